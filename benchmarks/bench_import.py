@@ -0,0 +1,166 @@
+# Benchmark of the import time of the entry modules (config, DB_tools, util_tools, ...).
+#
+# Each module is imported `--repeat` times in a fresh interpreter; the median wall time is
+# recorded, together with the slowest imports below it (from `python -X importtime`). The
+# benchmark also checks that importing the module has no side effects: no handler is added to the
+# root logger, the log file is not written, and none of the heavy optional libraries (statsmodels,
+# bokeh, matplotlib, sqlalchemy, dotenv) is loaded; they are imported where they are used.
+# Compared against a baseline, modules that got slower than `--tolerance` times the baseline or
+# that have side effects are reported and the script exits with status 1.
+#
+# Run from the project root:
+#
+#   python -m benchmarks.bench_import
+#   python -m benchmarks.bench_import --save-baseline          # record reports/benchmarks/imports_baseline.json
+#   python -m benchmarks.bench_import --baseline reports/benchmarks/imports_baseline.json
+
+import sys
+import json
+import argparse
+import platform
+import datetime
+import statistics
+import subprocess
+from pathlib import Path
+
+from src import config
+
+# entry modules of scripts and notebooks
+MODULES = ['src.config', 'src.data.DB_tools', 'src.data.util_tools', 'src.data.make_dataset', 'src.data.raw_store']
+
+# libraries that must not be loaded by importing an entry module
+HEAVY = ['statsmodels', 'bokeh', 'matplotlib', 'sqlalchemy', 'dotenv']
+
+# measures the import in the child interpreter and reports the state after it as JSON
+_PROBE = """
+import sys, json, time, logging
+log_file = {log_file!r}
+try:
+    import os
+    size = os.path.getsize(log_file)
+except OSError:
+    size = None
+tic = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - tic
+try:
+    log_written = os.path.getsize(log_file) != size
+except OSError:
+    log_written = size is not None
+print(json.dumps({{
+    'seconds': seconds,
+    'root_handlers': len(logging.getLogger().handlers),
+    'log_written': log_written,
+    'heavy': sorted(m for m in {heavy!r} if m in sys.modules),
+}}))
+"""
+
+
+def _run(args: list) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable] + args, cwd=config.project_dir, capture_output=True, text=True, check=True)
+
+
+def slowest_imports(module: str, top: int = 10) -> list:
+    """ The `top` imports with the largest cumulative time (-X importtime) when importing `module`. """
+
+    stderr = _run(['-X', 'importtime', '-c', f'import {module}']).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        rows.append({'module': name.strip(), 'cumulative_ms': int(cumulative) / 1000})
+    return sorted(rows, key=lambda r: r['cumulative_ms'], reverse=True)[:top]
+
+
+def measure(module: str, repeat: int) -> dict:
+    """ Imports `module` `repeat` times in a fresh interpreter; returns the median time and the side effects. """
+
+    probe = _PROBE.format(module=module, log_file=str(config.log_file_path), heavy=HEAVY)
+    runs = [json.loads(_run(['-c', probe]).stdout.splitlines()[-1]) for _ in range(repeat)]
+    return {
+        'seconds': statistics.median(r['seconds'] for r in runs),
+        'min_seconds': min(r['seconds'] for r in runs),
+        'root_handlers': runs[-1]['root_handlers'],
+        'log_written': any(r['log_written'] for r in runs),
+        'heavy': runs[-1]['heavy'],
+        'slowest': slowest_imports(module),
+    }
+
+
+def side_effects(result: dict) -> list:
+    """ Descriptions of the side effects of an import. """
+
+    effects = []
+    if result['root_handlers']:
+        effects.append(f"{result['root_handlers']} root logger handlers")
+    if result['log_written']:
+        effects.append("log file written")
+    if result['heavy']:
+        effects.append(f"loads {', '.join(result['heavy'])}")
+    return effects
+
+
+def run(args) -> dict:
+    results = {}
+    for module in args.modules:
+        result = measure(module, args.repeat)
+        results[module] = result
+        effects = side_effects(result)
+        print(f"{module:30s} {result['seconds'] * 1000:8.1f} ms  {'; '.join(effects) if effects else 'no side effects'}")
+
+    return {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'params': vars(args) | {'output': str(args.output), 'baseline': str(args.baseline)},
+        },
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """ Returns the modules that are slower than `tolerance` times the baseline. """
+
+    regressions = []
+    for name, result in report['results'].items():
+        base = baseline['results'].get(name)
+        if base and result['seconds'] > tolerance * base['seconds']:
+            regressions.append(f"{name}: {result['seconds']:.3f} s vs {base['seconds']:.3f} s baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the import time and side effects of the entry modules.')
+    parser.add_argument('--modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module, each in a fresh interpreter')
+    parser.add_argument('--output', type=Path, default=config.reports_dir / 'benchmarks' / 'imports.json')
+    parser.add_argument('--baseline', type=Path, default=None, help='compare with this baseline JSON')
+    parser.add_argument('--save-baseline', action='store_true', help='also save the results as imports_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed slowdown vs the baseline')
+    args = parser.parse_args()
+
+    report = run(args)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"results saved to {args.output}")
+
+    if args.save_baseline:
+        baseline_path = args.output.parent / 'imports_baseline.json'
+        baseline_path.write_text(json.dumps(report, indent=2))
+        print(f"baseline saved to {baseline_path}")
+
+    failures = [f"{name}: {'; '.join(side_effects(result))}" for name, result in report['results'].items()
+                if side_effects(result)]
+    if args.baseline is not None:
+        failures += compare(report, json.loads(args.baseline.read_text()), args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# Benchmark suite of the data pipeline on a synthetic sensor network.
+#
+# Generates a sqlite3 DB with the schema of the sensor DB (see src/data/synthetic.py), points the
+# pipeline at it (`config.DBType = 0`) and times the main steps: querying, downloading, loading,
+# resampling, decomposing and plotting. For each step the wall time, the number of rows, the
+# throughput and the peak memory (traced python and numpy allocations) are recorded in a JSON file.
+# Compared against a baseline, steps that got slower than `--tolerance` times the baseline are
+# reported as regressions and the script exits with status 1.
+#
+# Run from the project root:
+#
+#   python -m benchmarks.bench_pipeline --days 14 --sensors-per-type 5
+#   python -m benchmarks.bench_pipeline --save-baseline          # record reports/benchmarks/baseline.json
+#   python -m benchmarks.bench_pipeline --baseline reports/benchmarks/baseline.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+# plots are rendered headless
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from src import config
+from src.data import DB_tools as dbt
+from src.data import make_dataset, synthetic, util_tools
+
+
+def measure(results: dict, name: str, func, rows=None):
+    """ Runs `func` and records its wall time, peak memory and throughput under `name`. `rows` maps
+        the return value of `func` to the number of rows processed.
+    """
+
+    tracemalloc.start()
+    tic = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - tic
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n_rows = int(rows(value)) if rows is not None else None
+    results[name] = {
+        'seconds': round(seconds, 4),
+        'peak_mb': round(peak / 2**20, 2),
+        'rows': n_rows,
+        'rows_per_s': round(n_rows / seconds) if n_rows else None,
+    }
+    print(f"{name:<24} {seconds:8.3f} s  {peak / 2**20:8.1f} MB peak" +
+          (f"  {n_rows / seconds:12.0f} rows/s" if n_rows else ""))
+    return value
+
+
+def run(args) -> dict:
+    """ Generates the synthetic DB and runs all benchmarks in a temporary directory. """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        # point the pipeline at the synthetic DB; the query cache would only measure the disk
+        config.DBType = 0
+        config.SQLiteDBFile = tmp / 'synthetic.sqlite'
+        config.QueryCacheEnabled = False
+        config.RollupDir = tmp / 'rollups'
+        raw_dir = tmp / 'raw'
+
+        generated = measure(results, 'generate_db', lambda: synthetic.generate_db(
+            config.SQLiteDBFile, sensors_per_type=args.sensors_per_type, sampling_seconds=args.sampling_seconds,
+            gap_ratio=args.gap_ratio, days=args.days, seed=args.seed), rows=lambda g: g['measurements'])
+
+        sensor_id = int(dbt.GetSensorIdsOfType('temperature')['sensor_id'].iloc[0])
+        measure(results, 'GetTimeSeries', lambda: dbt.GetTimeSeries(sensor_id), rows=len)
+
+        measure(results, 'download_data', lambda: make_dataset.download_data(output_dir=raw_dir),
+                rows=lambda _: generated['measurements'])
+
+        def load_all():
+            data = util_tools.load_sensor_data(raw_dir)
+            return {sensor_type: data[sensor_type] for sensor_type in data}
+
+        data = measure(results, 'load_sensor_data', load_all, rows=lambda d: sum(df.notna().sum().sum() for df in d.values()))
+        temperature = data['temperature']
+
+        resampled = measure(results, 'resample_data', lambda: util_tools.resample_data(temperature),
+                            rows=lambda _: temperature.notna().sum().sum())
+
+        series = resampled.iloc[:, 0].dropna()
+        measure(results, 'seasonal_decomposition', lambda: util_tools.seasonal_decomposition(series), rows=lambda _: len(series))
+        plt.close('all')
+        measure(results, 'loess_decomposition', lambda: util_tools.loess_decomposition(series), rows=lambda _: len(series))
+        plt.close('all')
+
+        cwd = Path.cwd()
+        os.chdir(tmp)  # plot_all_sensors saves the HTML file in the working directory
+        try:
+            measure(results, 'plot_all_sensors', lambda: util_tools.plot_all_sensors(temperature, show_plot=False),
+                    rows=lambda _: temperature.size)
+        finally:
+            os.chdir(cwd)
+
+        dbt.dispose_engines()
+
+    return {
+        'meta': {
+            'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'params': vars(args) | {'output': str(args.output), 'baseline': str(args.baseline)},
+        },
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """ Returns the benchmarks that are slower than `tolerance` times the baseline. """
+
+    regressions = []
+    for name, result in report['results'].items():
+        base = baseline['results'].get(name)
+        if base and result['seconds'] > tolerance * base['seconds']:
+            regressions.append(f"{name}: {result['seconds']:.3f} s vs {base['seconds']:.3f} s baseline")
+    return regressions
+
+
+def main():
+    config.init()
+    parser = argparse.ArgumentParser(description='Benchmarks the data pipeline on a synthetic sensor network.')
+    parser.add_argument('--sensors-per-type', type=int, default=5)
+    parser.add_argument('--sampling-seconds', type=int, default=60)
+    parser.add_argument('--gap-ratio', type=float, default=0.05)
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, default=config.reports_dir / 'benchmarks' / 'latest.json')
+    parser.add_argument('--baseline', type=Path, default=None, help='compare with this baseline JSON')
+    parser.add_argument('--save-baseline', action='store_true', help='also save the results as baseline.json')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed slowdown vs the baseline')
+    args = parser.parse_args()
+
+    report = run(args)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"results saved to {args.output}")
+
+    if args.save_baseline:
+        baseline_path = args.output.parent / 'baseline.json'
+        baseline_path.write_text(json.dumps(report, indent=2))
+        print(f"baseline saved to {baseline_path}")
+
+    if args.baseline is not None:
+        regressions = compare(report, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
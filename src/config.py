@@ -1,14 +1,16 @@
 """
 This module:
-- sets up the logger
+- sets up the logger (in init())
 - defines file paths
-- imports the .env file
+- imports the .env file (in init() or load_env())
 - defines start and end date for evaluations
 - defines parameters used in the evaluations
 - defines the DB connection type
 - selects which sensor types to evaluate
 
-Import this module in any other modules and in the beginning of each notebook.
+Import this module in any other modules. Importing it has no side effects; call `config.init()` in
+the entry point of a program (script, pipeline, beginning of each notebook) to set up the logger and
+load the .env file.
 
 .. note::
     The root logger is setup to log to a file and to the console. The console 
@@ -20,10 +22,7 @@ Import this module in any other modules and in the beginning of each notebook.
 
 import sys
 import logging
-import logging.config
-from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from dotenv import find_dotenv, load_dotenv
 
 
 ### define paths 
@@ -43,72 +42,21 @@ reports_dir = project_dir / "reports"
 # data path for the modelling results, e.g. SARIMAX
 model_dir = project_dir / "models"
 
+# data path for the exported figures, e.g. ACF/PACF plots
+images_dir = project_dir / "data" / "images"
 
+# data path for the HTML overview plots of the pipeline (see visualization/visualize.py)
+figures_dir = reports_dir / "figures"
 
 
 
-### Setup logging
 
-# The root logger is setup to log to a file and to the console. The console handler is set to INFO level,
-# which is convenient because instead of using print() to display information, you can use logger.info() and
-# see the output in the console and in the file. The file is helpful for longer outputs.
 
-
-# Get the root logger
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO) # logging.INFO
-
-
-
-# Remove existing handlers to avoid output to console
-root_logger.handlers = []
-
-# Create file formatter
-file_formatter = logging.Formatter('%(asctime)s-%(name)s-%(levelname)s- %(message)s')
-file_formatter.default_time_format = '%Y%m%d %H:%M:%S'
-
-# Create handler for file logging
+# log file, see init()
 log_file_path = project_dir / 'logs' / 'SmartBuilding.log'
-file_handler = RotatingFileHandler(log_file_path, maxBytes=3*1024*1024, backupCount=5)
-file_handler.setLevel(logging.NOTSET)
-file_handler.setFormatter(file_formatter)
-
-# Create console formatter
-console_formatter = logging.Formatter('%(message)s')
-
-# Create handler for console logging
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(console_formatter)
-
-# Add handler to the logger
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
-
-# log start time
-root_logger.info('config==========================================')
-
 
 # get logger for this file
 logger = logging.getLogger("config")
-logger.info('running config.py')
-
-# log paths
-logger.info(f"project dir {project_dir}")
-logger.info(f"raw data dir {data_raw_dir}")
-logger.info(f"processed data dir {data_processed_dir}")
-logger.info(f"reports dir {reports_dir}")
-logger.info(f"model dir {model_dir}")
-
-
-
-
-### Misc
-
-# load .env file
-load_dotenv(find_dotenv())
-logger.info(f"loaded .env file from {find_dotenv()}")
-
 
 
 ### Global parameters
@@ -122,26 +70,197 @@ else:
     StartDate = None
     EndDate = None
 
-logger.info(f"StartDate: {StartDate}  EndDate: {EndDate}")
-
 
 # specify how many data points should be used for the evaluation; use None for all data points
 NrDataPoints = None #10000 / None
-root_logger.info(f"NrDataPoints: {NrDataPoints}")
 
 
 # select the DB connection type; connection details are defined in .env
-# 0 = sqlite3 (connection paramters not yet in .env)
+# 0 = sqlite3, local mirror of the DB in SQLiteDBFile (create and refresh it with db_mirror.sync())
 # 1 = MariaDB 
 # 2 = MySQL
 DBType = 2
 
+# local sqlite3 mirror of the sensor DB (DBType 0), and the DBType of the server it mirrors
+SQLiteDBFile = project_dir / "data" / "mirror" / "SmartBuilding.sqlite"
+MirrorSourceDBType = 2
+
+# connection pool of the shared DB engine (see DB_tools._get_engine); one engine is kept per process
+DBPoolSize = 5          # connections kept open in the pool
+DBMaxOverflow = 10      # additional connections opened under load, closed again when returned
+DBPoolPrePing = True    # test a connection before using it; replaces connections dropped by the server
+DBPoolRecycle = 3600    # replace connections older than this many seconds (below the server's wait_timeout)
+
+# bulk download of time series (see DB_tools.GetTimeSeriesBulk)
+BulkSensorBatchSize = 50    # sensors per query (sensor_id IN (...))
+BulkWindowDays = 31         # days per query; limits the size of a single result set
+
+# concurrent download (see downloader.Downloader); keep DownloadMaxWorkers <= DBPoolSize + DBMaxOverflow
+DownloadMaxWorkers = 4          # queries in flight at the same time
+DownloadRetries = 3             # retries of a query after a transient error (lost connection, timeout)
+DownloadBackoff = 1.0           # seconds before the first retry; doubled for every further retry
+DownloadProgressSeconds = 10    # interval of the progress log (rows/s, MB/s)
+
+# rows per chunk when streaming a time series (see DB_tools.GetTimeSeriesChunks)
+StreamChunkSize = 100_000
+
+# local cache of query results (see query_cache); historical measurements never change, so repeated
+# analysis runs can be served from disk
+QueryCacheEnabled = True
+QueryCacheDir = project_dir / "data" / "cache" / "queries"
+QueryCacheMaxBytes = 5 * 1024**3    # least recently used results are evicted above this size
+QueryCacheTTLMetadata = 3600        # seconds; sensors, sensor types, rooms and devices
+QueryCacheTTLRecent = 300           # seconds; measurements of a range that includes today, and empty results
+QueryCacheTTLClosed = 7 * 24 * 3600 # seconds; measurements of a closed range in the past (rows can arrive late)
+
+# dtype of the downloaded sensor values; 'float32' halves the memory, the sensors have < 7 significant digits
+ValueDtype = 'float64'
+
+# rows per parquet row group in the raw dataset (see raw_store); smaller groups let time filters skip more data
+RawRowGroupSize = 65_536
+
+# layout of newly written raw data (see raw_store): 'wide' (one column per sensor, mostly NaN) or 'long'
+# (one (timestamp, sensor_id, value) row per measurement with float32 values, several times smaller)
+RawStorageFormat = 'wide'
+
+# memory budget of the frames cached by util_tools.load_sensor_data (raw_store.SensorData)
+SensorDataCacheBytes = 2 * 1024**3
+
+# resampling stage (make_dataset.resample_data): bin width, and the longest gap of a sensor that is
+# interpolated; longer gaps hold the last value, which bounds the rows held back while streaming
+ResampleRate = '2min'
+ResampleMaxGap = '1D'
+
+# batch stationarity tests (features.stationarity): worker processes (None = number of CPUs), and the
+# cache of the results per sensor, keyed by a fingerprint of the data and the test settings
+StationarityMaxWorkers = None
+StationarityCacheDir = project_dir / "data" / "cache" / "stationarity"
+
+# batch decomposition (features.decomposition): worker processes (None = number of CPUs), and the
+# directory of the stored trend/seasonal/residual components, one parquet file per sensor
+DecompositionMaxWorkers = None
+DecompositionDir = data_processed_dir / "decomposition"
+
+# level-of-detail downsampling of interactive plots (visualization.lod): points per sensor, about two
+# per pixel of the plot width, and the method, 'minmax' (keeps all spikes) or 'lttb' (keeps the shape)
+PlotMaxPoints = 2400
+PlotLODMethod = 'minmax'
+
+# rollup store (see data/rollups.py): aggregates (count, min, max, sum, sum of squares) of the raw data
+# per sensor at these resolutions; download_data keeps them up to date if RollupsEnabled
+RollupsEnabled = True
+RollupDir = project_dir / "data" / "rollups"
+RollupResolutions = ['1min', '15min', '1h', '1D']
+
+# worker processes that render figures in batch (features.autocorrelation.plot_sensors); None = number of CPUs
+PlotMaxWorkers = None
+
+# stage runner of the pipeline (see pipeline.py): stages that run at the same time, each in its own
+# worker process (None = number of CPUs), and the fingerprints of the last successful run of each stage
+PipelineMaxWorkers = None
+PipelineStateDir = project_dir / "data" / "cache" / "pipeline"
+
+# feature store (features.build_features): lags and trailing windows of the rolling mean/std/min/max
+# (durations), the float32 feature tables, and the tail that is recomputed when new data arrives; the
+# resampling revises at most the last ResampleMaxGap of the data, so the tail should not be shorter
+FeatureLags = ['2min', '10min', '1h', '1D', '7D']
+FeatureWindows = ['1h', '6h', '1D']
+FeatureDir = data_processed_dir / "features"
+FeatureRecomputeTail = '1D'
+
+# metrics of the hot paths (see instrumentation.py): query and write latencies, rows, bytes, cache hits;
+# off by default, disabled they cost one flag check per call. Exported as JSON and Prometheus text file
+MetricsEnabled = False
+MetricsDir = reports_dir / "metrics"
+
 
 # define sensor types to download
 sensor_types = ["temperature", "voc", "co2", "humidity", "light", "uv", "pressure"]
-logger.info(f"selected sensor_types: {sensor_types}")
 
-# TODO define resampling frequency
 
 
-root_logger.info('==========================================config')
\ No newline at end of file
+### Initialization
+
+_env_loaded = False
+_initialized = False
+
+
+def load_env():
+    """ Loads the .env file with the DB connection parameters into the environment, once. Called by
+        init() and before the first DB connection.
+    """
+
+    global _env_loaded
+    if _env_loaded:
+        return
+    from dotenv import find_dotenv, load_dotenv
+
+    env_file = find_dotenv()
+    load_dotenv(env_file)
+    _env_loaded = True
+    logger.info(f"loaded .env file from {env_file}")
+
+
+def init(log_to_file: bool = True):
+    """ Sets up the root logger and loads the .env file; only the first call has an effect.
+
+    The root logger is setup to log to a file and to the console. The console handler is set to INFO level,
+    which is convenient because instead of using print() to display information, you can use logger.info() and
+    see the output in the console and in the file. The file is helpful for longer outputs.
+    """
+
+    global _initialized
+    if _initialized:
+        return
+    _initialized = True
+
+    from logging.handlers import RotatingFileHandler
+
+    # Get the root logger
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO) # logging.INFO
+
+    # Remove existing handlers to avoid output to console
+    root_logger.handlers = []
+
+    if log_to_file:
+        # Create file formatter
+        file_formatter = logging.Formatter('%(asctime)s-%(name)s-%(levelname)s- %(message)s')
+        file_formatter.default_time_format = '%Y%m%d %H:%M:%S'
+
+        # Create handler for file logging
+        file_handler = RotatingFileHandler(log_file_path, maxBytes=3*1024*1024, backupCount=5)
+        file_handler.setLevel(logging.NOTSET)
+        file_handler.setFormatter(file_formatter)
+        root_logger.addHandler(file_handler)
+
+    # Create console formatter
+    console_formatter = logging.Formatter('%(message)s')
+
+    # Create handler for console logging
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(console_formatter)
+    root_logger.addHandler(console_handler)
+
+    # log start time
+    root_logger.info('config==========================================')
+    logger.info('running config.py')
+
+    # log paths
+    logger.info(f"project dir {project_dir}")
+    logger.info(f"raw data dir {data_raw_dir}")
+    logger.info(f"processed data dir {data_processed_dir}")
+    logger.info(f"reports dir {reports_dir}")
+    logger.info(f"model dir {model_dir}")
+    logger.info(f"images dir {images_dir}")
+    logger.info(f"figures dir {figures_dir}")
+
+    # load .env file
+    load_env()
+
+    # log parameters
+    logger.info(f"StartDate: {StartDate}  EndDate: {EndDate}")
+    root_logger.info(f"NrDataPoints: {NrDataPoints}")
+    logger.info(f"selected sensor_types: {sensor_types}")
+    root_logger.info('==========================================config')
\ No newline at end of file
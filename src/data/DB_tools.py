@@ -1,18 +1,28 @@
 # Tools to access the DB storing the sensor data.
 
 import os
+import time
+import atexit
 import logging
-import pendulum
+import threading
 
 import contextlib
 import sqlite3
-import sqlalchemy
 
+import numpy as np
 import pandas as pd
-from typing import List
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Tuple
 
 # import config to config the logger, load environemt variables, ...
 from src import config
+from src import instrumentation
+from src.data import query_cache
+
+# sqlalchemy and the DB drivers are only imported when the first engine is created, so the sqlite
+# path and importing this module stay fast
+if TYPE_CHECKING:
+    import sqlalchemy
 
 ### DB connection parameters are now defined in .env and config.py
 
@@ -20,13 +30,158 @@ from src import config
 logger = logging.getLogger(__name__)
 
 
+##### DB engines
+
+# Process-wide engine registry: one pooled engine per DBType, created on first use and shared by
+# all queries. Creating an engine per query costs a TCP connect and the auth handshake every time.
+_engines = {}
+_engines_lock = threading.Lock()
+
+# per-query timing, see query_stats()
+_query_stats = {'queries': 0, 'rows': 0, 'connect_s': 0.0, 'query_s': 0.0}
+_query_stats_lock = threading.Lock()
+
+
+def _engine_url(db_type: int) -> str:
+    """ Builds the sqlalchemy URL for the specified DBType from the parameters in .env. """
+
+    config.load_env()
+
+    if db_type == 1:
+        # get connection parameters from .env
+        DBUser = os.environ.get('MariaDB.User')
+        DBPW = os.environ.get('MariaDB.PW')
+        DBHost = os.environ.get('MariaDB.Host')
+        DBPort = os.environ.get('MariaDB.Port')
+        DBName = os.environ.get('MariaDB.DBName')
+        logger.debug(f"MariaDB connection parameters: {DBUser} DBPW {DBHost} {DBPort} {DBName}")
+
+        # pandas somehow only supports sqlalchemy and not pymysql and not mysql.connector
+        # https://docs.sqlalchemy.org/en/20/dialects/mysql.html#module-sqlalchemy.dialects.mysql.mariadbconnector
+        return f"mariadb+mariadbconnector://{DBUser}:{DBPW}@{DBHost}:{DBPort}/{DBName}"
+
+    if db_type == 2:
+        # get connection parameters from .env
+        DBUser = os.environ.get('mysql.User')
+        DBPW = os.environ.get('mysql.PW')
+        DBHost = os.environ.get('mysql.Host')
+        # DBPort = os.environ.get('MySql.Port')
+        DBName = os.environ.get('mysql.DBName')
+        logger.debug(f"MySql connection parameters: {DBUser} DBPW {DBHost} {DBName}")
+
+        # https://docs.sqlalchemy.org/en/20/dialects/mysql.html#module-sqlalchemy.dialects.mysql.pymysql
+        return f"mysql+pymysql://{DBUser}:{DBPW}@{DBHost}/{DBName}"
+
+    logger.error(f"DBType {db_type} has no pooled engine")
+    raise ValueError(f"DBType {db_type} has no pooled engine")
+
+
+def db_identity() -> str:
+    """ Identity of the configured DB for the query cache keys: the sqlite file, or the server URL
+        without the password.
+    """
+
+    if config.DBType == 0:
+        return f"sqlite:///{Path(config.SQLiteDBFile).resolve()}"
+
+    from sqlalchemy.engine import make_url
+    return make_url(_engine_url(config.DBType)).render_as_string(hide_password=True)
+
+
+def _get_engine(db_type: int = None) -> 'sqlalchemy.engine.Engine':
+    """ Returns the shared, pooled engine for the specified DBType (default `config.DBType`).
+        The pool is configured by `config.DBPoolSize`, `config.DBMaxOverflow`,
+        `config.DBPoolPrePing` and `config.DBPoolRecycle`.
+    """
+
+    if db_type is None:
+        db_type = config.DBType
+
+    engine = _engines.get(db_type)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        # another thread might have created the engine while we waited for the lock
+        engine = _engines.get(db_type)
+        if engine is None:
+            import sqlalchemy
+            engine = sqlalchemy.create_engine(_engine_url(db_type),
+                                              pool_size=config.DBPoolSize,
+                                              max_overflow=config.DBMaxOverflow,
+                                              pool_pre_ping=config.DBPoolPrePing,
+                                              pool_recycle=config.DBPoolRecycle)
+            _engines[db_type] = engine
+            logger.info(f"created pooled engine for DBType {db_type} (pool_size={config.DBPoolSize}, "
+                        f"max_overflow={config.DBMaxOverflow})")
+
+    return engine
+
+
+def dispose_engines():
+    """ Closes all pooled connections and drops the engines. Call this at the end of a run; the
+        next query creates a fresh engine.
+    """
+
+    with _engines_lock:
+        for db_type, engine in _engines.items():
+            engine.dispose()
+            logger.debug(f"disposed engine for DBType {db_type}")
+        _engines.clear()
+
+
+# close pooled connections cleanly if the caller did not call dispose_engines()
+atexit.register(dispose_engines)
+
+
+def query_stats() -> dict:
+    """ Returns the accumulated query timing: number of queries, rows, and the seconds spent
+        checking out connections (`connect_s`) and running the queries (`query_s`).
+    """
+
+    with _query_stats_lock:
+        stats = dict(_query_stats)
+    stats['avg_connect_ms'] = 1000 * stats['connect_s'] / stats['queries'] if stats['queries'] else 0.0
+    stats['avg_query_ms'] = 1000 * stats['query_s'] / stats['queries'] if stats['queries'] else 0.0
+    return stats
+
+
+def reset_query_stats():
+    """ Resets the counters returned by query_stats(). """
+
+    with _query_stats_lock:
+        _query_stats.update(queries=0, rows=0, connect_s=0.0, query_s=0.0)
+
+
 ##### DB connectors
 
+def _general_ci(a: str, b: str) -> int:
+    """ Case insensitive collation, the sqlite stand-in for MySQL's utf8mb4_general_ci. """
+
+    a, b = a.casefold(), b.casefold()
+    return (a > b) - (a < b)
+
+
+def connect_sqlite(db_file: Path = None) -> sqlite3.Connection:
+    """ Opens the local sqlite3 database (default `config.SQLiteDBFile`, see db_mirror.py). The
+        MySQL collation used by the queries is registered, so they run unchanged.
+    """
+
+    db_file = Path(db_file) if db_file is not None else Path(config.SQLiteDBFile)
+    conn = sqlite3.connect(db_file)
+    conn.create_collation('utf8mb4_general_ci', _general_ci)
+    return conn
+
+
 @contextlib.contextmanager
 def _open_sqlite():
     """ Connector to the sqlite3 database. """
 
-    conn = sqlite3.connect(db_file)
+    if not Path(config.SQLiteDBFile).exists():
+        logger.error(f"sqlite DB {config.SQLiteDBFile} not found; run db_mirror.sync() first")
+        raise FileNotFoundError(f"sqlite DB {config.SQLiteDBFile} not found; run db_mirror.sync() first")
+
+    conn = connect_sqlite()
     try:
         yield conn
     except BaseException:
@@ -38,73 +193,137 @@ def _open_sqlite():
 
 @contextlib.contextmanager
 def _open_mariadb():
-    """ Connector to the MariaDB database. """
-
-    # get connection parameters from .env
-    DBUser = os.environ.get('MariaDB.User')
-    DBPW = os.environ.get('MariaDB.PW')
-    DBHost = os.environ.get('MariaDB.Host')
-    DBPort = os.environ.get('MariaDB.Port')
-    DBName = os.environ.get('MariaDB.DBName')
-    logger.debug(f"MariaDB connection parameters: {DBUser} DBPW {DBHost} {DBPort} {DBName}")
+    """ Connector to the MariaDB database; checks out a connection from the shared pool. """
 
-    # pandas somehow only supports sqlalchemy and not pymysql and not mysql.connector
-    # https://docs.sqlalchemy.org/en/20/dialects/mysql.html#module-sqlalchemy.dialects.mysql.mariadbconnector
-    conn = sqlalchemy.create_engine(f"mariadb+mariadbconnector://{DBUser}:{DBPW}@{DBHost}:{DBPort}/{DBName}")
-
-    try:
+    with _get_engine(1).connect() as conn:
         yield conn
-    except BaseException:
-        # conn.rollback()
-        raise
-    finally:
-        conn.dispose()
 
 
 @contextlib.contextmanager
 def _open_mysql():
-    """ Connector to the mySQL database. """
-
-    # get connection parameters from .env
-    DBUser = os.environ.get('mysql.User')
-    DBPW = os.environ.get('mysql.PW')
-    DBHost = os.environ.get('mysql.Host')
-    # DBPort = os.environ.get('MySql.Port')
-    DBName = os.environ.get('mysql.DBName')
-    logger.debug(f"MySql connection parameters: {DBUser} DBPW {DBHost} {DBName}")
+    """ Connector to the mySQL database; checks out a connection from the shared pool. """
 
-    # pandas somehow only supports sqlalchemy and not pymysql and not mysql.connector
-    # https://docs.sqlalchemy.org/en/20/dialects/mysql.html#module-sqlalchemy.dialects.mysql.pymysql
-    conn = sqlalchemy.create_engine(f"mysql+pymysql://{DBUser}:{DBPW}@{DBHost}/{DBName}")
-
-    try:
+    with _get_engine(2).connect() as conn:
         yield conn
-    except BaseException:
-        # conn.rollback()
-        raise
-    finally:
-        conn.dispose()
 
 
 ##### DB queries
 
-def query(sql_query: str, query_args: List[str] = None) -> pd.DataFrame:
-    """ Query the database with the specified SQL query and return a dataframe. """
+def _execute(conn, sql_query: str, query_args=None):
+    """ Executes the query on a sqlalchemy or sqlite3 connection and returns the cursor. """
+
+    if isinstance(conn, sqlite3.Connection):
+        return conn.execute(sql_query, query_args or ())
+    if query_args:
+        return conn.exec_driver_sql(sql_query, tuple(query_args))
+    return conn.exec_driver_sql(sql_query)
+
+
+def _typed_frame(rows, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """ Builds a dataframe from result rows with one numpy array per column, converted straight to
+        the dtypes in `dtypes` (column name -> dtype, in the order of the selected columns), so no
+        object columns are created. Datetime columns are expected as integer microseconds since the
+        epoch (see _timestamp_sql()).
+    """
+
+    columns = list(zip(*rows)) if rows else [()] * len(dtypes)
+
+    data = {}
+    for (name, dtype), values in zip(dtypes.items(), columns):
+        if np.dtype(dtype).kind == 'M':
+            data[name] = np.array(values, dtype=np.int64).view('datetime64[us]').astype(dtype)
+        else:
+            data[name] = np.array(values, dtype=dtype)
+
+    return pd.DataFrame(data, copy=False)
+
+
+def _timed_read(open_conn, sql_query: str, query_args, dtypes: Dict[str, str] = None) -> pd.DataFrame:
+    """ Runs the query on a connection from `open_conn` and records the timing. """
+
+    tic = time.perf_counter()
+    with open_conn() as conn:
+        tac = time.perf_counter()
+        if dtypes is None:
+            df = pd.read_sql_query(sql_query, conn, params=query_args)
+        else:
+            df = _typed_frame(_execute(conn, sql_query, query_args).fetchall(), dtypes)
+    toc = time.perf_counter()
+
+    with _query_stats_lock:
+        _query_stats['queries'] += 1
+        _query_stats['rows'] += len(df)
+        _query_stats['connect_s'] += tac - tic
+        _query_stats['query_s'] += toc - tac
+    if instrumentation.enabled():
+        instrumentation.observe('db_connect_seconds', tac - tic)
+        instrumentation.observe('db_query_seconds', toc - tac)
+        instrumentation.count('db_queries_total')
+        instrumentation.count('db_rows_total', len(df))
+        instrumentation.count('db_bytes_total', int(df.memory_usage(index=False).sum()))
+    logger.debug(f"query: {len(df)} rows, connect {1000 * (tac - tic):.1f} ms, query {1000 * (toc - tac):.1f} ms")
+
+    return df
+
+
+def _connector():
+    """ Returns the connector of the configured `config.DBType`. """
 
     if config.DBType == 0:
-        with _open_sqlite() as conn:
-            return pd.read_sql_query(sql_query, conn, params=query_args)
+        return _open_sqlite
     elif config.DBType == 1:
-        with _open_mariadb() as conn:
-            return pd.read_sql_query(sql_query, conn, params=query_args)
+        return _open_mariadb
     elif config.DBType == 2:
-        with _open_mysql() as conn:
-            return pd.read_sql_query(sql_query, conn, params=query_args)
+        return _open_mysql
     else:
         logger.error("DBType not supported")
         raise ValueError("DBType not supported")
 
 
+@contextlib.contextmanager
+def _open_stream():
+    """ Opens a connection that streams results with a server-side cursor instead of buffering
+        the whole result set on the client.
+    """
+
+    with _connector()() as conn:
+        if not isinstance(conn, sqlite3.Connection):
+            conn = conn.execution_options(stream_results=True)
+        yield conn
+
+
+def query(sql_query: str, query_args: List[str] = None, dtypes: Dict[str, str] = None,
+          ttl: float = None) -> pd.DataFrame:
+    """ Query the database with the specified SQL query and return a dataframe. With `dtypes`
+        (column name -> dtype for each selected column), the columns are built directly with these
+        dtypes, see _typed_frame().
+
+        If `config.QueryCacheEnabled`, results are served from the local query cache while they are
+        younger than `ttl` seconds (default by query class, see query_cache; NO_CACHE bypasses it).
+    """
+
+    use_cache = config.QueryCacheEnabled
+    if use_cache:
+        if ttl is None:
+            ttl = query_cache.default_ttl(sql_query)
+        use_cache = ttl != query_cache.NO_CACHE
+
+    if use_cache:
+        db = db_identity()
+        df = query_cache.get(sql_query, query_args, dtypes, db)
+        instrumentation.count('query_cache_requests_total', result='miss' if df is None else 'hit')
+        if df is not None:
+            logger.debug(f"query: {len(df)} rows from the query cache")
+            return df
+
+    df = _timed_read(_connector(), sql_query, query_args, dtypes)
+
+    if use_cache:
+        query_cache.put(sql_query, query_args, dtypes, df, ttl, db)
+
+    return df
+
+
 def GetSensorId(sensor_name: str) -> pd.DataFrame:
     """ Queries the sensor_id for the specified sensor name. """
 
@@ -137,11 +356,69 @@ def GetRooms() -> pd.DataFrame:
     return q
 
 
-def GetTimeSeries(sensor_id: str, start_date: str = None, end_date: str = None, limit: int = None) -> pd.DataFrame:
-    """ Queries the time series of the specified sensor. """
+def _timestamp_sql() -> str:
+    """ SQL expression that builds the measurement timestamp from 'date' and 'time' on the DB server,
+        as integer microseconds since 1970-01-01 (no time zone conversion).
+    """
+
+    if config.DBType == 0:
+        # sqlite has no TIMESTAMP(); julianday() also keeps fractional seconds
+        return "CAST(ROUND((julianday(date || ' ' || time) - 2440587.5) * 86400000) AS INTEGER) * 1000"
+
+    return "TIMESTAMPDIFF(MICROSECOND, '1970-01-01', TIMESTAMP(date, time))"
+
+
+def _series_dtypes(*id_columns: str) -> Dict[str, str]:
+    """ dtypes of a typed time series query selecting `id_columns`, the timestamp and the value. """
+
+    dtypes = {column: 'int64' for column in id_columns}
+    dtypes['timestamp'] = 'datetime64[ns]'
+    dtypes['value'] = config.ValueDtype
+    return dtypes
+
+
+def _date_windows(start_date: str = None, end_date: str = None, window_days: int = None) -> List[Tuple[str, float]]:
+    """ Splits the date range into windows of `window_days` days and returns the SQL condition of each
+        window together with the cache TTL of its results (see query_cache.range_ttl()). Without a
+        start date or window size the whole range is a single window. The last window is open ended
+        if no end date is given, so rows dated today are not missed. Raises a ValueError if the start
+        date is after the end date.
+    """
+
+    if start_date is not None and end_date is not None and pd.Timestamp(start_date) > pd.Timestamp(end_date):
+        raise ValueError(f"start date {start_date} is after the end date {end_date}")
+
+    # end_date is inclusive, the TTL expects the exclusive upper date
+    end_ttl = query_cache.range_ttl(pd.Timestamp(end_date) + pd.Timedelta(days=1) if end_date is not None else None)
+
+    if start_date is None or not window_days:
+        cond = ""
+        if start_date is not None:
+            cond += f"AND date >= '{start_date}' "
+        if end_date is not None:
+            cond += f"AND date <= '{end_date}' "
+        return [(cond, end_ttl)]
+
+    stop = pd.Timestamp(end_date) if end_date is not None else pd.Timestamp.today().normalize()
+    # a start date after today gives a single window from the start date
+    bounds = list(pd.date_range(pd.Timestamp(start_date), stop, freq=f"{window_days}D")) or [pd.Timestamp(start_date)]
+
+    windows = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        windows.append((f"AND date >= '{lo:%Y-%m-%d}' AND date < '{hi:%Y-%m-%d}' ", query_cache.range_ttl(hi)))
+    last = f"AND date >= '{bounds[-1]:%Y-%m-%d}' "
+    if end_date is not None:
+        last += f"AND date <= '{end_date}' "
+    windows.append((last, end_ttl))
+
+    return windows
+
+
+def _time_series_sql(sensor_id: str, start_date: str = None, end_date: str = None, limit: int = None) -> str:
+    """ SQL query for the time series of the specified sensor; selects the timestamp and the value. """
 
     sql = f"""
-    SELECT *
+    SELECT {_timestamp_sql()} AS ts, value
     FROM tblMeasurement
     WHERE sensor_id = {sensor_id}
     """
@@ -162,31 +439,139 @@ def GetTimeSeries(sensor_id: str, start_date: str = None, end_date: str = None,
     else:
         sql += ";"
 
-    df = query(sql)
+    return sql
+
+
+def GetTimeSeriesChunks(sensor_id: str, start_date: str = None, end_date: str = None, limit: int = None,
+                        chunk_size: int = None, arrow: bool = False) -> Iterator[pd.DataFrame]:
+    """ Streams the time series of the specified sensor in chunks of `chunk_size` rows (default
+        `config.StreamChunkSize`), so memory stays bounded by the chunk size instead of the length of
+        the time series. Each chunk has a datetime64[ns] 'timestamp' index, built on the DB server, and
+        a 'value' column of `config.ValueDtype`. With `arrow=True` the chunks are yielded as
+        `pyarrow.Table`.
+
+        The connection stays checked out until the generator is exhausted or closed.
+    """
+
+    if chunk_size is None:
+        chunk_size = config.StreamChunkSize
 
-    # log results
-    logger.debug(f"GetTimeSeries: df head: {df.head()}")
-    logger.debug(f"GetTimeSeries: df info: {df.info()}")
+    if arrow:
+        import pyarrow as pa
 
-    # Combine 'date' and 'time' columns into a single datetime column
-    df['date'] = pd.to_datetime(df['date'])
-    df['time'] = pd.to_timedelta(df['time'])
-    df['timestamp'] = df['date'] + df['time']
-    df = df.drop(['date', 'time'], axis=1)
+    sql = _time_series_sql(sensor_id, start_date, end_date, limit)
+    dtypes = _series_dtypes()
 
-    # make timestamp the index
-    # df = df.set_index('timestamp')
+    with _open_stream() as conn:
+        cursor = _execute(conn, sql)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
 
-    # drop columns that are not needed
-    df = df.drop(['sensor_id', 'measurement_id'], axis=1)
+            instrumentation.count('db_stream_rows_total', len(rows))
+            chunk = _typed_frame(rows, dtypes).set_index('timestamp')
 
-    # log results
-    logger.debug(f"GetTimeSeries processed: df head=\t {df.head()}")
-    # logger.debug(f"GetTimeSeries processed: df info: {df.info()}")
+            if arrow:
+                yield pa.Table.from_pandas(chunk)
+            else:
+                yield chunk
+
+
+def GetTimeSeries(sensor_id: str, start_date: str = None, end_date: str = None, limit: int = None) -> pd.DataFrame:
+    """ Queries the time series of the specified sensor. Returns the columns 'value' and
+        'timestamp'; GetTimeSeriesChunks() returns the timestamp as index instead.
+    """
+
+    with instrumentation.timer('get_time_series_seconds'):
+        chunks = list(GetTimeSeriesChunks(sensor_id, start_date, end_date, limit))
+        if not chunks:
+            return _typed_frame([], _series_dtypes())[['value', 'timestamp']]
+
+        df = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+        df = df.reset_index()[['value', 'timestamp']]
+    instrumentation.count('get_time_series_rows_total', len(df))
+
+    # log results; df.head() is only formatted if debug messages are logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"GetTimeSeries processed: df head=\t {df.head()}")
 
     return df
 
 
+def GetTimeSeriesBulk(sensor_ids: Iterable, start_date: str = None, end_date: str = None,
+                      batch_size: int = None, window_days: int = None,
+                      after_measurement_id: Dict[int, int] = None,
+                      keep_measurement_id: bool = False) -> Dict[int, pd.DataFrame]:
+    """ Queries the time series of many sensors at once. Instead of one query per sensor, the sensors
+        are fetched in batches of `batch_size` (`sensor_id IN (...)`) and the date range is split into
+        windows of `window_days` days (defaults `config.BulkSensorBatchSize`, `config.BulkWindowDays`).
+
+        With `after_measurement_id` (sensor_id -> measurement_id) only rows inserted after the given
+        measurement are returned, which also includes rows that arrive late with an older date. The
+        measurement_id bounds the result, so the date range is not split into windows then.
+
+        Returns a dict sensor_id -> dataframe indexed by timestamp with a 'value' column, like the
+        chunks of GetTimeSeriesChunks(), plus a 'measurement_id' column if `keep_measurement_id` is
+        set. Sensors without data in the date range are not in the dict.
+    """
+
+    sensor_ids = [int(sensor_id) for sensor_id in sensor_ids]
+    if batch_size is None:
+        batch_size = config.BulkSensorBatchSize
+    if window_days is None:
+        window_days = config.BulkWindowDays
+    if after_measurement_id is not None:
+        window_days = 0
+
+    windows = _date_windows(start_date, end_date, window_days)
+    id_columns = ('measurement_id', 'sensor_id') if keep_measurement_id or after_measurement_id is not None \
+        else ('sensor_id',)
+    dtypes = _series_dtypes(*id_columns)
+    columns = f"{', '.join(id_columns)}, {_timestamp_sql()} AS ts, value"
+
+    parts = []
+    for i in range(0, len(sensor_ids), batch_size):
+        batch = sensor_ids[i:i + batch_size]
+        id_list = ", ".join(str(sensor_id) for sensor_id in batch)
+
+        # a single lower bound for the batch; rows below a sensor's own watermark are dropped below
+        id_cond = ""
+        if after_measurement_id is not None:
+            id_cond = f"AND measurement_id > {min(after_measurement_id.get(s, 0) for s in batch)}"
+
+        for window, ttl in windows:
+            sql = f"""
+            SELECT {columns}
+            FROM tblMeasurement
+            WHERE sensor_id IN ({id_list})
+            {id_cond}
+            {window}
+            ORDER BY sensor_id ASC, date ASC, time ASC;
+            """
+            # rows newer than a watermark are by definition not in the cache
+            df = query(sql, dtypes=dtypes, ttl=query_cache.NO_CACHE if id_cond else ttl)
+            if not df.empty:
+                parts.append(df)
+
+    logger.debug(f"GetTimeSeriesBulk: {len(sensor_ids)} sensors, {len(parts)} non-empty result sets")
+
+    if not parts:
+        return {}
+
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+
+    if after_measurement_id is not None:
+        watermark = df['sensor_id'].map(after_measurement_id).fillna(0)
+        df = df[df['measurement_id'] > watermark]
+    if not keep_measurement_id and 'measurement_id' in df.columns:
+        df = df.drop(columns='measurement_id')
+
+    # split per sensor; groupby keeps the (chronological) row order within each group
+    return {int(sensor_id): group.drop(columns='sensor_id').set_index('timestamp')
+            for sensor_id, group in df.groupby('sensor_id', sort=False)}
+
+
 def GetSensorIdsOfType(sensor_type: str) -> pd.DataFrame:
     """ Returns a list of all sensor_id's of the specified type. """
 
@@ -229,8 +614,12 @@ def GetDevices(room_id: str) -> pd.DataFrame:
 
 # executed when run as script (aka as unit test)
 if __name__ == "__main__":
+    import json
+
+    config.init()
+    instrumentation.enable()
     logger.info("executing DB_tools.py as script...");
-    tic = pendulum.now();
+    tic = time.perf_counter()
 
     # get list of rooms
     types = GetSensorTypes()
@@ -249,7 +638,10 @@ if __name__ == "__main__":
     # ts = GetTimeSeries(sensorId, limit=100)
     # print(ts.head)
 
-    toc = pendulum.now() - tic
-    print(f"Wall time: {toc.minutes:02}:{toc.seconds:02}+{toc.microseconds / 1000:03}")
+    instrumentation.observe('script_seconds', time.perf_counter() - tic)
+    print(json.dumps(instrumentation.report(), indent=2))
+    print(f"Query cache: {query_cache.stats()}")
+
+    dispose_engines()
 
 
@@ -0,0 +1,173 @@
+# Alignment of per-sensor time series into a wide frame with one column per sensor.
+#
+# The per-sensor series are sorted by time, so they can be merged like the runs of a merge sort
+# (k-way merge): the merge only ever needs the head of every series, and rows are emitted as soon
+# as no series can still contribute to them. Each series may be given as an iterator of chunks, e.g.
+# from DB_tools.GetTimeSeriesChunks(), so neither the inputs nor the sparse intermediate (the stacked
+# rows of all sensors) have to be in memory at once.
+
+import logging
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, Iterator, Union
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# rows per chunk when an in-memory series is fed into the merge
+CHUNK_SIZE = 100_000
+
+SeriesLike = Union[pd.Series, pd.DataFrame]
+
+
+def _as_chunks(obj: Union[SeriesLike, Iterable[SeriesLike]], chunk_size: int) -> Iterator[pd.Series]:
+    """ Yields the input as chunks of a series. Dataframes contribute their 'value' column, or their
+        only column.
+    """
+
+    if isinstance(obj, (pd.Series, pd.DataFrame)):
+        series = obj
+        obj = (series.iloc[i:i + chunk_size] for i in range(0, len(series), chunk_size))
+
+    for chunk in obj:
+        if isinstance(chunk, pd.DataFrame):
+            chunk = chunk['value'] if 'value' in chunk.columns else chunk.iloc[:, 0]
+        yield chunk
+
+
+def _snap(ts: np.ndarray, freq: np.int64) -> np.ndarray:
+    """ Floors the int64 timestamps onto the grid with spacing `freq`. """
+
+    return ts - ts % freq
+
+
+def iter_aligned(streams: Dict[str, Union[SeriesLike, Iterable[SeriesLike]]], tolerance: str = None,
+                 freq: str = None, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """ Merges sorted per-sensor series into wide chunks with one column per sensor (k-way merge).
+
+    Args:
+    streams (dict): column name -> time series sorted by its DatetimeIndex, either a series/dataframe
+        or an iterable of chunks of it.
+    tolerance (str): optional pandas offset, e.g. '5s'. Consecutive timestamps less than this apart
+        are merged into one row, labelled with the first timestamp.
+    freq (str): optional pandas offset, e.g. '1min'. Timestamps are floored onto this grid.
+    chunk_size (int): rows per chunk in which in-memory series are fed into the merge.
+
+    Values of a sensor that fall into the same row are averaged. The chunks have a unique, sorted
+    'timestamp' index and can simply be concatenated.
+    """
+
+    names = list(streams)
+    iterators = {name: _as_chunks(streams[name], chunk_size) for name in names}
+    tol = pd.Timedelta(tolerance).value if tolerance is not None else None
+    grid = np.int64(pd.Timedelta(freq).value) if freq is not None else None
+
+    # buffered head of each series as int64 timestamps and float values
+    ts_buf = {name: np.empty(0, dtype=np.int64) for name in names}
+    val_buf = {name: np.empty(0, dtype=np.float64) for name in names}
+    exhausted = {name: False for name in names}
+    dtype = None
+
+    to_refill = list(names)
+    while True:
+        # pull the next chunk of every series that has no buffered rows or constrains the merge
+        for name in to_refill:
+            for chunk in iterators[name]:
+                if len(chunk):
+                    break
+            else:
+                exhausted[name] = True
+                continue
+
+            dtype = chunk.dtype if dtype is None else np.promote_types(dtype, chunk.dtype)
+            ts = chunk.index.values.astype('datetime64[ns]').view(np.int64)
+            ts_buf[name] = np.concatenate([ts_buf[name], ts])
+            val_buf[name] = np.concatenate([val_buf[name], chunk.to_numpy(dtype=np.float64)])
+
+        # rows before the frontier can no longer receive values from any series
+        active = [name for name in names if not exhausted[name]]
+        frontier = min(ts_buf[name][-1] for name in active) if active else None
+
+        if frontier is None:
+            cut = None
+        elif grid is not None:
+            cut = _snap(np.int64(frontier), grid)
+        else:
+            cut = frontier
+
+        taken = {}
+        for name in names:
+            n = len(ts_buf[name]) if cut is None else np.searchsorted(ts_buf[name], cut, side='left')
+            taken[name] = (ts_buf[name][:n], val_buf[name][:n])
+
+        if tol is not None and cut is not None:
+            # hold back the last cluster; timestamps after the frontier might still join it
+            union = np.unique(np.concatenate([_snap(ts, grid) if grid is not None else ts
+                                              for ts, _ in taken.values()]))
+            if len(union):
+                starts = np.flatnonzero(np.diff(union, prepend=union[0] - tol - 1) > tol)
+                cut = union[starts[-1]]
+                for name in names:
+                    n = np.searchsorted(taken[name][0], cut, side='left')
+                    taken[name] = (taken[name][0][:n], taken[name][1][:n])
+
+        for name in names:
+            n = len(taken[name][0])
+            ts_buf[name] = ts_buf[name][n:]
+            val_buf[name] = val_buf[name][n:]
+
+        block = _merge_block(names, taken, tol, grid, dtype)
+        if block is not None:
+            yield block
+
+        if not active:
+            break
+
+        to_refill = [name for name in active if len(ts_buf[name]) == 0 or ts_buf[name][-1] == frontier]
+
+
+def _merge_block(names, taken, tol, grid, dtype) -> pd.DataFrame:
+    """ Builds the wide frame of one block of the merge, or None if the block has no rows. """
+
+    ts_all = [_snap(ts, grid) if grid is not None else ts for ts, _ in taken.values()]
+    union = np.unique(np.concatenate(ts_all)) if ts_all else np.empty(0, dtype=np.int64)
+    if len(union) == 0:
+        return None
+
+    # row of each distinct timestamp; with a tolerance, clusters of close timestamps share a row
+    if tol is not None:
+        row_of = np.cumsum(np.diff(union, prepend=union[0] - tol - 1) > tol) - 1
+        row_ts = union[np.flatnonzero(np.diff(row_of, prepend=-1))]
+    else:
+        row_of = np.arange(len(union))
+        row_ts = union
+
+    n_rows, n_cols = len(row_ts), len(names)
+    flat_idx, flat_val = [], []
+    for col, (ts, (_, values)) in enumerate(zip(ts_all, taken.values())):
+        valid = ~np.isnan(values)
+        rows = row_of[np.searchsorted(union, ts[valid])]
+        flat_idx.append(rows * n_cols + col)
+        flat_val.append(values[valid])
+    flat_idx = np.concatenate(flat_idx)
+    flat_val = np.concatenate(flat_val)
+
+    # mean of the values per cell; cells without values stay NaN
+    sums = np.bincount(flat_idx, weights=flat_val, minlength=n_rows * n_cols)
+    counts = np.bincount(flat_idx, minlength=n_rows * n_cols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wide = (sums / counts).reshape(n_rows, n_cols)
+
+    index = pd.DatetimeIndex(row_ts.view('datetime64[ns]'), name='timestamp')
+    return pd.DataFrame(wide.astype(dtype or np.float64, copy=False), index=index, columns=names)
+
+
+def align_streams(streams: Dict[str, Union[SeriesLike, Iterable[SeriesLike]]], tolerance: str = None,
+                  freq: str = None, chunk_size: int = CHUNK_SIZE) -> pd.DataFrame:
+    """ Aligns the per-sensor series into a single wide frame, see iter_aligned(). """
+
+    chunks = list(iter_aligned(streams, tolerance=tolerance, freq=freq, chunk_size=chunk_size))
+    if not chunks:
+        return pd.DataFrame(columns=list(streams), index=pd.DatetimeIndex([], name='timestamp'), dtype=float)
+
+    return pd.concat(chunks) if len(chunks) > 1 else chunks[0]
@@ -0,0 +1,120 @@
+# Local sqlite3 mirror of the sensor DB, used as DBType 0 (see config.py).
+#
+# sync() copies the metadata tables (tblSensor, tblSensorType, tblRoom, tblDevice) and the new rows of
+# tblMeasurement from the DB server (`config.MirrorSourceDBType`) into `config.SQLiteDBFile`. The
+# measurements are append-only and have an auto-increment measurement_id, so a refresh only fetches
+# the rows with a measurement_id above the largest one in the mirror. tblMeasurement is indexed on
+# (sensor_id, date, time), which is how all DB_tools queries access it.
+#
+# With `config.DBType = 0`, all DB_tools getters run unchanged against the mirror; this also serves
+# as a stand-in for the DB server when working offline.
+
+import time
+import decimal
+import datetime
+import logging
+import pandas as pd
+from pathlib import Path
+
+from src import config
+from src.data import DB_tools as dbt
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# tables that are copied as a whole on every sync
+METADATA_TABLES = ['tblSensorType', 'tblSensor', 'tblRoom', 'tblDevice']
+
+# rows per insert transaction when copying tblMeasurement
+CHUNK_SIZE = 50_000
+
+_MEASUREMENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tblMeasurement (
+    measurement_id INTEGER PRIMARY KEY,
+    sensor_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    value REAL
+);
+"""
+
+_MEASUREMENT_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_measurement_sensor_date_time ON tblMeasurement (sensor_id, date, time);
+"""
+
+
+def _sqlite_value(value):
+    """ Converts the values returned by the MySQL drivers to the text formats stored in sqlite. """
+
+    if isinstance(value, datetime.timedelta):
+        # MySQL TIME columns are returned as timedelta
+        seconds = int(value.total_seconds())
+        text = f"{seconds // 3600:02}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+        return text + f".{value.microseconds:06}" if value.microseconds else text
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def sync(source_db_type: int = None, db_file: Path = None, chunk_size: int = CHUNK_SIZE) -> dict:
+    """ Creates or refreshes the local mirror of the DB and returns the number of copied rows per table.
+        Only the measurements inserted since the last sync are copied.
+    """
+
+    source_db_type = source_db_type if source_db_type is not None else config.MirrorSourceDBType
+    db_file = Path(db_file) if db_file is not None else Path(config.SQLiteDBFile)
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"syncing DBType {source_db_type} into {db_file}")
+    tic = time.perf_counter()
+    copied = {}
+
+    conn = dbt.connect_sqlite(db_file)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL;")
+
+        with dbt._get_engine(source_db_type).connect() as src:
+            # the metadata tables are small; replace them as a whole
+            for table in METADATA_TABLES:
+                df = pd.read_sql_query(f"SELECT * FROM {table};", src)
+                df.to_sql(table, conn, if_exists='replace', index=False)
+                copied[table] = len(df)
+
+            conn.execute(_MEASUREMENT_SCHEMA)
+            last_id = conn.execute("SELECT COALESCE(MAX(measurement_id), 0) FROM tblMeasurement;").fetchone()[0]
+
+            # stream the new measurements with a server-side cursor; each chunk is committed, so an
+            # interrupted sync continues where it stopped
+            result = src.execution_options(stream_results=True).exec_driver_sql(f"""
+                SELECT measurement_id, sensor_id, date, time, value
+                FROM tblMeasurement
+                WHERE measurement_id > {last_id}
+                ORDER BY measurement_id ASC;
+                """)
+
+            copied['tblMeasurement'] = 0
+            while rows := result.fetchmany(chunk_size):
+                conn.executemany("INSERT OR REPLACE INTO tblMeasurement VALUES (?, ?, ?, ?, ?);",
+                                 [tuple(_sqlite_value(v) for v in row) for row in rows])
+                conn.commit()
+                copied['tblMeasurement'] += len(rows)
+                logger.debug(f"sync: copied {copied['tblMeasurement']} measurements")
+
+        # creating the index after the initial load is faster than maintaining it during the load
+        conn.execute(_MEASUREMENT_INDEX)
+        conn.commit()
+    finally:
+        conn.close()
+
+    logger.info(f"sync done in {time.perf_counter() - tic:.1f} s: {copied}")
+    return copied
+
+
+if __name__ == "__main__":
+    config.init()
+
+    # create or refresh the mirror
+    sync()
+    dbt.dispose_engines()
@@ -0,0 +1,144 @@
+# Concurrent download of sensor time series from the DB.
+#
+# The sensors are fetched in batches (see DB_tools.GetTimeSeriesBulk) on a thread pool, so several
+# queries are in flight at once instead of the DB server and the network waiting for one query at a
+# time. Transient errors (lost connections, timeouts) are retried with exponential backoff. A batch
+# that still fails is split into single sensors, so one bad sensor cannot abort the whole run.
+
+import time
+import sqlite3
+import logging
+import sys
+import threading
+import pandas as pd
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List
+
+from src import config
+from src.data import DB_tools as dbt
+
+# get logger
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DownloadJob:
+    """ Sensors of one sensor type and the keyword arguments for DB_tools.GetTimeSeriesBulk(). """
+
+    sensor_type: str
+    sensor_ids: List[int]
+    kwargs: dict = field(default_factory=dict)
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """ True for errors that are worth retrying: lost connections, timeouts, locked databases. """
+
+    # sqlalchemy is only loaded if a server connection was made (see DB_tools._get_engine)
+    sqlalchemy = sys.modules.get('sqlalchemy')
+    if sqlalchemy is not None and isinstance(exc, sqlalchemy.exc.DBAPIError):
+        return exc.connection_invalidated or isinstance(exc, sqlalchemy.exc.OperationalError)
+    return isinstance(exc, (ConnectionError, TimeoutError, sqlite3.OperationalError))
+
+
+class Downloader:
+    """ Runs download jobs on a thread pool with at most `max_workers` queries in flight (default
+        `config.DownloadMaxWorkers`). Failed queries are retried `retries` times with a backoff of
+        `backoff * 2**attempt` seconds (defaults `config.DownloadRetries`, `config.DownloadBackoff`).
+
+        After run(), `failed` maps the sensor_id of every sensor that could not be downloaded to the
+        error message.
+    """
+
+    def __init__(self, max_workers: int = None, retries: int = None, backoff: float = None):
+        self.max_workers = max_workers if max_workers is not None else config.DownloadMaxWorkers
+        self.retries = retries if retries is not None else config.DownloadRetries
+        self.backoff = backoff if backoff is not None else config.DownloadBackoff
+        self.failed: Dict[int, str] = {}
+
+        self._lock = threading.Lock()
+        self._rows = 0
+        self._bytes = 0
+
+    def _fetch(self, sensor_ids: List[int], kwargs: dict) -> Dict[int, pd.DataFrame]:
+        """ Fetches one batch of sensors; retries transient errors with exponential backoff. """
+
+        for attempt in range(self.retries + 1):
+            try:
+                series = dbt.GetTimeSeriesBulk(sensor_ids, batch_size=len(sensor_ids), **kwargs)
+                break
+            except Exception as e:
+                if attempt == self.retries or not _is_transient(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"query for sensors {sensor_ids} failed ({e}); retrying in {delay:.1f} s")
+                time.sleep(delay)
+
+        with self._lock:
+            for df in series.values():
+                self._rows += len(df)
+                self._bytes += int(df.memory_usage(index=True).sum())
+
+        return series
+
+    def run(self, jobs: List[DownloadJob]) -> Dict[str, Dict[int, pd.DataFrame]]:
+        """ Downloads all jobs and returns sensor_type -> sensor_id -> time series. Sensors that fail
+            are logged and listed in `failed`; the other sensors are still downloaded.
+        """
+
+        self.failed = {}
+        self._rows = self._bytes = 0
+        results = {job.sensor_type: {} for job in jobs}
+
+        # split the jobs into batches, one query each (or one per date window)
+        batch_size = config.BulkSensorBatchSize
+        batches = [(job, job.sensor_ids[i:i + batch_size])
+                   for job in jobs for i in range(0, len(job.sensor_ids), batch_size)]
+        n_batches = len(batches)
+
+        tic = time.perf_counter()
+        last_report = tic
+        done = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='download') as pool:
+            pending = {pool.submit(self._fetch, ids, job.kwargs): (job, ids) for job, ids in batches}
+
+            while pending:
+                finished, _ = wait(pending, timeout=config.DownloadProgressSeconds, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    job, ids = pending.pop(future)
+                    try:
+                        results[job.sensor_type].update(future.result())
+                        done += 1
+                    except Exception as e:
+                        if len(ids) > 1:
+                            # isolate the failing sensor(s): retry the batch sensor by sensor
+                            logger.warning(f"batch of {len(ids)} {job.sensor_type} sensors failed ({e}); "
+                                           f"retrying them one by one")
+                            n_batches += len(ids) - 1
+                            for sensor_id in ids:
+                                pending[pool.submit(self._fetch, [sensor_id], job.kwargs)] = (job, [sensor_id])
+                        else:
+                            logger.error(f"download of {job.sensor_type} sensor {ids[0]} failed: {e}")
+                            self.failed[ids[0]] = str(e)
+                            done += 1
+
+                now = time.perf_counter()
+                if now - last_report >= config.DownloadProgressSeconds or not pending:
+                    self._report(done, n_batches, now - tic)
+                    last_report = now
+
+        if self.failed:
+            logger.warning(f"{len(self.failed)} sensors could not be downloaded: {sorted(self.failed)}")
+
+        return results
+
+    def _report(self, done: int, total: int, seconds: float):
+        """ Logs the aggregate progress of the download. """
+
+        with self._lock:
+            rows, nbytes = self._rows, self._bytes
+        seconds = max(seconds, 1e-9)
+        logger.info(f"download: {done}/{total} batches, {rows} rows, {nbytes / 2**20:.1f} MB, "
+                    f"{rows / seconds:.0f} rows/s, {nbytes / 2**20 / seconds:.2f} MB/s")
@@ -1,76 +1,193 @@
 # Module to download the raw data from the DB and process it for further analysis.
 
+import time
 import logging
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # import config logger initialization
 from src import config
+from src import instrumentation
 import os
 from src.data import DB_tools as dbt
+from src.data import raw_store
+from src.data import align
+from src.data import downloader
+from src.data import resample
+from src.data import rollups
 from pathlib import Path
 
 # get Logger
 logger = logging.getLogger(__name__)
 
-def download_data(start_date="2024-01-01"):
+def download_data(start_date="2024-01-01", incremental: bool = False, output_dir: Path = None):
     """ Downloads the data from the DB and saves it in the `config.data_raw_dir`. The saved dataframes 
         contain a single timestamp column (index) and one column for each sensor. If a 
         sensor has no value for a timestamp, the value is NaN (outer merge). 
         The data that is downloaded is defined by `config.sensor_types`. The
         DB connection parameters are defined in `.env`.
+
+        With `incremental=True` only measurements newer than the watermark of each sensor (the last
+        measurement_id already stored, see `raw_store`) are downloaded and appended as new parquet
+        files to the partitions. Sensors without a watermark, e.g. sensors added since the last run, are downloaded
+        from `start_date` on. The returned dataframes then only contain the new rows.
     """
-    logger.info(f"Starting data download process with start date: {start_date}")
-    base_dir = Path.cwd()  # Adjust this if your script is in a different directory structure
-    output_dir = base_dir / 'data' / 'raw'
+    logger.info(f"Starting data download process with start date: {start_date} (incremental={incremental})")
+    output_dir = Path(output_dir) if output_dir is not None else config.data_raw_dir
     output_dir.mkdir(parents=True, exist_ok=True)
     logger.debug(f"Ensured existence of directory: {output_dir}")
 
+    watermarks = raw_store.load_watermarks(output_dir)
+
     sensor_types = dbt.GetSensorTypes()
     sensor_data_dfs = {}  # Dictionary to store dataframes for each sensor type
 
+    # collect the sensors of all types first, so the downloads of all types can run concurrently
+    plan = {}  # sensor_type -> (sensor_ids, append, type_watermarks)
+    jobs = []
     for sensor_type in sensor_types['type_name']:
-        logger.info(f"Processing {sensor_type} sensors")
         sensor_ids = dbt.GetSensorIdsOfType(sensor_type)
 
-        all_sensor_data = []
+        # an incremental download needs the full download it is appended to
+        type_watermarks = watermarks.get(sensor_type, {})
+        append = incremental and raw_store.has_type(output_dir, sensor_type)
+        if not append:
+            type_watermarks = {}
+        plan[sensor_type] = (sensor_ids, append, type_watermarks)
+
+        # fetch the sensors with a few bulk queries instead of one query per sensor;
+        # sensors with a watermark only fetch the rows inserted after it
+        known = {int(s): type_watermarks[str(s)]['measurement_id'] for s in sensor_ids['sensor_id']
+                 if str(s) in type_watermarks}
+        new = [int(s) for s in sensor_ids['sensor_id'] if int(s) not in known]
+        if known:
+            jobs.append(downloader.DownloadJob(sensor_type, list(known),
+                                               dict(after_measurement_id=known, keep_measurement_id=True)))
+        if new:
+            jobs.append(downloader.DownloadJob(sensor_type, new,
+                                               dict(start_date=start_date, keep_measurement_id=True)))
+
+    # run the queries concurrently; sensors that fail are skipped and keep their old watermark
+    download = downloader.Downloader()
+    series_of_type = download.run(jobs)
+
+    for sensor_type, (sensor_ids, append, type_watermarks) in plan.items():
+        logger.info(f"Processing {sensor_type} sensors")
+        sensor_series = series_of_type.get(sensor_type, {})
+
+        all_sensor_data = {}  # column name -> time series of the sensor
 
         for sensor_id in sensor_ids['sensor_id']:
-            sensor_data = dbt.GetTimeSeries(sensor_id, start_date=start_date)
-            if sensor_data.empty:
-                logger.warning(f"No data found for sensor ID {sensor_id}")
+            sensor_data = sensor_series.get(int(sensor_id))
+            if sensor_data is None:
+                if not append and int(sensor_id) not in download.failed:
+                    logger.warning(f"No data found for sensor ID {sensor_id}")
                 continue
 
-            sensor_data.set_index('timestamp', inplace=True)
-            sensor_data.rename(columns={'value': f'sensor_{sensor_id}'}, inplace=True)
-            all_sensor_data.append(sensor_data)
+            # advance the watermark of the sensor; late-arriving rows must not move the timestamp back
+            previous = type_watermarks.get(str(sensor_id), {}).get('timestamp', '')
+            type_watermarks[str(sensor_id)] = {'measurement_id': int(sensor_data['measurement_id'].max()),
+                                               'timestamp': max(previous, str(sensor_data.index.max()))}
+
+            all_sensor_data[f'sensor_{sensor_id}'] = sensor_data['value']
 
         if all_sensor_data:
-            combined_data = pd.concat(all_sensor_data)
-            file_path = output_dir / f'{sensor_type}_data.parquet'
-            combined_data.to_parquet(file_path)
-            logger.info(f"Saved combined data for {sensor_type} to {file_path}")
+            # one row per timestamp and one column per sensor (outer merge of the sorted series)
+            combined_data = align.align_streams(all_sensor_data)
+            file_path = raw_store.write_type(combined_data, output_dir, sensor_type, append=append)
+            if append:
+                logger.info(f"Appended {len(combined_data)} new rows for {sensor_type} to {file_path}")
+            else:
+                logger.info(f"Saved combined data for {sensor_type} to {file_path}")
             sensor_data_dfs[sensor_type] = combined_data
+
+            # save the watermarks only after the data is written
+            watermarks[sensor_type] = type_watermarks
+            raw_store.save_watermarks(output_dir, watermarks)
+
+            # aggregate the new raw files into the rollups
+            if config.RollupsEnabled:
+                rollups.update(output_dir, sensor_type, rollup_dir=rollups.rollup_dir_for(output_dir))
         else:
             sensor_data_dfs[sensor_type] = pd.DataFrame()  # Store an empty DataFrame if no data
-            logger.warning(f"No valid data collected for {sensor_type}; creating an empty DataFrame")
+            if append:
+                logger.info(f"No new data for {sensor_type}")
+            else:
+                logger.warning(f"No valid data collected for {sensor_type}; creating an empty DataFrame")
 
-    logger.info(f"Saved all sensor data to {file_path}")
+    logger.info(f"Saved all sensor data to {output_dir}")
 
     return sensor_data_dfs
 
-def resample_data():
-    raise NotImplementedError("Not implemented yet")
+def resample_data(rate: str = None, sensor_types=None, raw_dir: Path = None, output_dir: Path = None,
+                  max_gap: str = None):
+    """ Resamples the raw data of each sensor type to bins of width `rate` (default `config.ResampleRate`)
+        and saves it as `<output_dir>/<sensor_type>_resampled.parquet` (default `config.data_processed_dir`),
+        with a timestamp index and one column per sensor. A bin is the time-weighted mean of the linear
+        interpolation between the samples, see `resample`.
+
+        The raw data is streamed month by month and the resampled rows are appended to the parquet file
+        as they are complete, so the memory does not grow with the date range. Gaps longer than `max_gap`
+        (default `config.ResampleMaxGap`) hold the last value instead of being interpolated.
+    """
+    rate = rate if rate is not None else config.ResampleRate
+    max_gap = max_gap if max_gap is not None else config.ResampleMaxGap
+    raw_dir = Path(raw_dir) if raw_dir is not None else config.data_raw_dir
+    output_dir = Path(output_dir) if output_dir is not None else config.data_processed_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+    sensor_types = sensor_types if sensor_types is not None else raw_store.stored_types(raw_dir)
+
+    logger.info(f"Resampling {sensor_types} to {rate} (max gap {max_gap})")
+    output_files = {}
+    for sensor_type in sensor_types:
+        if not raw_store.has_type(raw_dir, sensor_type):
+            logger.warning(f"No raw data for {sensor_type}")
+            continue
+
+        columns = raw_store.stored_columns(raw_dir, sensor_type)
+        chunks = raw_store.iter_type(raw_dir, sensor_type, columns)
+
+        # write into a temporary file, so an interrupted run does not leave a truncated output
+        file_path = output_dir / f'{sensor_type}_resampled.parquet'
+        tmp_path = file_path.with_name(file_path.name + '.tmp')
+        writer = None
+        rows, write_s = 0, 0.0
+        with instrumentation.timer('resample_seconds', sensor_type=sensor_type):
+            try:
+                for df in resample.iter_resampled(chunks, rate, max_gap=max_gap, columns=columns):
+                    tic = time.perf_counter()
+                    table = pa.Table.from_pandas(df)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp_path, table.schema)
+                    writer.write_table(table, row_group_size=config.RawRowGroupSize)
+                    write_s += time.perf_counter() - tic
+                    rows += len(df)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+        if writer is None:
+            logger.warning(f"No data to resample for {sensor_type}")
+            continue
+        os.replace(tmp_path, file_path)
+        instrumentation.file_written('resampled', rows, write_s, file_path)
+        output_files[sensor_type] = file_path
+        logger.info(f"Saved {rows} resampled rows for {sensor_type} to {file_path}")
+
+    return output_files
 
 
 
 if __name__ == '__main__':
     # execute only if run as the entry point into the program
+    config.init()
 
     # download data from DB server
     download_data()
 
     # resample data
-    #resample_data()
+    resample_data()
 
 
 
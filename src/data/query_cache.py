@@ -0,0 +1,217 @@
+# Local, content-addressed cache of query results (see DB_tools.query).
+#
+# A result is stored as a parquet file named by the hash of the normalized SQL, the query arguments,
+# the requested dtypes and the DB (sqlite file or server URL, see DB_tools.db_identity). Each entry
+# expires after the TTL of its query class:
+#
+# - metadata (sensors, types, rooms, devices) may change and expires after `config.QueryCacheTTLMetadata`
+# - measurements of a closed date range in the past rarely change and expire after
+#   `config.QueryCacheTTLClosed` (rows can still arrive late with an older date)
+# - measurements of an open range (up to today) expire after `config.QueryCacheTTLRecent`
+#
+# Empty results expire after `config.QueryCacheTTLRecent` at most, so a DB that is filled or synced
+# later is not hidden behind them.
+#
+# When the cache grows beyond `config.QueryCacheMaxBytes`, the least recently used entries are
+# evicted; the modification time of an entry is updated on every hit and serves as its LRU time.
+#
+# pyarrow is only imported on the first get() or put(), to keep `import DB_tools` fast.
+
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import pandas as pd
+from pathlib import Path
+from typing import Dict
+
+from src import config
+from src import instrumentation
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# TTL of results that never expire, and of results that are not cached at all
+FOREVER = float('inf')
+NO_CACHE = 0
+
+# parquet metadata key of the expiry time (seconds since the epoch)
+_EXPIRES_KEY = b'query_cache.expires'
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'puts': 0, 'evictions': 0}
+_total_bytes = None  # size of the cache directory, scanned on first use
+
+
+def _normalize(sql_query: str) -> str:
+    """ Normalizes whitespace and the trailing semicolon, so formatting does not change the key. """
+
+    return re.sub(r'\s+', ' ', sql_query).strip().rstrip(';').strip()
+
+
+def _key(sql_query: str, query_args=None, dtypes: Dict[str, str] = None, db: str = None) -> str:
+    """ Content address of a query on the DB `db` (default the DBType). """
+
+    db = db if db is not None else str(config.DBType)
+    text = repr((db, _normalize(sql_query), list(query_args or []), sorted((dtypes or {}).items())))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _path(key: str) -> Path:
+    return Path(config.QueryCacheDir) / key[:2] / f'{key}.parquet'
+
+
+def default_ttl(sql_query: str) -> float:
+    """ TTL of a query that did not specify one: measurements are treated as an open range. """
+
+    if re.search(r'\btblMeasurement\b', sql_query, re.IGNORECASE):
+        return config.QueryCacheTTLRecent
+    return config.QueryCacheTTLMetadata
+
+
+def range_ttl(end_date=None) -> float:
+    """ TTL of a measurement query with the (exclusive) upper date `end_date`: ranges that end before
+        today are closed and cached for `config.QueryCacheTTLClosed`.
+    """
+
+    if end_date is not None and pd.Timestamp(end_date) <= pd.Timestamp.today().normalize():
+        return config.QueryCacheTTLClosed
+    return config.QueryCacheTTLRecent
+
+
+def get(sql_query: str, query_args=None, dtypes: Dict[str, str] = None, db: str = None) -> pd.DataFrame:
+    """ Returns the cached result of the query on the DB `db`, or None if it is not cached or expired. """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = _path(_key(sql_query, query_args, dtypes, db))
+    try:
+        table = pq.read_table(path)
+    except (FileNotFoundError, OSError, pa.ArrowInvalid):
+        with _lock:
+            _stats['misses'] += 1
+        return None
+
+    expires = float((table.schema.metadata or {}).get(_EXPIRES_KEY, b'0'))
+    if expires < time.time():
+        _remove(path)
+        with _lock:
+            _stats['misses'] += 1
+        return None
+
+    # mark the entry as recently used
+    os.utime(path)
+    with _lock:
+        _stats['hits'] += 1
+
+    return table.to_pandas()
+
+
+def put(sql_query: str, query_args, dtypes: Dict[str, str], df: pd.DataFrame, ttl: float, db: str = None):
+    """ Stores the result of the query on the DB `db` with the given TTL in seconds; empty results
+        are kept for `config.QueryCacheTTLRecent` at most.
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    global _total_bytes
+
+    if df.empty:
+        ttl = min(ttl, config.QueryCacheTTLRecent)
+
+    path = _path(_key(sql_query, query_args, dtypes, db))
+    try:
+        table = pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as e:
+        # e.g. columns of mixed python objects; such results are simply not cached
+        logger.debug(f"query_cache: result not cacheable ({e})")
+        return
+
+    expires = time.time() + ttl if ttl != FOREVER else FOREVER
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), _EXPIRES_KEY: str(expires).encode()})
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+    tic = time.perf_counter()
+    pq.write_table(table, tmp)
+    instrumentation.file_written('query_cache', len(df), time.perf_counter() - tic, tmp)
+
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = _scan()[1]
+        if path.exists():
+            _total_bytes -= path.stat().st_size
+        os.replace(tmp, path)
+        _total_bytes += path.stat().st_size
+        _stats['puts'] += 1
+
+        if _total_bytes > config.QueryCacheMaxBytes:
+            _evict()
+
+
+def _scan():
+    """ Returns the cache entries as (mtime, size, path), and their total size. """
+
+    entries = []
+    root = Path(config.QueryCacheDir)
+    if root.exists():
+        for path in root.glob('*/*.parquet'):
+            st = path.stat()
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries, sum(size for _, size, _ in entries)
+
+
+def _evict():
+    """ Removes the least recently used entries until the cache is below its size limit; `_lock` must be held. """
+
+    global _total_bytes
+
+    entries, _total_bytes = _scan()
+    for _, size, path in sorted(entries):
+        if _total_bytes <= config.QueryCacheMaxBytes:
+            break
+        path.unlink(missing_ok=True)
+        _total_bytes -= size
+        _stats['evictions'] += 1
+
+
+def _remove(path: Path):
+    """ Removes an expired entry. """
+
+    global _total_bytes
+
+    with _lock:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        if _total_bytes is not None:
+            _total_bytes -= size
+
+
+def stats() -> dict:
+    """ Returns the hit/miss counters and the size of the cache in bytes. """
+
+    global _total_bytes
+
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = _scan()[1]
+        return dict(_stats, bytes=_total_bytes)
+
+
+def clear():
+    """ Removes all cache entries and resets the counters. """
+
+    global _total_bytes
+
+    with _lock:
+        for _, _, path in _scan()[0]:
+            path.unlink(missing_ok=True)
+        _total_bytes = 0
+        _stats.update(hits=0, misses=0, puts=0, evictions=0)
@@ -0,0 +1,563 @@
+# Storage of the raw sensor data downloaded from the DB.
+#
+# The raw data is a partitioned parquet dataset (hive layout):
+#
+#   <raw_dir>/sensor_type=<type>/year=<yyyy>/month=<m>/part-<time>-<i>.parquet
+#
+# Each file holds a 'timestamp' column and one column per sensor, sorted by timestamp and split into
+# row groups of `config.RawRowGroupSize` rows. Readers only open the partitions of the requested
+# sensor types and months, and the row group statistics of 'timestamp' skip the rest, so loading one
+# sensor for one week reads about one row group. Incremental downloads add new files to the
+# partitions, and the per-sensor watermarks (last measurement already stored) are kept in
+# `<raw_dir>/_watermarks.json`.
+#
+# With `config.RawStorageFormat = 'long'` the files hold one row per measurement instead:
+#
+#   timestamp   int64      nanoseconds since the epoch (delta encoded)
+#   sensor_id   int32      dictionary encoded, the <id> of the wide column 'sensor_<id>'
+#   value       float32    (the sensors have < 7 significant digits)
+#
+# sorted by sensor_id and timestamp, so a row group holds a run of one sensor and the row group
+# statistics of both columns skip the other sensors and times. The wide frames are mostly NaN (every
+# sensor gets a row at the timestamps of all others), the long files only store the measurements, which
+# cuts their size on disk and in memory by several times. read_long() returns the long frame;
+# read_type() converts to wide only for the requested sensors. A sensor type keeps the format it
+# was written in when data is appended; convert() rewrites it in the other format.
+#
+# Files of the former layout (`<type>_data.parquet` and its `<type>_data/` fragments) can still be read.
+#
+# SensorData gives dict-like, lazy access to all stored sensor types with an LRU cache, and
+# iter_type() streams a sensor type month by month.
+
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterator, List
+
+from src import config
+from src import instrumentation
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# name of the watermark manifest in the raw data directory
+WATERMARK_FILE = '_watermarks.json'
+
+# partitioning of each sensor type below its `sensor_type=<type>` directory
+_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor='hive')
+
+# storage formats, see the module description
+WIDE = 'wide'
+LONG = 'long'
+
+# schema of the files of the long format; the sensor ids are also kept in the footer metadata, so
+# stored_columns() does not need to read the data
+_LONG_SCHEMA = pa.schema([('timestamp', pa.int64()), ('sensor_id', pa.dictionary(pa.int32(), pa.int32())),
+                          ('value', pa.float32())])
+_SENSOR_IDS_KEY = b'sensor_ids'
+
+
+def type_dir(raw_dir: Path, sensor_type: str) -> Path:
+    """ Directory of the partitions of the sensor type. """
+
+    return Path(raw_dir) / f'sensor_type={sensor_type}'
+
+
+def _legacy_path(raw_dir: Path, sensor_type: str) -> Path:
+    """ File of the sensor type in the former, unpartitioned layout. """
+
+    return Path(raw_dir) / f'{sensor_type}_data.parquet'
+
+
+def has_type(raw_dir: Path, sensor_type: str) -> bool:
+    """ True if data of the sensor type is stored in `raw_dir`. """
+
+    return type_dir(raw_dir, sensor_type).is_dir() or _legacy_path(raw_dir, sensor_type).exists()
+
+
+def stored_types(raw_dir: Path) -> List[str]:
+    """ Returns the sensor types stored in `raw_dir`. """
+
+    raw_dir = Path(raw_dir)
+    types = {p.name.split('=', 1)[1] for p in raw_dir.glob('sensor_type=*') if p.is_dir()}
+    types |= {p.stem[:-len('_data')] for p in raw_dir.glob('*_data.parquet')}
+    return sorted(types)
+
+
+def stored_format(raw_dir: Path, sensor_type: str) -> str:
+    """ Format of the stored partitions of the sensor type (WIDE or LONG), None if there are none. """
+
+    in_dir = type_dir(raw_dir, sensor_type)
+    path = next(in_dir.rglob('*.parquet'), None) if in_dir.is_dir() else None
+    if path is None:
+        return None
+    return LONG if 'sensor_id' in pq.read_schema(path).names else WIDE
+
+
+def _sensor_id(column: str) -> int:
+    prefix, _, number = column.partition('_')
+    if prefix != 'sensor' or not number.isdigit():
+        raise ValueError(f"column {column!r} is not of the form 'sensor_<id>' and cannot be stored in the long format")
+    return int(number)
+
+
+def to_long_table(df: pd.DataFrame) -> pa.Table:
+    """ Converts the wide frame (timestamp index, columns 'sensor_<id>') into the long table of the
+        files (see the module description): the NaN values are dropped, the rows sorted by sensor and time.
+    """
+
+    timestamps = df.index.as_unit('ns').asi8
+    ids = sorted(_sensor_id(c) for c in df.columns)
+    time_parts, value_parts, counts = [], [], []
+    for sensor_id in ids:
+        values = df[f'sensor_{sensor_id}'].to_numpy(np.float32, na_value=np.nan)
+        keep = ~np.isnan(values)
+        time_parts.append(timestamps[keep])
+        value_parts.append(values[keep])
+        counts.append(int(keep.sum()))
+
+    codes = np.repeat(np.arange(len(ids), dtype=np.int32), counts)
+    sensor_ids = pa.DictionaryArray.from_arrays(pa.array(codes, pa.int32()), pa.array(ids, pa.int32()))
+    arrays = [pa.array(np.concatenate(time_parts) if ids else np.empty(0, np.int64), pa.int64()), sensor_ids,
+              pa.array(np.concatenate(value_parts) if ids else np.empty(0, np.float32), pa.float32())]
+    schema = _LONG_SCHEMA.with_metadata({_SENSOR_IDS_KEY: json.dumps(ids).encode()})
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _write_options(fmt: str):
+    if fmt == WIDE:
+        return None
+    # delta encoding of the sorted timestamps and byte stream split of the floats compress well with zstd
+    return ds.ParquetFileFormat().make_write_options(
+        compression='zstd', use_dictionary=['sensor_id'],
+        column_encoding={'timestamp': 'DELTA_BINARY_PACKED', 'value': 'BYTE_STREAM_SPLIT'})
+
+
+def write_type(df: pd.DataFrame, raw_dir: Path, sensor_type: str, append: bool = False,
+               storage_format: str = None) -> Path:
+    """ Writes the wide frame of the sensor type (timestamp index, one column per sensor) into the
+        year/month partitions, in `storage_format` (WIDE or LONG, default `config.RawStorageFormat`).
+        Without `append`, the stored data of the sensor type is replaced; appended data is written
+        in the format of the stored data.
+    """
+
+    out_dir = type_dir(raw_dir, sensor_type)
+    stored = stored_format(raw_dir, sensor_type) if append else None
+    fmt = storage_format if storage_format is not None else (stored or config.RawStorageFormat)
+    if fmt not in (WIDE, LONG):
+        raise ValueError(f"unknown raw storage format {fmt!r}; expected {WIDE!r} or {LONG!r}")
+    if stored is not None and fmt != stored:
+        raise ValueError(f"{sensor_type} is stored in the {stored} format; use convert() before appending {fmt} data")
+
+    if not append:
+        if out_dir.exists():
+            shutil.rmtree(out_dir)
+        legacy = _legacy_path(raw_dir, sensor_type)
+        if legacy.exists():
+            legacy.unlink()
+            shutil.rmtree(legacy.with_suffix(''), ignore_errors=True)
+
+    df = df.sort_index()
+    if fmt == LONG:
+        table = to_long_table(df)
+        timestamps = pd.DatetimeIndex(table['timestamp'].to_numpy())
+    else:
+        table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+        timestamps = df.index
+    table = table.append_column('year', pa.array(timestamps.year, pa.int16()))
+    table = table.append_column('month', pa.array(timestamps.month, pa.int8()))
+
+    # unique file names, so appended files never overwrite earlier ones
+    basename = f"part-{pd.Timestamp.now():%Y%m%dT%H%M%S%f}"
+    tic = time.perf_counter()
+    ds.write_dataset(table, out_dir, format='parquet', partitioning=_PARTITIONING,
+                     basename_template=f"{basename}-{{i}}.parquet",
+                     existing_data_behavior='overwrite_or_ignore', file_options=_write_options(fmt),
+                     max_rows_per_group=config.RawRowGroupSize, min_rows_per_group=config.RawRowGroupSize)
+    if instrumentation.enabled():
+        instrumentation.file_written('raw', len(table), time.perf_counter() - tic, *out_dir.rglob(f'{basename}-*.parquet'))
+
+    return out_dir
+
+
+def _month_filter(start: pd.Timestamp = None, end: pd.Timestamp = None) -> ds.Expression:
+    """ Partition filter for the months overlapping [start, end]. """
+
+    expr = None
+    if start is not None:
+        expr = (ds.field('year') > start.year) | ((ds.field('year') == start.year) & (ds.field('month') >= start.month))
+    if end is not None:
+        upper = (ds.field('year') < end.year) | ((ds.field('year') == end.year) & (ds.field('month') <= end.month))
+        expr = upper if expr is None else expr & upper
+    return expr
+
+
+def _read_legacy(file_path: Path, columns: List[str] = None, start: pd.Timestamp = None,
+                 end: pd.Timestamp = None) -> pd.DataFrame:
+    """ Reads a file of the former layout together with its incremental fragments. """
+
+    filters = []
+    if start is not None:
+        filters.append(('timestamp', '>=', start))
+    if end is not None:
+        filters.append(('timestamp', '<=', end))
+
+    frames = []
+    frag_dir = file_path.with_suffix('')
+    paths = [file_path] + (sorted(frag_dir.glob('part-*.parquet')) if frag_dir.is_dir() else [])
+    for path in paths:
+        cols = None if columns is None else [c for c in columns if c in pq.read_schema(path).names]
+        frames.append(pd.read_parquet(path, columns=cols, filters=filters or None, memory_map=True))
+
+    df = pd.concat(frames) if len(frames) > 1 else frames[0]
+    return df.groupby(level=0, sort=True).last() if len(frames) > 1 else df
+
+
+def _unified_schema(in_dir: Path) -> pa.Schema:
+    """ Schema of all files of a sensor type. Files written at different times can hold different
+        sensors, so the schemas of all files are unified (only the file footers are read).
+    """
+
+    dataset = ds.dataset(in_dir, format='parquet', partitioning=_PARTITIONING)
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()])
+    return pa.unify_schemas([schema, _PARTITIONING.schema])
+
+
+def _long_sensor_ids(in_dir: Path) -> List[int]:
+    """ Sensor ids of all files of a sensor type in the long format, from the footer metadata. """
+
+    ids = set()
+    for path in in_dir.rglob('*.parquet'):
+        ids.update(json.loads(pq.read_schema(path).metadata[_SENSOR_IDS_KEY]))
+    return sorted(ids)
+
+
+def stored_columns(raw_dir: Path, sensor_type: str) -> List[str]:
+    """ Returns the sensor columns stored for the sensor type, without reading any data. """
+
+    in_dir = type_dir(raw_dir, sensor_type)
+    if stored_format(raw_dir, sensor_type) == LONG:
+        return [f'sensor_{sensor_id}' for sensor_id in _long_sensor_ids(in_dir)]
+    if in_dir.is_dir():
+        names = _unified_schema(in_dir).names
+    else:
+        names = pq.read_schema(_legacy_path(raw_dir, sensor_type)).names
+    return [name for name in names if name not in ('timestamp', 'year', 'month', '__index_level_0__')]
+
+
+def read_type(raw_dir: Path, sensor_type: str, sensors: List[str] = None, start=None, end=None,
+              memory_map: bool = True) -> pd.DataFrame:
+    """ Reads the wide frame of the sensor type. Only the columns in `sensors` (all if None) and the
+        rows with `start <= timestamp <= end` are read; the filters are pushed down to the partitions
+        and the row group statistics.
+    """
+
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    in_dir = type_dir(raw_dir, sensor_type)
+    if not in_dir.is_dir():
+        return _read_legacy(_legacy_path(raw_dir, sensor_type), sensors, start, end)
+    if stored_format(raw_dir, sensor_type) == LONG:
+        # like the wide format: every stored sensor that was requested is a column, even without rows in the range
+        stored = stored_columns(raw_dir, sensor_type)
+        columns = stored if sensors is None else [name for name in sensors if name in stored]
+        return to_wide(_read_long(in_dir, sensors, start, end, memory_map), columns)
+
+    # memory-mapped files are decoded straight from the page cache instead of being read into buffers
+    filesystem = fs.LocalFileSystem(use_mmap=memory_map)
+    dataset = ds.dataset(in_dir, format='parquet', partitioning=_PARTITIONING, filesystem=filesystem,
+                         schema=_unified_schema(in_dir))
+    schema = dataset.schema
+
+    value_columns = [name for name in schema.names if name not in ('timestamp', 'year', 'month')]
+    if sensors is not None:
+        value_columns = [name for name in sensors if name in schema.names]
+
+    expr = _month_filter(start, end)
+    if start is not None:
+        expr = expr & (ds.field('timestamp') >= pa.scalar(start.to_datetime64()))
+    if end is not None:
+        expr = expr & (ds.field('timestamp') <= pa.scalar(end.to_datetime64()))
+
+    table = dataset.to_table(columns=['timestamp'] + value_columns, filter=expr)
+    # release the arrow buffers while converting, so the data is not held twice
+    df = table.to_pandas(split_blocks=True, self_destruct=True).set_index('timestamp')
+    del table
+
+    # files of incremental downloads overlap in time; combine rows of the same timestamp
+    if not df.index.is_monotonic_increasing or not df.index.is_unique:
+        df = df.groupby(level=0, sort=True).last()
+
+    return df
+
+
+def _read_long(in_dir: Path, sensors: List[str] = None, start: pd.Timestamp = None, end: pd.Timestamp = None,
+               memory_map: bool = True) -> pd.DataFrame:
+    """ Reads the long files of a sensor type; the filters are pushed down like in read_type(). """
+
+    filesystem = fs.LocalFileSystem(use_mmap=memory_map)
+    dataset = ds.dataset(in_dir, format='parquet', partitioning=_PARTITIONING, filesystem=filesystem)
+
+    expr = _month_filter(start, end)
+    if start is not None:
+        expr = expr & (ds.field('timestamp') >= start.as_unit('ns').value)
+    if end is not None:
+        expr = expr & (ds.field('timestamp') <= end.as_unit('ns').value)
+    if sensors is not None:
+        ids = [_sensor_id(s) for s in sensors if s.startswith('sensor_') and s[len('sensor_'):].isdigit()]
+        ids_expr = ds.field('sensor_id').isin(pa.array(ids, pa.int32()))
+        expr = ids_expr if expr is None else expr & ids_expr
+
+    table = dataset.to_table(columns=['timestamp', 'sensor_id', 'value'], filter=expr)
+    df = table.to_pandas(self_destruct=True)
+    del table
+    df['timestamp'] = pd.to_datetime(df['timestamp'].to_numpy(), unit='ns')
+    # categorical in memory too (1 or 2 bytes per row); the categories are the sorted ids
+    df['sensor_id'] = df['sensor_id'].astype('category')
+
+    # every file is sorted, but the months (and the files of incremental downloads, which overlap in
+    # time) are concatenated: sort, and keep the last row of a sensor and timestamp
+    codes, timestamps = df['sensor_id'].cat.codes.to_numpy(), df['timestamp'].to_numpy().view(np.int64)
+    order = np.lexsort((timestamps, codes))
+    codes, timestamps = codes[order], timestamps[order]
+    last = np.ones(len(order), bool)
+    last[:-1] = (codes[1:] != codes[:-1]) | (timestamps[1:] != timestamps[:-1])
+    return df.take(order[last]).reset_index(drop=True)
+
+
+def read_long(raw_dir: Path, sensor_type: str, sensors: List[str] = None, start=None, end=None,
+              memory_map: bool = True) -> pd.DataFrame:
+    """ Reads the long frame of the sensor type: the columns timestamp, sensor_id (categorical) and
+        value (float32), one row per measurement, sorted by sensor_id and timestamp. Only the
+        sensors in `sensors` (column names 'sensor_<id>', all if None) and the rows with
+        `start <= timestamp <= end` are read. Sensor types in the wide format are converted.
+    """
+
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    if stored_format(raw_dir, sensor_type) == LONG:
+        return _read_long(type_dir(raw_dir, sensor_type), sensors, start, end, memory_map)
+
+    df = read_type(raw_dir, sensor_type, sensors, start, end, memory_map)
+    return to_long(df)
+
+
+def to_long(df: pd.DataFrame) -> pd.DataFrame:
+    """ Converts a wide frame into the long frame of read_long(). """
+
+    table = to_long_table(df)
+    long = table.to_pandas()
+    long['timestamp'] = pd.to_datetime(long['timestamp'].to_numpy(), unit='ns')
+    long['sensor_id'] = long['sensor_id'].astype('category')
+    return long
+
+
+def to_wide(long: pd.DataFrame, sensors: List[str] = None) -> pd.DataFrame:
+    """ Converts the long frame of read_long() into the wide frame of read_type(): a timestamp index
+        and one float32 column 'sensor_<id>' per sensor, by id. With `sensors`, the columns are exactly
+        `sensors` in that order; sensors without rows are all NaN.
+    """
+
+    sensor_ids = long['sensor_id'].astype('category').cat.remove_unused_categories()
+    names = [f'sensor_{sensor_id}' for sensor_id in sensor_ids.cat.categories]
+    columns = names if sensors is None else list(sensors)
+
+    # scatter the values into a float32 matrix: row of the timestamp, column of the sensor (-1: not requested)
+    position = {name: i for i, name in enumerate(columns)}
+    column_of = np.array([position.get(name, -1) for name in names], np.int64)
+    cols = column_of[sensor_ids.cat.codes.to_numpy()]
+    keep = cols >= 0
+    timestamps = long['timestamp'].to_numpy('datetime64[ns]')[keep]
+    index = np.sort(timestamps)
+    if len(index):
+        index = index[np.r_[True, index[1:] != index[:-1]]]
+    # one row per sensor, so the transposed matrix is the column-major block of the frame
+    values = np.full((len(columns), len(index)), np.nan, np.float32)
+    values[cols[keep], np.searchsorted(index, timestamps)] = long['value'].to_numpy(np.float32)[keep]
+    return pd.DataFrame(values.T, index=pd.DatetimeIndex(index, name='timestamp'), columns=columns, copy=False)
+
+
+def read_files(paths: List[Path]) -> pd.DataFrame:
+    """ Wide frame of the given raw files (of one sensor type, in either format); the partition
+        columns are dropped.
+    """
+
+    frames = []
+    for path in paths:
+        table = pq.read_table(path, partitioning=None)
+        table = table.drop_columns([c for c in ('year', 'month') if c in table.column_names])
+        if 'sensor_id' in table.column_names:
+            long = table.to_pandas()
+            long['timestamp'] = pd.to_datetime(long['timestamp'].to_numpy(), unit='ns')
+            frames.append(to_wide(long))
+        else:
+            frames.append(table.to_pandas().set_index('timestamp'))
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+
+def convert(raw_dir: Path, sensor_type: str, storage_format: str = None) -> Dict[str, int]:
+    """ Rewrites the stored data of the sensor type in `storage_format` (default
+        `config.RawStorageFormat`), month by month. The new partitions are written next to the old
+        ones and replace them at the end. Returns the size on disk in bytes before and after.
+    """
+
+    raw_dir = Path(raw_dir)
+    fmt = storage_format if storage_format is not None else config.RawStorageFormat
+    in_dir = type_dir(raw_dir, sensor_type)
+    before = sum(p.stat().st_size for p in in_dir.rglob('*.parquet'))
+
+    tmp_raw_dir = raw_dir / '_convert'
+    shutil.rmtree(type_dir(tmp_raw_dir, sensor_type), ignore_errors=True)
+    for df in iter_type(raw_dir, sensor_type):
+        write_type(df, tmp_raw_dir, sensor_type, append=True, storage_format=fmt)
+
+    shutil.rmtree(in_dir)
+    os.replace(type_dir(tmp_raw_dir, sensor_type), in_dir)
+    if not any(tmp_raw_dir.iterdir()):
+        tmp_raw_dir.rmdir()
+
+    after = sum(p.stat().st_size for p in in_dir.rglob('*.parquet'))
+    logger.info(f"converted {sensor_type} to the {fmt} format: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB")
+    return {'bytes_before': before, 'bytes_after': after}
+
+
+def stored_months(raw_dir: Path, sensor_type: str) -> List[pd.Timestamp]:
+    """ Returns the first day of every month partition of the sensor type, in order. """
+
+    months = set()
+    for path in type_dir(raw_dir, sensor_type).glob('year=*/month=*'):
+        months.add(pd.Timestamp(year=int(path.parent.name.split('=')[1]), month=int(path.name.split('=')[1]), day=1))
+    return sorted(months)
+
+
+def iter_type(raw_dir: Path, sensor_type: str, sensors: List[str] = None, start=None,
+              end=None) -> Iterator[pd.DataFrame]:
+    """ Yields the wide frame of the sensor type month by month, so only one month partition is in
+        memory at a time. Every chunk has the same columns (`sensors`, default all stored columns).
+    """
+
+    columns = sensors if sensors is not None else stored_columns(raw_dir, sensor_type)
+    if not type_dir(raw_dir, sensor_type).is_dir():
+        # the former layout is a single file
+        yield read_type(raw_dir, sensor_type, columns, start, end).reindex(columns=columns)
+        return
+
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    for month in stored_months(raw_dir, sensor_type):
+        month_end = month + pd.offsets.MonthBegin() - pd.Timedelta(1, 'ns')
+        if (start is not None and month_end < start) or (end is not None and month > end):
+            continue
+        df = read_type(raw_dir, sensor_type, columns, max(month, start) if start is not None else month,
+                       min(month_end, end) if end is not None else month_end)
+        if len(df):
+            yield df.reindex(columns=columns)
+
+
+class SensorData(Mapping):
+    """ Dict-like access to the stored sensor types: sensor_type -> wide frame. A sensor type is only
+        read when it is accessed, and the most recently used frames are cached as long as their total
+        size stays below `cache_bytes` (default `config.SensorDataCacheBytes`).
+
+        The `sensors`, `start` and `end` filters are applied to every read, see read_type().
+    """
+
+    def __init__(self, raw_dir: Path, sensor_types: List[str] = None, sensors: List[str] = None,
+                 start=None, end=None, cache_bytes: int = None):
+        self.raw_dir = Path(raw_dir)
+        self.sensors = sensors
+        self.start = start
+        self.end = end
+        self.cache_bytes = cache_bytes if cache_bytes is not None else config.SensorDataCacheBytes
+
+        if sensor_types is None:
+            sensor_types = stored_types(self.raw_dir)
+        sensor_types = [t for t in sensor_types if has_type(self.raw_dir, t)]
+        if sensors is not None:
+            # skip types that have none of the requested sensors (checked on the file footers)
+            sensor_types = [t for t in sensor_types
+                            if set(sensors) & set(stored_columns(self.raw_dir, t))]
+        self._types = sensor_types
+
+        self._cache = OrderedDict()  # sensor_type -> frame, least recently used first
+        self._sizes = {}
+
+    def __getitem__(self, sensor_type: str) -> pd.DataFrame:
+        if sensor_type not in self._types:
+            raise KeyError(sensor_type)
+
+        if sensor_type in self._cache:
+            self._cache.move_to_end(sensor_type)
+            return self._cache[sensor_type]
+
+        df = read_type(self.raw_dir, sensor_type, sensors=self.sensors, start=self.start, end=self.end)
+        self._cache[sensor_type] = df
+        self._sizes[sensor_type] = int(df.memory_usage(index=True).sum())
+        logger.debug(f"SensorData: loaded {sensor_type} ({self._sizes[sensor_type] / 2**20:.1f} MB)")
+
+        # evict the least recently used frames, but always keep the one just loaded
+        while sum(self._sizes.values()) > self.cache_bytes and len(self._cache) > 1:
+            evicted, _ = self._cache.popitem(last=False)
+            logger.debug(f"SensorData: evicted {evicted} ({self._sizes.pop(evicted) / 2**20:.1f} MB)")
+
+        return df
+
+    def __iter__(self):
+        return iter(self._types)
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def __repr__(self) -> str:
+        loaded = ", ".join(self._cache)
+        return f"SensorData({self.raw_dir}, types={self._types}, loaded=[{loaded}], {self.nbytes / 2**20:.1f} MB)"
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the cached frames in bytes. """
+
+        return sum(self._sizes.values())
+
+    def memory_usage(self) -> Dict[str, int]:
+        """ Memory used by each cached frame in bytes. """
+
+        return dict(self._sizes)
+
+    def clear(self):
+        """ Drops all cached frames. """
+
+        self._cache.clear()
+        self._sizes.clear()
+
+
+def load_watermarks(raw_dir: Path) -> Dict[str, Dict[str, dict]]:
+    """ Loads the watermark manifest: sensor_type -> sensor_id -> {'measurement_id', 'timestamp'}. """
+
+    manifest = Path(raw_dir) / WATERMARK_FILE
+    if not manifest.exists():
+        return {}
+
+    with open(manifest) as f:
+        return json.load(f)
+
+
+def save_watermarks(raw_dir: Path, watermarks: Dict[str, Dict[str, dict]]):
+    """ Saves the watermark manifest; the file is replaced atomically so a crash cannot corrupt it. """
+
+    manifest = Path(raw_dir) / WATERMARK_FILE
+    tmp = manifest.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(watermarks, f, indent=2, sort_keys=True)
+    os.replace(tmp, manifest)
@@ -0,0 +1,260 @@
+# Downsampling of irregular sensor series onto a regular grid.
+#
+# The value of a bin is the time-weighted mean of the piecewise-linear interpolant through the raw
+# samples over the bin. This is what upsampling to a fine grid, interpolating linearly and averaging
+# down again approximates (see util_tools.resample_data(method='upsample')), but it is computed
+# directly: the integral of the interpolant is a cumulative sum of trapezoids over the samples, and
+# the mean over a bin is the difference of that integral at the bin edges divided by the bin width.
+# The cost is linear in the number of samples plus bins, without any intermediate grid.
+#
+# StreamingResampler does the same on a stream of chunks, e.g. the monthly partitions of the raw
+# data: the last sample of every sensor and the bins that are not complete yet are carried over to
+# the next chunk, so the result equals resample_frame() on the concatenated chunks while only a chunk
+# (plus the rows since the last complete bin) is in memory.
+
+import logging
+import numpy as np
+import pandas as pd
+from typing import Iterable, Iterator, List
+
+# get logger
+logger = logging.getLogger(__name__)
+
+
+def bin_means(timestamps: np.ndarray, values: np.ndarray, edges: np.ndarray, end: int = None,
+              max_gap: int = None) -> np.ndarray:
+    """ Time-weighted means of the linear interpolant through the samples over the bins.
+
+    Args:
+    timestamps (np.ndarray): sorted, unique int64 timestamps (ns) of the samples.
+    values (np.ndarray): values of the samples, without NaN.
+    edges (np.ndarray): sorted int64 bin edges (ns); bin k is [edges[k], edges[k+1]).
+    end (int): the last value is held constant up to this timestamp (ns). Default is the last sample.
+    max_gap (int): gaps between samples longer than this (ns) are not interpolated; the value before
+        the gap is held instead. Default None interpolates all gaps.
+
+    Returns the mean of each of the len(edges) - 1 bins, NaN for bins outside the samples. Before the
+    first sample nothing is extrapolated, like pandas' interpolate().
+    """
+
+    n_bins = len(edges) - 1
+    means = np.full(n_bins, np.nan)
+    if len(timestamps) == 0 or n_bins <= 0:
+        return means
+
+    # seconds relative to the first edge keeps the float arithmetic exact enough over long ranges
+    origin = edges[0]
+    x = (timestamps - origin) / 1e9
+    v = np.asarray(values, dtype=np.float64)
+    e = (edges - origin) / 1e9
+    x_end = max(x[-1], (end - origin) / 1e9) if end is not None else x[-1]
+
+    dx = np.diff(x)
+    slope = np.zeros(len(x))
+    slope[:-1] = np.diff(v) / dx  # the last segment (up to `end`) is constant
+    if max_gap is not None:
+        slope[:-1][dx > max_gap / 1e9] = 0
+    integral = np.concatenate(([0.0], np.cumsum(dx * (v[:-1] + slope[:-1] * dx / 2))))
+
+    def segment(y):
+        i = np.searchsorted(x, y, side='right') - 1
+        return i, y - x[i]
+
+    # clip the bins to the support [x[0], x_end] of the interpolant
+    lo = np.clip(e[:-1], x[0], x_end)
+    hi = np.clip(e[1:], x[0], x_end)
+
+    i_lo, d_lo = segment(lo)
+    i_hi, d_hi = segment(hi)
+    integral_lo = integral[i_lo] + d_lo * (v[i_lo] + slope[i_lo] * d_lo / 2)
+    integral_hi = integral[i_hi] + d_hi * (v[i_hi] + slope[i_hi] * d_hi / 2)
+
+    width = hi - lo
+    covered = width > 0
+    means[covered] = (integral_hi[covered] - integral_lo[covered]) / width[covered]
+
+    # bins that only touch the support in a single point (a single sample, or `end` on a bin edge)
+    point = ~covered & (lo >= e[:-1]) & (lo < e[1:])
+    means[point] = v[i_lo[point]] + slope[i_lo[point]] * d_lo[point]
+
+    return means
+
+
+def bin_edges(start: pd.Timestamp, end: pd.Timestamp, rate: str) -> pd.DatetimeIndex:
+    """ Edges of the bins of width `rate` that cover [start, end], aligned to midnight of the first
+        day like pandas' resample().
+    """
+
+    step = pd.Timedelta(rate)
+    origin = start.normalize()
+    first = origin + (start - origin) // step * step
+    last = first + (end - first) // step * step
+    return pd.date_range(first, last + step, freq=step)
+
+
+def _floor(ts: pd.Timestamp, step: pd.Timedelta) -> pd.Timestamp:
+    """ Left edge of the bin of width `step` that contains `ts`, with bins aligned to midnight. """
+
+    origin = ts.normalize()
+    return origin + (ts - origin) // step * step
+
+
+def resample_frame(df: pd.DataFrame, rate: str = '2min', max_gap: str = None) -> pd.DataFrame:
+    """ Downsamples every column of the frame (DatetimeIndex) to bins of width `rate`, labelled with
+        their left edge. Each column is interpolated linearly over its gaps and its last value is held
+        up to the end of the frame, as with the upsample-interpolate-downsample approach. Gaps longer
+        than `max_gap` (pandas offset, default None) hold the value before the gap instead.
+    """
+
+    if df.empty:
+        return df.resample(rate).mean()
+
+    df = df.sort_index()
+    if not df.index.is_unique:
+        df = df.groupby(level=0).mean()
+    index = df.index.as_unit('ns')
+    edges = bin_edges(index[0], index[-1], rate)
+    edge_values = edges.as_unit('ns').asi8
+    end = index[-1].value
+    timestamps = index.asi8
+    gap = pd.Timedelta(max_gap).value if max_gap is not None else None
+
+    out = {}
+    for column in df.columns:
+        values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(values)
+        out[column] = bin_means(timestamps[valid], values[valid], edge_values, end=end, max_gap=gap)
+
+    return pd.DataFrame(out, index=pd.DatetimeIndex(edges[:-1], name=df.index.name), columns=df.columns)
+
+
+class StreamingResampler:
+    """ Resamples a stream of wide chunks (DatetimeIndex, one column per sensor) like resample_frame().
+
+        push() takes the next chunk and returns the bins that are complete, flush() returns the
+        remaining bins at the end of the stream. The chunks must follow each other in time. A bin is
+        complete when every sensor has a sample at or after its end, or when the sensor has not sent
+        a sample for longer than `max_gap` (then its value is held over the gap). With `max_gap=None`
+        all gaps are interpolated, but a sensor that stops sending keeps all later rows in memory
+        until the end of the stream.
+
+        `columns` fixes the output columns (default: the columns of the first chunk); missing columns
+        of a chunk are NaN.
+    """
+
+    def __init__(self, rate: str = '2min', max_gap: str = None, columns: List[str] = None):
+        self.rate = rate
+        self.max_gap = max_gap
+        self.columns = list(columns) if columns is not None else None
+
+        self._step = pd.Timedelta(rate).value
+        self._gap = pd.Timedelta(max_gap).value if max_gap is not None else None
+        self._next_edge = None  # left edge (ns) of the first bin that was not returned yet
+        self._index_name = None
+
+        # rows since the first open bin, and the last sample of each column before it
+        self._times = np.empty(0, np.int64)
+        self._values = None
+        self._carry_times = None
+        self._carry_values = None
+
+    def push(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """ Adds the next chunk and returns the bins that are complete (possibly none). """
+
+        if chunk.empty:
+            return self._frame(np.empty(0, np.int64), np.empty((0, len(self.columns or []))))
+
+        chunk = chunk.sort_index()
+        if not chunk.index.is_unique:
+            chunk = chunk.groupby(level=0).mean()
+
+        if self._next_edge is None:
+            self.columns = self.columns if self.columns is not None else list(chunk.columns)
+            self._index_name = chunk.index.name
+            self._next_edge = _floor(chunk.index[0], pd.Timedelta(self._step)).as_unit('ns').value
+            self._values = np.empty((0, len(self.columns)))
+            self._carry_times = np.zeros(len(self.columns), np.int64)
+            self._carry_values = np.full(len(self.columns), np.nan)
+
+        times = chunk.index.as_unit('ns').asi8
+        if len(self._times) and times[0] <= self._times[-1]:
+            raise ValueError(f"chunk starting at {chunk.index[0]} overlaps the previous chunk")
+
+        values = chunk.reindex(columns=self.columns).to_numpy(dtype=np.float64, na_value=np.nan)
+        self._times = np.concatenate([self._times, times])
+        self._values = np.concatenate([self._values, values])
+
+        return self._emit(final=False)
+
+    def flush(self) -> pd.DataFrame:
+        """ Returns the remaining bins; the last values are held up to the last timestamp. """
+
+        if self._next_edge is None or len(self._times) == 0:
+            return self._frame(np.empty(0, np.int64), np.empty((0, len(self.columns or []))))
+        return self._emit(final=True)
+
+    def _emit(self, final: bool) -> pd.DataFrame:
+        """ Computes the complete bins from the buffered rows and drops the rows they no longer need. """
+
+        step, start = self._step, self._next_edge
+        watermark = self._times[-1]
+        valid = ~np.isnan(self._values)
+
+        if final:
+            n_bins = (watermark - start) // step + 1
+        else:
+            # time up to which the interpolant of each column is known
+            has_rows = valid.any(axis=0)
+            last_row = len(self._times) - 1 - np.argmax(valid[::-1], axis=0)
+            last_time = np.where(has_rows, self._times[last_row], self._carry_times)
+            seen = has_rows | ~np.isnan(self._carry_values)
+            known = np.where(seen, last_time, watermark)
+            if self._gap is not None:
+                known = np.where(watermark - last_time > self._gap, watermark, known)
+            n_bins = (known.min() - start) // step
+
+        if n_bins <= 0:
+            return self._frame(np.empty(0, np.int64), np.empty((0, len(self.columns))))
+
+        edges = start + step * np.arange(n_bins + 1, dtype=np.int64)
+        means = np.empty((n_bins, len(self.columns)))
+        for j in range(len(self.columns)):
+            times, values = self._times[valid[:, j]], self._values[valid[:, j], j]
+            if not np.isnan(self._carry_values[j]):
+                times = np.concatenate([[self._carry_times[j]], times])
+                values = np.concatenate([[self._carry_values[j]], values])
+            means[:, j] = bin_means(times, values, edges, end=watermark, max_gap=self._gap)
+
+        # carry the last sample of each column before the new first open bin, drop the rows before it
+        self._next_edge = edges[-1]
+        done = self._times < self._next_edge
+        done_valid = valid[done]
+        has_done = done_valid.any(axis=0)
+        last_done = done.sum() - 1 - np.argmax(done_valid[::-1], axis=0)
+        cols = np.flatnonzero(has_done)
+        self._carry_times[cols] = self._times[last_done[cols]]
+        self._carry_values[cols] = self._values[last_done[cols], cols]
+        self._times = self._times[~done]
+        self._values = self._values[~done]
+
+        return self._frame(edges[:-1], means)
+
+    def _frame(self, edges: np.ndarray, means: np.ndarray) -> pd.DataFrame:
+        index = pd.DatetimeIndex(pd.to_datetime(edges, unit='ns'), name=self._index_name)
+        return pd.DataFrame(means, index=index, columns=self.columns)
+
+
+def iter_resampled(chunks: Iterable[pd.DataFrame], rate: str = '2min', max_gap: str = None,
+                   columns: List[str] = None) -> Iterator[pd.DataFrame]:
+    """ Yields the resampled chunks of a stream of wide chunks, see StreamingResampler. Chunks without
+        complete bins are skipped.
+    """
+
+    resampler = StreamingResampler(rate, max_gap=max_gap, columns=columns)
+    for chunk in chunks:
+        out = resampler.push(chunk)
+        if len(out):
+            yield out
+    out = resampler.flush()
+    if len(out):
+        yield out
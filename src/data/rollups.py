@@ -0,0 +1,269 @@
+# Precomputed aggregates of the raw sensor data at several resolutions (rollups).
+#
+# For each sensor type and each resolution in `config.RollupResolutions` (default 1min, 15min, 1h and
+# 1D), the rollup store holds one row per sensor and time bin with the count, min, max, sum and sum
+# of squares of the raw values, so the mean and the standard deviation of any bin follow without
+# the raw data. The aggregates are mergeable: the aggregate of two sets of rows is the sum of the
+# counts, sums and sums of squares and the min/max of the minima/maxima.
+#
+# Layout (long format, one file per month):
+#
+#   <rollup_dir>/sensor_type=<type>/resolution=<res>/<yyyy>-<mm>.parquet
+#   <rollup_dir>/sensor_type=<type>/_manifest.json    raw files already aggregated, per month
+#
+# The rollups of `config.data_raw_dir` are kept in `config.RollupDir`, those of any other raw data
+# directory in `<raw_dir>/_rollups` (see rollup_dir_for), so data of other raw directories (e.g. of
+# the benchmarks) never mixes with them.
+#
+# update() compares the raw files of each month partition (see raw_store) with the manifest: files
+# added by an incremental download are aggregated on their own and merged into the stored months,
+# months whose files were replaced (a full download) are aggregated again, and unchanged months are
+# skipped. read() picks the finest resolution that returns at most `max_points` bins for the
+# requested range, so a plot or an analysis of months of data works on thousands of rows.
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from typing import Dict, List
+
+from src import config
+from src import instrumentation
+from src.data import raw_store
+
+# get logger
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = '_manifest.json'
+
+# statistics that read() can return besides the stored aggregates
+DERIVED_STATS = ['mean', 'std']
+
+_AGGREGATES = ['count', 'min', 'max', 'sum', 'sumsq']
+_MERGE = {'count': 'sum', 'min': 'min', 'max': 'max', 'sum': 'sum', 'sumsq': 'sum'}
+
+
+def _type_dir(rollup_dir: Path, sensor_type: str) -> Path:
+    return Path(rollup_dir) / f'sensor_type={sensor_type}'
+
+
+def _month_path(rollup_dir: Path, sensor_type: str, resolution: str, month: pd.Timestamp) -> Path:
+    return _type_dir(rollup_dir, sensor_type) / f'resolution={resolution}' / f'{month:%Y-%m}.parquet'
+
+
+def rollup_dir_for(raw_dir: Path = None) -> Path:
+    """ Rollup directory of the raw data in `raw_dir` (default `config.data_raw_dir`). """
+
+    if raw_dir is None or Path(raw_dir).resolve() == Path(config.data_raw_dir).resolve():
+        return Path(config.RollupDir)
+    return Path(raw_dir) / '_rollups'
+
+
+def aggregate(df: pd.DataFrame, resolution: str) -> pd.DataFrame:
+    """ Aggregates a wide frame (timestamp index, one column per sensor) into bins of `resolution`.
+        Returns the long frame with the columns timestamp (left edge of the bin), sensor, count, min,
+        max, sum and sumsq; only bins with values have a row.
+    """
+
+    long = df.rename_axis(index='timestamp', columns='sensor').stack().rename('value').reset_index()
+    long = long[long['value'].notna()]
+    long['timestamp'] = long['timestamp'].dt.floor(resolution)
+    # sum in float64, also for float32 raw data
+    long['value'] = long['value'].astype(np.float64)
+    long['sq'] = long['value'] ** 2
+
+    grouped = long.groupby(['sensor', 'timestamp'], sort=True, observed=True)
+    out = grouped['value'].agg(['count', 'min', 'max', 'sum'])
+    out['sumsq'] = grouped['sq'].sum()
+    return out.reset_index()[['timestamp', 'sensor'] + _AGGREGATES]
+
+
+def merge(*frames: pd.DataFrame) -> pd.DataFrame:
+    """ Merges aggregates of disjoint sets of raw rows. """
+
+    frames = [f for f in frames if f is not None and len(f)]
+    if not frames:
+        return pd.DataFrame(columns=['timestamp', 'sensor'] + _AGGREGATES)
+    if len(frames) == 1:
+        return frames[0]
+    combined = pd.concat(frames, ignore_index=True)
+    return combined.groupby(['sensor', 'timestamp'], sort=True).agg(_MERGE).reset_index()[
+        ['timestamp', 'sensor'] + _AGGREGATES]
+
+
+def _write(path: Path, df: pd.DataFrame):
+    """ Writes a month of aggregates; the sensor column is dictionary encoded. """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df = df.sort_values(['timestamp', 'sensor'], kind='stable')
+    df = df.astype({'sensor': 'category', 'count': np.int64})
+    tmp = path.with_name(path.name + '.tmp')
+    tic = time.perf_counter()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+    os.replace(tmp, path)
+    instrumentation.file_written('rollup', len(df), time.perf_counter() - tic, path)
+
+
+def _read_month(path: Path) -> pd.DataFrame:
+    if not path.exists():
+        return None
+    df = pd.read_parquet(path)
+    return df.astype({'sensor': str})
+
+
+def _raw_files(raw_dir: Path, sensor_type: str) -> Dict[str, List[Path]]:
+    """ Raw files of each month partition: 'yyyy-mm' -> files. """
+
+    files = {}
+    for month in raw_store.stored_months(raw_dir, sensor_type):
+        month_dir = raw_store.type_dir(raw_dir, sensor_type) / f'year={month.year}' / f'month={month.month}'
+        files[f'{month:%Y-%m}'] = sorted(month_dir.glob('*.parquet'))
+    return files
+
+
+def _load_manifest(rollup_dir: Path, sensor_type: str) -> dict:
+    path = _type_dir(rollup_dir, sensor_type) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(rollup_dir: Path, sensor_type: str, manifest: dict):
+    path = _type_dir(rollup_dir, sensor_type) / MANIFEST_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def update(raw_dir: Path = None, sensor_type: str = None, rollup_dir: Path = None,
+           resolutions: List[str] = None) -> dict:
+    """ Brings the rollups of the sensor type in `rollup_dir` (default rollup_dir_for(raw_dir)) up to
+        date with the raw data and returns the number of months that were merged, rebuilt and skipped.
+    """
+
+    raw_dir = Path(raw_dir) if raw_dir is not None else config.data_raw_dir
+    rollup_dir = Path(rollup_dir) if rollup_dir is not None else rollup_dir_for(raw_dir)
+    resolutions = list(resolutions) if resolutions is not None else list(config.RollupResolutions)
+
+    counts = {'merged': 0, 'rebuilt': 0, 'skipped': 0}
+    if not raw_store.type_dir(raw_dir, sensor_type).is_dir():
+        logger.warning(f"rollups: no partitioned raw data for {sensor_type} in {raw_dir}")
+        return counts
+
+    manifest = _load_manifest(rollup_dir, sensor_type)
+    if manifest.get('resolutions') != resolutions:
+        # new resolutions; aggregate everything again
+        manifest = {'resolutions': resolutions, 'months': {}}
+
+    for month_key, paths in _raw_files(raw_dir, sensor_type).items():
+        names = [p.name for p in paths]
+        done = manifest['months'].get(month_key, [])
+        if names == done:
+            counts['skipped'] += 1
+            continue
+
+        month = pd.Timestamp(f'{month_key}-01')
+        incremental = set(done) <= set(names) and done
+        new_paths = [p for p in paths if p.name not in done] if incremental else paths
+        raw = raw_store.read_files(new_paths)
+
+        for resolution in resolutions:
+            path = _month_path(rollup_dir, sensor_type, resolution, month)
+            new = aggregate(raw, resolution)
+            _write(path, merge(_read_month(path), new) if incremental else new)
+
+        manifest['months'][month_key] = names
+        _save_manifest(rollup_dir, sensor_type, manifest)
+        counts['merged' if incremental else 'rebuilt'] += 1
+
+    logger.info(f"rollups of {sensor_type}: {counts}")
+    return counts
+
+
+def update_all(raw_dir: Path = None, rollup_dir: Path = None) -> Dict[str, dict]:
+    """ Updates the rollups of all sensor types stored in `raw_dir`. """
+
+    raw_dir = Path(raw_dir) if raw_dir is not None else config.data_raw_dir
+    return {sensor_type: update(raw_dir, sensor_type, rollup_dir) for sensor_type in raw_store.stored_types(raw_dir)}
+
+
+def stored_resolutions(sensor_type: str, rollup_dir: Path = None) -> List[str]:
+    """ Resolutions stored for the sensor type in `rollup_dir` (default rollup_dir_for(None)), finest first. """
+
+    rollup_dir = Path(rollup_dir) if rollup_dir is not None else rollup_dir_for(None)
+    resolutions = [p.name.split('=', 1)[1] for p in _type_dir(rollup_dir, sensor_type).glob('resolution=*')]
+    return sorted(resolutions, key=pd.Timedelta)
+
+
+def choose_resolution(resolutions: List[str], start: pd.Timestamp, end: pd.Timestamp, max_points: int) -> str:
+    """ Finest resolution with at most `max_points` bins in [start, end]; the coarsest if none has. """
+
+    resolutions = sorted(resolutions, key=pd.Timedelta)
+    for resolution in resolutions:
+        if (end - start) / pd.Timedelta(resolution) <= max_points:
+            return resolution
+    return resolutions[-1]
+
+
+def read(sensor_type: str, start=None, end=None, sensors: List[str] = None, max_points: int = None,
+         resolution: str = None, stat: str = 'mean', rollup_dir: Path = None) -> pd.DataFrame:
+    """ Reads the rollups of the sensor type for start <= timestamp <= end.
+
+    Args:
+    sensor_type (str): sensor type.
+    start, end (str or Timestamp): time range, default all stored months.
+    sensors (list): sensor columns ('sensor_<id>'), default all.
+    max_points (int): bins per sensor the result may have at most; picks the resolution, default
+        `config.PlotMaxPoints`. Ignored if `resolution` is given.
+    resolution (str): one of the stored resolutions.
+    rollup_dir (Path): rollup store, default that of `config.data_raw_dir` (see rollup_dir_for).
+    stat (str): 'mean', 'std', 'count', 'min', 'max', 'sum' or 'sumsq' returns a wide frame (timestamp
+        index, one column per sensor) of that statistic; None returns the long frame with all
+        aggregates and the mean and std.
+
+    The chosen resolution is in `df.attrs['resolution']`.
+    """
+
+    rollup_dir = Path(rollup_dir) if rollup_dir is not None else rollup_dir_for(None)
+    resolutions = stored_resolutions(sensor_type, rollup_dir)
+    if not resolutions:
+        raise FileNotFoundError(f"no rollups of {sensor_type} in {rollup_dir}; run rollups.update() first")
+
+    months = sorted(_type_dir(rollup_dir, sensor_type).glob(f'resolution={resolutions[-1]}/*.parquet'))
+    first, last = pd.Timestamp(months[0].stem + '-01'), pd.Timestamp(months[-1].stem + '-01') + pd.offsets.MonthBegin()
+    start = pd.Timestamp(start) if start is not None else first
+    end = pd.Timestamp(end) if end is not None else last
+
+    if resolution is None:
+        max_points = max_points if max_points is not None else config.PlotMaxPoints
+        resolution = choose_resolution(resolutions, start, end, max_points)
+
+    frames = []
+    for month in pd.date_range(start.to_period('M').to_timestamp(), end, freq='MS'):
+        path = _month_path(rollup_dir, sensor_type, resolution, month)
+        if not path.exists():
+            continue
+        filters = [('timestamp', '>=', start), ('timestamp', '<=', end)]
+        if sensors is not None:
+            filters.append(('sensor', 'in', list(sensors)))
+        frames.append(pd.read_parquet(path, filters=filters))
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['timestamp', 'sensor'] + _AGGREGATES)
+    df = df.astype({'sensor': str})
+    df['mean'] = df['sum'] / df['count']
+    with np.errstate(invalid='ignore'):
+        df['std'] = np.sqrt(np.maximum(df['sumsq'] / df['count'] - df['mean'] ** 2, 0))
+
+    if stat is not None:
+        df = df.pivot(index='timestamp', columns='sensor', values=stat).rename_axis(columns=None)
+    df.attrs['resolution'] = resolution
+    logger.debug(f"rollups: read {len(df)} rows of {sensor_type} at {resolution}")
+    return df
@@ -0,0 +1,136 @@
+# Synthetic sensor network for benchmarks and offline tests.
+#
+# generate_db() fills a sqlite3 database with the schema of the sensor DB (the schema of the local
+# mirror, see db_mirror.py), so the whole pipeline can run against it with `config.DBType = 0`.
+# Each sensor gets a daily and a weekly cycle plus noise around a level typical for its type, and a
+# fraction of the samples is removed in contiguous gaps, like the outages of the real sensors.
+
+import time
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import List
+
+from src import config
+from src.data import DB_tools as dbt
+from src.data import db_mirror
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# typical level, daily amplitude and noise of each sensor type
+_TYPE_PROFILES = {
+    'temperature': (21.0, 1.5, 0.1),
+    'voc': (150.0, 60.0, 10.0),
+    'co2': (600.0, 250.0, 20.0),
+    'humidity': (40.0, 8.0, 1.0),
+    'light': (200.0, 180.0, 15.0),
+    'uv': (0.5, 0.5, 0.05),
+    'pressure': (965.0, 3.0, 0.2),
+}
+
+_METADATA_SCHEMA = """
+CREATE TABLE tblSensorType (sensor_type_id INTEGER PRIMARY KEY, type_name TEXT NOT NULL);
+CREATE TABLE tblRoom (room_id INTEGER PRIMARY KEY, room_name TEXT NOT NULL);
+CREATE TABLE tblDevice (device_id INTEGER PRIMARY KEY, room_id INTEGER NOT NULL, device_name TEXT NOT NULL);
+CREATE TABLE tblSensor (sensor_id INTEGER PRIMARY KEY, sensor_name TEXT NOT NULL,
+                        sensor_type_id INTEGER NOT NULL, device_id INTEGER NOT NULL);
+"""
+
+
+def _sensor_values(rng: np.random.Generator, sensor_type: str, t: np.ndarray) -> np.ndarray:
+    """ Values of one sensor at the times `t` (seconds since the start). """
+
+    level, amplitude, noise = _TYPE_PROFILES.get(sensor_type, (100.0, 10.0, 1.0))
+    level *= rng.uniform(0.9, 1.1)
+    phase = rng.uniform(0, 2 * np.pi)
+
+    daily = np.sin(2 * np.pi * t / 86400 + phase)
+    weekly = 0.3 * np.sin(2 * np.pi * t / (7 * 86400))
+    return level + amplitude * (daily + weekly) + rng.normal(0, noise, len(t))
+
+
+def _keep_mask(rng: np.random.Generator, n: int, gap_ratio: float, mean_gap: int) -> np.ndarray:
+    """ Mask of the samples that are kept; about `gap_ratio` of them are removed in gaps of on
+        average `mean_gap` samples.
+    """
+
+    keep = np.ones(n, dtype=bool)
+    n_gaps = int(n * gap_ratio / mean_gap)
+    if n_gaps == 0:
+        return keep
+
+    starts = rng.integers(0, n, n_gaps)
+    lengths = rng.geometric(1 / mean_gap, n_gaps)
+    for start, length in zip(starts, lengths):
+        keep[start:start + length] = False
+    return keep
+
+
+def generate_db(db_file: Path, sensors_per_type: int = 5, sensor_types: List[str] = None,
+                sampling_seconds: int = 60, gap_ratio: float = 0.05, start_date: str = "2024-01-01",
+                days: int = 14, seed: int = 0) -> dict:
+    """ Creates a sqlite3 DB with the schema of the sensor DB and synthetic measurements.
+
+    Args:
+    db_file (Path): DB file; an existing file is replaced.
+    sensors_per_type (int): number of sensors of each type. Default is 5.
+    sensor_types (list): sensor types, default `config.sensor_types`.
+    sampling_seconds (int): sampling interval of the sensors. Default is 60.
+    gap_ratio (float): fraction of the samples that is missing, in contiguous gaps. Default is 0.05.
+    start_date (str): first day of the measurements. Default is "2024-01-01".
+    days (int): number of days of measurements. Default is 14.
+    seed (int): seed of the random generator, so the DB is reproducible. Default is 0.
+
+    Returns the number of sensors and measurements.
+    """
+
+    sensor_types = sensor_types if sensor_types is not None else config.sensor_types
+    db_file = Path(db_file)
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+    db_file.unlink(missing_ok=True)
+
+    tic = time.perf_counter()
+    rng = np.random.default_rng(seed)
+
+    start = pd.Timestamp(start_date)
+    n = days * 86400 // sampling_seconds
+
+    conn = dbt.connect_sqlite(db_file)
+    try:
+        conn.executescript(_METADATA_SCHEMA + db_mirror._MEASUREMENT_SCHEMA)
+
+        sensor_id = 0
+        n_rows = 0
+        for type_id, sensor_type in enumerate(sensor_types, start=1):
+            conn.execute("INSERT INTO tblSensorType VALUES (?, ?);", (type_id, sensor_type))
+
+            for _ in range(sensors_per_type):
+                sensor_id += 1
+                room = f"TE {sensor_id:03}"
+                conn.execute("INSERT OR IGNORE INTO tblRoom VALUES (?, ?);", (sensor_id, room))
+                conn.execute("INSERT INTO tblDevice VALUES (?, ?, ?);", (sensor_id, sensor_id, f"sensor-{sensor_id}"))
+                conn.execute("INSERT INTO tblSensor VALUES (?, ?, ?, ?);",
+                             (sensor_id, f"sensor-{sensor_id}.zhaw.ch_{sensor_type}", type_id, sensor_id))
+
+                # sensors are not synchronized; each has its own offset
+                t = np.arange(n) * sampling_seconds + rng.integers(0, sampling_seconds)
+                keep = _keep_mask(rng, n, gap_ratio, mean_gap=max(1, 3600 // sampling_seconds))
+                t = t[keep]
+                values = _sensor_values(rng, sensor_type, t)
+
+                stamps = start + pd.to_timedelta(t, unit='s')
+                conn.executemany("INSERT INTO tblMeasurement (sensor_id, date, time, value) VALUES (?, ?, ?, ?);",
+                                 zip([sensor_id] * len(t), stamps.strftime('%Y-%m-%d'), stamps.strftime('%H:%M:%S'),
+                                     values.tolist()))
+                n_rows += len(t)
+
+        conn.execute(db_mirror._MEASUREMENT_INDEX)
+        conn.commit()
+    finally:
+        conn.close()
+
+    logger.info(f"generated {sensor_id} sensors with {n_rows} measurements in {db_file} "
+                f"({time.perf_counter() - tic:.1f} s)")
+    return {'sensors': sensor_id, 'measurements': n_rows}
@@ -1,19 +1,18 @@
 import logging
-from statsmodels.tsa.stattools import adfuller
-from statsmodels.tsa.stattools import kpss
 from src import config
-from statsmodels.tsa.seasonal import seasonal_decompose
-from statsmodels.tsa.seasonal import STL
-from bokeh.plotting import figure, show, output_file
-from bokeh.palettes import Category20  # For color palettes
-from bokeh.models import ColumnDataSource
+from src import instrumentation
 from pathlib import Path
-from tqdm import tqdm
 import pandas as pd
 import src.data.DB_tools as dbt
-from statsmodels.graphics.tsaplots import plot_acf, plot_pacf
+from src.data import raw_store
+from src.data import resample
+from src.data import rollups
+from src.visualization import lod
+from src.data import make_dataset
 import time
-import matplotlib.pyplot as plt
+
+# statsmodels, bokeh and matplotlib are imported in the functions that use them, so importing
+# util_tools stays fast
 
 
 logger = logging.getLogger(__name__)
@@ -23,63 +22,50 @@ def download_all_data(start_date : str="2024-01-01"):  # Due to the faulty data
     """Download all the data from the DB
     Parameters: start_date (default "2024-01-01")
     Returns: DataFrame incl all the sensor data
+    The download runs concurrently, see make_dataset.download_data()
     """
     logger.info("Downloading all data")
     base_dir = Path.cwd()  # Adjust this if your script is in a different directory structure
     output_dir = base_dir / 'data' / 'raw'
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    sensor_types = dbt.GetSensorTypes()
-    sensor_data_dfs = {}  # Dictionary to store dataframes for each sensor type
-
-    for sensor_type in sensor_types['type_name']:
-        print(f"Processing {sensor_type} sensors")
-        sensor_ids = dbt.GetSensorIdsOfType(sensor_type)
-
-        all_sensor_data = []
-
-        for sensor_id in tqdm(sensor_ids['sensor_id'], desc=f"Downloading {sensor_type} sensor data"):
-            sensor_data = dbt.GetTimeSeries(sensor_id, start_date=start_date)
-            if sensor_data.empty:
-                continue
 
-            sensor_data.set_index('timestamp', inplace=True)
-            sensor_data.rename(columns={'value': f'sensor_{sensor_id}'}, inplace=True)
-            all_sensor_data.append(sensor_data)
-
-        if all_sensor_data:
-            combined_data = pd.concat(all_sensor_data)
-            file_path = output_dir / f'{sensor_type}_data.parquet'
-            combined_data.to_parquet(file_path)
-            sensor_data_dfs[sensor_type] = combined_data
-        else:
-            sensor_data_dfs[sensor_type] = pd.DataFrame()  # Store an empty DataFrame if no data
+    sensor_data_dfs = make_dataset.download_data(start_date=start_date, output_dir=output_dir)
     logger.info("Successfully downloaded all data")
     return sensor_data_dfs
 
 
-def load_sensor_data(directory):
+def load_sensor_data(directory, sensor_types=None, sensors=None, start=None, end=None):
     """Load the sensor data
-    Parameters: directory (str)
-    Returns: sensor_data (DataFrame)"""
+    Parameters: directory (str) with the raw dataset (see `raw_store`)
+                sensor_types (list of str): sensor types to load, default all stored types
+                sensors (list of str or int): sensor columns ('sensor_<id>' or id) to load, default all
+                start, end (str or Timestamp): only load rows with start <= timestamp <= end
+    Only the requested partitions, columns and row groups are read from disk, and each sensor type
+    is only read when it is accessed.
+    Returns: sensor_data (dict-like raw_store.SensorData, sensor_type -> DataFrame)"""
     logger.info("Loading sensor data")
     # Define the directory path for the Parquet files
     data_dir = Path(directory)
 
-    # Create a dictionary to store each DataFrame
-    sensor_data_dfs = {}
+    if sensors is not None:
+        sensors = [s if isinstance(s, str) else f'sensor_{s}' for s in sensors]
 
-    # List all Parquet files in the directory
-    parquet_files = data_dir.glob('*.parquet')
+    return raw_store.SensorData(data_dir, sensor_types=sensor_types, sensors=sensors, start=start, end=end)
 
-    # Load each Parquet file into a DataFrame and store it in the dictionary
-    for file_path in parquet_files:
-        # Assume the file name format is 'sensor_type_data.parquet'
-        sensor_type = file_path.stem.replace('_data', '')  # Extract sensor type from file name
-        df = pd.read_parquet(file_path)
-        sensor_data_dfs[sensor_type] = df
 
-    return sensor_data_dfs
+def load_sensor_rollup(sensor_type, start=None, end=None, sensors=None, max_points=None, stat='mean', directory=None):
+    """Load aggregated sensor data from the rollup store (see `rollups`)
+    Parameters: sensor_type (str)
+                start, end (str or Timestamp): time range, default all data
+                sensors (list of str or int): sensor columns ('sensor_<id>' or id) to load, default all
+                max_points (int): bins per sensor at most; the finest resolution that fits is used
+                stat (str): 'mean', 'std', 'min', 'max', 'count' or 'sum' of each bin
+                directory (str): raw dataset the rollups belong to, default `config.data_raw_dir`
+    Returns: DataFrame with one column per sensor; the resolution is in df.attrs['resolution']"""
+    logger.info(f"Loading {stat} rollup of {sensor_type}")
+    if sensors is not None:
+        sensors = [s if isinstance(s, str) else f'sensor_{s}' for s in sensors]
+    return rollups.read(sensor_type, start=start, end=end, sensors=sensors, max_points=max_points, stat=stat,
+                        rollup_dir=rollups.rollup_dir_for(directory))
 
 
 def stationarity_tests(df):
@@ -98,40 +84,53 @@ def stationarity_tests(df):
 
     Logging:
     - The function logs the initiation of the stationarity test and the results of both the ADF and KPSS tests.
+
+    Returns:
+    - The results of adfuller() and kpss(). To test many sensors at once, see features.stationarity.test_sensors().
     """
 
+    from statsmodels.tsa.stattools import adfuller, kpss
+
     logger.info("Stationarity tests")
     adf = adfuller(df, regression='ct')
     kp = kpss(df, regression='ct')
     # log results
     logger.info(f'p-value of adf:\n {adf[1]}\n \n p-value of the kpss: \n{kp[1]}')
-    #return adf, kp # exchange thru logger!
-    return
+    return adf, kp
 
-def resample_data(df, downsampling_rate : str =  '2min', upsampling_rate : str = '0.1min'):
+def resample_data(df, downsampling_rate : str =  '2min', upsampling_rate : str = '0.1min', method : str = 'direct'):
     """
-    Resample the data first by upsampling to a finer granularity, then interpolating missing values,
-    and finally downsampling to a coarser granularity.
+    Resample the data to a coarser granularity: each bin gets the time-weighted mean of the linear
+    interpolation between the samples.
 
     Parameters:
     df (pd.DataFrame): The dataframe to resample.
     downsampling_rate (str): The rate for downsampling, default is '2min'.
-    upsampling_rate (str): The rate for upsampling, default is '0.1min'.
+    upsampling_rate (str): The rate for upsampling with method 'upsample', default is '0.1min'.
+    method (str): 'direct' computes the bin means from the raw samples (see `resample`), without an
+        intermediate grid. 'upsample' first upsamples to `upsampling_rate`, interpolates the missing
+        values and then downsamples; it approximates 'direct' and needs
+        downsampling_rate / upsampling_rate times more memory. Default is 'direct'.
 
     Returns:
     pd.DataFrame: The resampled dataframe.
     """
+    if method not in ('direct', 'upsample'):
+        raise ValueError(f"unknown resampling method {method!r}")
+
     logger.info("Resampling data")
-    try:
-        upsampled = df.resample(upsampling_rate).mean()
-        interpolated = upsampled.interpolate(method='linear')
-        downsampled = interpolated.resample(downsampling_rate).mean()
-        logger.info(f'Data has been upsampled to :{upsampling_rate} and downsampled to {downsampling_rate}"')
-    except Exception as e:
-        logger.debug(e)
+    with instrumentation.timer('resample_seconds', method=method):
+        if method == 'direct':
+            downsampled = resample.resample_frame(df, downsampling_rate)
+            logger.info(f'Data has been downsampled to {downsampling_rate}')
+        else:
+            upsampled = df.resample(upsampling_rate).mean()
+            interpolated = upsampled.interpolate(method='linear')
+            downsampled = interpolated.resample(downsampling_rate).mean()
+            logger.info(f'Data has been upsampled to :{upsampling_rate} and downsampled to {downsampling_rate}"')
     return downsampled
 
-def seasonal_decomposition(df: pd.DataFrame, model_type: str = 'multiplicative', period = 720):
+def seasonal_decomposition(df: pd.DataFrame, model_type: str = 'multiplicative', period = 720, plot: bool = True):
     """
     Decomposes a time series into seasonal, trend, and residual components using specified model type and period.
     This function is useful for analyzing patterns within time series data.
@@ -140,20 +139,26 @@ def seasonal_decomposition(df: pd.DataFrame, model_type: str = 'multiplicative',
     df (pd.DataFrame): Time series data as a DataFrame.
     model_type (str): Type of decomposition model ('additive' or 'multiplicative'). Default is 'multiplicative'.
     period (int): The frequency of the time series. Default is 24 (e.g., hourly data for a full day).
+    plot (bool): Plot the decomposed components. Default is True.
 
     Effect:
     Logs the start and completion of decomposition and plots the decomposed components.
+    To decompose many sensors at once without plotting, see features.decomposition.decompose_sensors().
     """
+    from statsmodels.tsa.seasonal import seasonal_decompose
+
     logger.info("seasonal_decomposition:")
     # Decompose the data
-    decomposition = seasonal_decompose(df, model=model_type, period=period)
+    with instrumentation.timer('decomposition_fit_seconds', method='classical'):
+        decomposition = seasonal_decompose(df, model=model_type, period=period)
     # model additive or multiplicative, here we should use multiplicative, see daily/ seasonal highs in co2_data
     logger.info(f"seasonal_decomposition: done with a  {model_type} model and period {period}")
     # Plot the decomposed components
-    decomposition.plot()
+    if plot:
+        decomposition.plot()
     return decomposition
 
-def loess_decomposition(df: pd.DataFrame, seasonal: int = 5, period = 720):
+def loess_decomposition(df: pd.DataFrame, seasonal: int = 5, period = 720, plot: bool = True):
 
     """
     Performs LOESS (Locally Estimated Scatterplot Smoothing) decomposition to analyze and smooth time series data.
@@ -163,19 +168,24 @@ def loess_decomposition(df: pd.DataFrame, seasonal: int = 5, period = 720):
     df (pd.DataFrame): Time series data as a DataFrame.
     seasonal (int): The smoothing parameter for seasonal component. Default is 5.
     period (int): The number of observations that complete one seasonal cycle. Default is 52 (e.g., weekly data over a year).
+    plot (bool): Plot the results. Default is True.
 
     Effect:
     Logs the start and completion of LOESS fitting and plots the results.
     """
+    from statsmodels.tsa.seasonal import STL
+
     logger.info("loess_decomposition:")
-    stl = STL(df, seasonal=seasonal, period = period)
-    res = stl.fit()
+    with instrumentation.timer('decomposition_fit_seconds', method='stl'):
+        stl = STL(df, seasonal=seasonal, period = period)
+        res = stl.fit()
     logger.info(f"loess_decomposition: done with a seasonal: {seasonal}  and period {period}")
-    res.plot()
+    if plot:
+        res.plot()
     return res
 
 
-def plot_all_sensors(df):
+def plot_all_sensors(df, show_plot: bool = True, method: str = None, max_points: int = None):
     """
     Generates an interactive plot for sensor data from a DataFrame where each column is a sensor.
     Saves the plot as an HTML file named after the first column. Uses the Bokeh library for plotting.
@@ -183,10 +193,21 @@ def plot_all_sensors(df):
     Args:
     df (DataFrame): Sensor data where each column represents a different sensor.
     output_filename (str): Name of the output HTML file. Defaults to the name of the first sensor column with '_plot.html' suffix.
+    show_plot (bool): Open the plot in the browser. If False, the HTML file is only saved (headless use). Default is True.
+    method (str): Level-of-detail downsampling of each sensor, 'minmax' (keeps the spikes) or 'lttb' (keeps the shape),
+        or False for the full resolution. Default is `config.PlotLODMethod`.
+    max_points (int): Points per sensor after downsampling. Default is `config.PlotMaxPoints`.
+
+    All sensors share a single ColumnDataSource. To zoom into the full resolution, use the Bokeh server app
+    `bokeh serve src/visualization/lod_app.py --args <sensor_type>`, which reads the zoomed range from the raw data.
 
     Returns:
-    Displays the interactive plot.
+    Displays the interactive plot, or returns the figure if `show_plot` is False.
     """
+    from bokeh.plotting import figure, show, save, output_file
+    from bokeh.palettes import Category20  # For color palettes
+    from bokeh.models import ColumnDataSource
+
     file_name = df.columns[0]
     output_filename = f"{file_name}_plot.html"
     output_file(output_filename)  # output_notebook() would display plot within the Jupyter Notebook
@@ -198,37 +219,42 @@ def plot_all_sensors(df):
     # Colors for lines
     colors = Category20[20]  # Supports up to 10 lines; use other palettes for more lines
 
+    # One column data source for all sensors, each reduced to about max_points points
+    source = ColumnDataSource(data=lod.source_data(df, max_points=max_points, method=method))
+
     # Plot data from each sensor
     for index, column in enumerate(df.columns):
         # Use cyclic colors if more than 10 sensors
         color = colors[index % len(colors)]
-        # Create a column data source for each sensor's data
-        source = ColumnDataSource(data={
-            'timestamp': df.index,
-            'values': df[column]
-        })
-        p.line(x='timestamp', y='values', source=source, legend_label=column, line_width=2, color=color)
+        p.line(x=f'x_{column}', y=f'y_{column}', source=source, legend_label=column, line_width=2, color=color)
 
     # Styling for the plot
     p.legend.location = "top_left"
     p.legend.click_policy = "hide"
 
+    if not show_plot:
+        save(p)
+        return p
+
     return show(p)
 
 
-def acf_plotting(residuals):
+def acf_plotting(residuals, output_dir=None, show_plot: bool = True):
     """
     Plot the Autocorrelation Function (ACF) and the Partial Autocorrelation Function (PACF) of the given residuals.
 
     Parameters:
     residuals (pd.Series): The residuals of a time series model. It should be a Pandas Series object.
+    output_dir (str or Path): Directory of the PNG file. Default is `config.images_dir` (data/images).
+    show_plot (bool): Display the plots. If False, the figure is only saved (headless use). Default is True.
 
     This function generates two plots:
     1. ACF plot
     2. PACF plot
 
-    The plots are displayed and saved as a PNG file in the './data/images/' directory with a filename that includes
-    the name of the residual series and the current timestamp.
+    The plots are displayed and saved as a PNG file in the `output_dir` directory with a filename that includes
+    the name of the residual series and the current timestamp. For many series at once, see
+    features.autocorrelation.compute() and plot_sensors().
 
     The function also logs the completion of the plotting and saving process.
 
@@ -237,6 +263,9 @@ def acf_plotting(residuals):
     >>> residuals = pd.Series([...])
     >>> acf_plotting(residuals)
     """
+    import matplotlib.pyplot as plt
+    from statsmodels.graphics.tsaplots import plot_acf, plot_pacf
+
     logger.info("plotting ACF:")
 
     # Plot the ACF and PACF
@@ -254,8 +283,13 @@ def acf_plotting(residuals):
 
     plt.tight_layout()
     timestamp = round(time.time())
-    filename = f'../../data/images/acf_{residuals.name}_{timestamp}.png'
+    output_dir = Path(output_dir) if output_dir is not None else Path(config.images_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    filename = output_dir / f'acf_{residuals.name}_{timestamp}.png'
     plt.savefig(filename)
-    plt.show()
+    if show_plot:
+        plt.show()
+    else:
+        plt.close(fig)
 
-    logging.info(f'ACF and PACF plots saved as {filename}')
\ No newline at end of file
+    logger.info(f'ACF and PACF plots saved as {filename}')
@@ -0,0 +1,155 @@
+# Autocorrelation (ACF) and partial autocorrelation (PACF) of many series at once.
+#
+# compute() returns the ACF and PACF of every column of a wide frame as numeric tables (lag x sensor),
+# e.g. of the decomposition residuals of all sensors (see decomposition.load_all). The ACF of all
+# columns is computed with one FFT along the time axis: the autocovariance is the inverse transform
+# of the power spectrum of the demeaned, zero-padded series. The PACF follows from the ACF by the
+# Durbin-Levinson recursion, vectorized over the columns. Both match statsmodels' acf() and pacf()
+# with method 'ywm' (for series without gaps).
+#
+# significant_lags() selects the lags outside of the confidence band, e.g. as AR/MA orders, and
+# plot_sensors() renders the figures headless in worker processes into `config.images_dir`.
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import norm
+
+from src import config
+
+# get logger
+logger = logging.getLogger(__name__)
+
+
+def acf(df: pd.DataFrame, nlags: int = 40) -> pd.DataFrame:
+    """ Autocorrelation of every column for the lags 0..nlags (biased estimator, like statsmodels).
+        NaNs do not contribute; leading and trailing NaNs give the same result as dropping them.
+    """
+
+    x = df.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(x)
+    x = np.where(valid, x - np.nanmean(x, axis=0), 0.0)
+
+    n = len(x)
+    nfft = 1 << int(np.ceil(np.log2(max(2 * n - 1, 1))))
+    spectrum = np.fft.rfft(x, n=nfft, axis=0)
+    acov = np.fft.irfft(spectrum * np.conj(spectrum), n=nfft, axis=0)[:nlags + 1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = acov / acov[0]
+    return pd.DataFrame(r, index=pd.RangeIndex(nlags + 1, name='lag'), columns=df.columns)
+
+
+def pacf_from_acf(r: pd.DataFrame) -> pd.DataFrame:
+    """ Partial autocorrelation from the autocorrelation (lag x column) by the Durbin-Levinson recursion. """
+
+    rho = r.to_numpy(dtype=np.float64).T  # column x lag
+    n_cols, n_lags = rho.shape[0], rho.shape[1] - 1
+
+    out = np.ones((n_cols, n_lags + 1))
+    phi = np.zeros((n_cols, n_lags + 1))  # coefficients of the AR(k) fit, phi[:, 1..k]
+    for k in range(1, n_lags + 1):
+        num = rho[:, k] - np.sum(phi[:, 1:k] * rho[:, k - 1:0:-1], axis=1)
+        den = 1 - np.sum(phi[:, 1:k] * rho[:, 1:k], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            phi_kk = num / den
+        phi[:, 1:k] = phi[:, 1:k] - phi_kk[:, None] * phi[:, k - 1:0:-1]
+        phi[:, k] = phi_kk
+        out[:, k] = phi_kk
+
+    return pd.DataFrame(out.T, index=r.index, columns=r.columns)
+
+
+def compute(df: pd.DataFrame, nlags: int = 40, alpha: float = 0.05) -> Dict[str, pd.DataFrame]:
+    """ ACF and PACF of every column of the frame.
+
+    Args:
+    df (pd.DataFrame): one column per series, e.g. residuals.
+    nlags (int): number of lags. Default is 40.
+    alpha (float): confidence level of the bands. Default is 0.05.
+
+    Returns a dict with the tables (lag x sensor) 'acf', 'pacf', 'acf_band' (Bartlett's formula) and
+    'pacf_band' (1 / sqrt(n)), and the series 'n_obs' (observations per sensor).
+    """
+
+    logger.info(f"ACF/PACF of {df.shape[1]} series, {nlags} lags")
+    n_obs = df.notna().sum()
+    z = norm.ppf(1 - alpha / 2)
+
+    r = acf(df, nlags)
+    p = pacf_from_acf(r)
+
+    # Bartlett: var(r_k) = (1 + 2 * sum_{j<k} r_j^2) / n
+    cum = np.cumsum(np.r_[np.zeros((1, r.shape[1])), r.to_numpy()[1:-1] ** 2], axis=0)
+    acf_band = pd.DataFrame(np.nan, index=r.index, columns=r.columns)
+    acf_band.iloc[1:] = z * np.sqrt((1 + 2 * cum) / n_obs.to_numpy())
+    pacf_band = pd.DataFrame(np.broadcast_to(z / np.sqrt(n_obs.to_numpy()), r.shape).copy(),
+                             index=r.index, columns=r.columns)
+    pacf_band.iloc[0] = np.nan
+
+    return {'acf': r, 'pacf': p, 'acf_band': acf_band, 'pacf_band': pacf_band, 'n_obs': n_obs}
+
+
+def significant_lags(result: Dict[str, pd.DataFrame], which: str = 'pacf') -> Dict[str, List[int]]:
+    """ Lags (> 0) of each sensor whose ACF or PACF is outside of the confidence band. """
+
+    values, band = result[which].iloc[1:], result[f'{which}_band'].iloc[1:]
+    outside = values.abs() > band
+    return {column: outside.index[outside[column]].tolist() for column in outside.columns}
+
+
+def _plot_one(name: str, lags: np.ndarray, acf_values: np.ndarray, pacf_values: np.ndarray,
+              acf_band: np.ndarray, pacf_band: np.ndarray, path: Path) -> str:
+    """ Worker: renders the ACF and PACF of one sensor, in the layout of util_tools.acf_plotting. """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(2, 1, figsize=(12, 10))
+    for ax, values, band, title, label in ((axs[0], acf_values, acf_band, 'Autocorrelation Function (ACF)', 'ACF'),
+                                           (axs[1], pacf_values, pacf_band, 'Partial Autocorrelation Function (PACF)', 'PACF')):
+        ax.vlines(lags, 0, values, colors='tab:blue')
+        ax.plot(lags, values, 'o', color='tab:blue', markersize=4)
+        ax.fill_between(lags[1:], -band[1:], band[1:], alpha=0.25, color='tab:blue', linewidth=0)
+        ax.axhline(0, color='black', linewidth=0.8)
+        ax.set_title(f'{title} {name}')
+        ax.set_xlabel('Lag')
+        ax.set_ylabel(label)
+
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    return str(path)
+
+
+def plot_sensors(result: Dict[str, pd.DataFrame], output_dir: Path = None, prefix: str = 'acf',
+                 max_workers: int = None) -> List[Path]:
+    """ Renders the ACF/PACF figure of every sensor of a compute() result into
+        `<output_dir>/<prefix>_<sensor>.png` (default `config.images_dir`), in parallel worker
+        processes (default `config.PlotMaxWorkers`) and without a display. Returns the file paths.
+    """
+
+    output_dir = Path(output_dir) if output_dir is not None else Path(config.images_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    max_workers = max_workers if max_workers is not None else config.PlotMaxWorkers
+
+    names = list(result['acf'].columns)
+    lags = result['acf'].index.to_numpy()
+    args = [(name, lags, result['acf'][name].to_numpy(), result['pacf'][name].to_numpy(),
+             result['acf_band'][name].to_numpy(), result['pacf_band'][name].to_numpy(),
+             output_dir / f'{prefix}_{name}.png') for name in names]
+
+    if max_workers == 1 or len(names) <= 1:
+        paths = [_plot_one(*a) for a in args]
+    else:
+        workers = min(max_workers or os.cpu_count(), len(names))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            paths = list(pool.map(_plot_one, *zip(*args), chunksize=max(1, len(names) // (4 * workers))))
+
+    logger.info(f"ACF/PACF plots of {len(paths)} sensors saved in {output_dir}")
+    return [Path(p) for p in paths]
@@ -0,0 +1,259 @@
+# Feature store: model features of every sensor, computed from the resampled data.
+#
+# compute() builds the features of all sensor columns of a wide frame at once, with one pandas
+# rolling/shift call per feature over the whole frame instead of a loop over the sensors:
+#
+#   <sensor>__lag_<lag>          value `lag` earlier (config.FeatureLags)
+#   <sensor>__<stat>_<window>    rolling mean, std, min and max over the trailing window (config.FeatureWindows)
+#   <sensor>__diff               first difference to the previous bin
+#   tod_sin, tod_cos             time of day and
+#   dow_sin, dow_cos             day of week, encoded on the unit circle
+#
+# Lags and windows are durations, so gaps in the index are handled correctly. The features are stored
+# as float32 (half the size of float64; the sensors have < 7 significant digits), one file per month:
+#
+#   <feature_dir>/<sensor_type>/<yyyy>-<mm>.parquet
+#   <feature_dir>/<sensor_type>/_manifest.json    settings, last timestamp and input fingerprint
+#
+# update() only recomputes the tail: the rows from `config.FeatureRecomputeTail` before the last
+# stored timestamp on, from the input rows of the longest lag/window before them. Earlier rows cannot
+# change (the features only look back), so only the months of the tail are rewritten. A change of
+# the settings or of the sensors rebuilds the whole table.
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+
+from src import config
+from src import instrumentation
+
+# get logger
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = '_manifest.json'
+
+STATS = ['mean', 'std', 'min', 'max']
+TIME_COLUMNS = ['tod_sin', 'tod_cos', 'dow_sin', 'dow_cos']
+
+
+def _settings(lags: List[str] = None, windows: List[str] = None) -> dict:
+    return {'lags': list(lags) if lags is not None else list(config.FeatureLags),
+            'windows': list(windows) if windows is not None else list(config.FeatureWindows),
+            'stats': STATS}
+
+
+def lookback(lags: List[str], windows: List[str]) -> pd.Timedelta:
+    """ Input history needed for the features of a row: the longest lag or window. """
+
+    return max([pd.Timedelta(d) for d in list(lags) + list(windows)], default=pd.Timedelta(0))
+
+
+def time_encodings(index: pd.DatetimeIndex) -> pd.DataFrame:
+    """ Time of day and day of week of the index on the unit circle, so 23:59 is close to 00:00. """
+
+    day = (index - index.normalize()) / pd.Timedelta('1D')
+    week = (index.dayofweek + day) / 7
+    return pd.DataFrame({'tod_sin': np.sin(2 * np.pi * day), 'tod_cos': np.cos(2 * np.pi * day),
+                         'dow_sin': np.sin(2 * np.pi * week), 'dow_cos': np.cos(2 * np.pi * week)},
+                        index=index)
+
+
+def compute(df: pd.DataFrame, lags: List[str] = None, windows: List[str] = None) -> pd.DataFrame:
+    """ Features of every column of the frame (sorted timestamp index, one column per sensor), see the
+        module description. Lags and windows are durations (default `config.FeatureLags` and
+        `config.FeatureWindows`). Returns a float32 frame with the same index.
+    """
+
+    settings = _settings(lags, windows)
+    df = df.astype(np.float64)
+    sensors = list(df.columns)
+
+    blocks = []
+    for lag in settings['lags']:
+        # shift by a duration and align, so rows missing in the index do not shift the values
+        blocks.append(df.shift(freq=pd.Timedelta(lag)).reindex(df.index).add_suffix(f'__lag_{lag}'))
+    for window in settings['windows']:
+        rolling = df.rolling(pd.Timedelta(window), min_periods=1)
+        for stat in STATS:
+            blocks.append(getattr(rolling, stat)().add_suffix(f'__{stat}_{window}'))
+    blocks.append(df.diff().add_suffix('__diff'))
+
+    features = pd.concat(blocks, axis=1)
+    # group the columns by sensor
+    order = [f'{sensor}__{name}' for sensor in sensors for name in feature_names(settings['lags'], settings['windows'])]
+    features = features[order]
+    features = pd.concat([features, time_encodings(df.index)], axis=1)
+    return features.astype(np.float32)
+
+
+def feature_names(lags: List[str] = None, windows: List[str] = None) -> List[str]:
+    """ Names of the features of one sensor (the column names without '<sensor>__'). """
+
+    settings = _settings(lags, windows)
+    return ([f'lag_{lag}' for lag in settings['lags']]
+            + [f'{stat}_{window}' for window in settings['windows'] for stat in STATS]
+            + ['diff'])
+
+
+### storage
+
+def _type_dir(feature_dir: Path, sensor_type: str) -> Path:
+    return Path(feature_dir) / sensor_type
+
+
+def _load_manifest(feature_dir: Path, sensor_type: str) -> dict:
+    path = _type_dir(feature_dir, sensor_type) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(feature_dir: Path, sensor_type: str, manifest: dict):
+    path = _type_dir(feature_dir, sensor_type) / MANIFEST_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _write_months(features: pd.DataFrame, feature_dir: Path, sensor_type: str, keep_before: pd.Timestamp = None):
+    """ Writes the rows into the month files. The rows of the first month before `keep_before` are kept. """
+
+    type_dir = _type_dir(feature_dir, sensor_type)
+    type_dir.mkdir(parents=True, exist_ok=True)
+    for month, part in features.groupby(features.index.to_period('M'), sort=True):
+        path = type_dir / f"{month.strftime('%Y-%m')}.parquet"
+        if keep_before is not None and path.exists() and month == keep_before.to_period('M'):
+            old = pd.read_parquet(path, filters=[('timestamp', '<', keep_before)])
+            part = pd.concat([old, part]) if len(old) else part
+
+        tmp = path.with_name(path.name + '.tmp')
+        tic = time.perf_counter()
+        part.to_parquet(tmp, row_group_size=config.RawRowGroupSize)
+        os.replace(tmp, path)
+        instrumentation.file_written('features', len(part), time.perf_counter() - tic, path)
+
+
+def _fingerprint(path: Path) -> str:
+    stat = path.stat()
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def update(sensor_type: str, processed_dir: Path = None, feature_dir: Path = None, lags: List[str] = None,
+           windows: List[str] = None, tail: str = None) -> dict:
+    """ Brings the features of the sensor type up to date with `<processed_dir>/<sensor_type>_resampled.parquet`
+        (default `config.data_processed_dir`) in `feature_dir` (default `config.FeatureDir`). Only the
+        rows from `tail` (default `config.FeatureRecomputeTail`) before the last stored timestamp on are
+        recomputed, see the module description. Returns the mode ('full', 'tail' or 'skipped') and the
+        number of computed rows.
+    """
+
+    processed_dir = Path(processed_dir) if processed_dir is not None else config.data_processed_dir
+    feature_dir = Path(feature_dir) if feature_dir is not None else Path(config.FeatureDir)
+    tail = pd.Timedelta(tail if tail is not None else config.FeatureRecomputeTail)
+    settings = _settings(lags, windows)
+
+    path = processed_dir / f'{sensor_type}_resampled.parquet'
+    if not path.exists():
+        logger.warning(f"features: no resampled data for {sensor_type} in {processed_dir}")
+        return {'mode': 'skipped', 'rows': 0}
+
+    import pyarrow.parquet as pq
+    sensors = [c for c in pq.read_schema(path).names if c != 'timestamp' and not c.startswith('__')]
+
+    manifest = _load_manifest(feature_dir, sensor_type)
+    if manifest.get('input') == _fingerprint(path) and manifest.get('settings') == settings:
+        return {'mode': 'skipped', 'rows': 0}
+
+    full = (manifest.get('settings') != settings or manifest.get('sensors') != sensors
+            or manifest.get('last') is None)
+    with instrumentation.timer('features_seconds', sensor_type=sensor_type, mode='full' if full else 'tail'):
+        if full:
+            for old in _type_dir(feature_dir, sensor_type).glob('*.parquet'):
+                old.unlink()
+            start = None
+            df = pd.read_parquet(path)
+        else:
+            # recompute the tail, from the history the features of its first row look back on
+            start = pd.Timestamp(manifest['last']) - tail
+            df = pd.read_parquet(path, filters=[('timestamp', '>=', start - lookback(settings['lags'], settings['windows']))])
+
+        features = compute(df, settings['lags'], settings['windows'])
+        if start is not None:
+            features = features[features.index >= start]
+        if len(features):
+            _write_months(features, feature_dir, sensor_type, keep_before=start)
+
+    last = features.index.max() if len(features) else (pd.Timestamp(manifest['last']) if manifest.get('last') else None)
+    _save_manifest(feature_dir, sensor_type, {'settings': settings, 'sensors': sensors, 'input': _fingerprint(path),
+                                              'last': str(last) if last is not None else None})
+    mode = 'full' if full else 'tail'
+    logger.info(f"features of {sensor_type}: {len(features)} rows computed ({mode})")
+    return {'mode': mode, 'rows': len(features)}
+
+
+def update_all(processed_dir: Path = None, feature_dir: Path = None) -> Dict[str, dict]:
+    """ Updates the features of all resampled sensor types. """
+
+    processed_dir = Path(processed_dir) if processed_dir is not None else config.data_processed_dir
+    return {path.name[:-len('_resampled.parquet')]: update(path.name[:-len('_resampled.parquet')], processed_dir, feature_dir)
+            for path in sorted(processed_dir.glob('*_resampled.parquet'))}
+
+
+def read(sensor_type: str, start=None, end=None, sensors: List[str] = None, features: List[str] = None,
+         feature_dir: Path = None) -> pd.DataFrame:
+    """ Reads the feature table of the sensor type for start <= timestamp <= end. Only the columns of
+        `sensors` (default all) and `features` (names without '<sensor>__', see feature_names(), and
+        the time encodings; default all) and the month files of the range are read.
+    """
+
+    import pyarrow.parquet as pq
+
+    feature_dir = Path(feature_dir) if feature_dir is not None else Path(config.FeatureDir)
+    files = sorted(_type_dir(feature_dir, sensor_type).glob('*.parquet'))
+    if not files:
+        raise FileNotFoundError(f"no features of {sensor_type} in {feature_dir}; run build_features.update() first")
+
+    # the stored columns, also when no month file is in the range
+    schema = pq.read_schema(files[-1])
+    names = [c for c in schema.names if c != 'timestamp' and not c.startswith('__')]
+
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    if start is not None:
+        files = [f for f in files if pd.Period(f.stem, 'M') >= start.to_period('M')]
+    if end is not None:
+        files = [f for f in files if pd.Period(f.stem, 'M') <= end.to_period('M')]
+
+    columns = None
+    if sensors is not None or features is not None:
+        columns = []
+        for name in names:
+            sensor, _, feature = name.rpartition('__')
+            if not sensor:
+                # time encodings
+                keep = features is None or name in features
+            else:
+                keep = (sensors is None or sensor in sensors) and (features is None or feature in features)
+            if keep:
+                columns.append(name)
+
+    filters = []
+    if start is not None:
+        filters.append(('timestamp', '>=', start))
+    if end is not None:
+        filters.append(('timestamp', '<=', end))
+
+    if not files:
+        empty = schema.empty_table().to_pandas()
+        return empty[columns if columns is not None else names]
+
+    frames = [pd.read_parquet(f, columns=columns, filters=filters or None) for f in files]
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
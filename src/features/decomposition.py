@@ -0,0 +1,349 @@
+# Batch decomposition of many sensors into trend, seasonal and residual components.
+#
+# decompose_sensors() fits a classical (moving average, statsmodels' seasonal_decompose) or an STL
+# decomposition for every column of a wide frame on a process pool, without plotting. The components
+# of each sensor are written by the worker to `<output_dir>/<sensor>.parquet` (timestamp index,
+# columns observed/trend/seasonal/resid, the settings in the file metadata), so the parent process
+# never holds the components of all sensors and later steps (acf_plotting, forecasting) can read
+# them with load_components() instead of fitting again.
+#
+# For long and multiple seasonal periods, e.g. daily (720) and weekly (5040) at 2min, STL gets slow.
+# MultiSeasonalDecomposition ('mstl') estimates each seasonal component as the mean profile over its
+# phase (np.bincount) and the trend as a centered moving average over the longest period (cumulative
+# sums), alternating between the periods like MSTL. The cost is linear in the length of the series,
+# and the phase sums can be updated with new days without refitting the history.
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from typing import List, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from statsmodels.tsa.seasonal import seasonal_decompose, STL
+
+from src import config
+from src import instrumentation
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# parquet metadata key of the decomposition settings
+_SETTINGS_KEY = b'decomposition.settings'
+
+# columns of the summary table
+SUMMARY_COLUMNS = ['sensor', 'n_obs', 'trend_strength', 'seasonal_strength', 'seconds', 'path', 'error']
+
+
+def _prepare(series: pd.Series) -> pd.Series:
+    """ Trims leading and trailing NaNs and interpolates the gaps linearly; the decompositions need a
+        complete, regularly spaced series.
+    """
+
+    if series.first_valid_index() is None:
+        raise ValueError("series has no values")
+    series = series.loc[series.first_valid_index():series.last_valid_index()]
+    return series.interpolate(method='linear')
+
+
+def _strength(component: np.ndarray, resid: np.ndarray) -> float:
+    """ Strength of a component, 1 - var(resid) / var(component + resid), in [0, 1] (Wang et al. 2006). """
+
+    mask = ~np.isnan(component) & ~np.isnan(resid)
+    total = np.var(component[mask] + resid[mask])
+    return float(max(0.0, 1 - np.var(resid[mask]) / total)) if total > 0 else np.nan
+
+
+# reference of the seasonal phases: a Monday midnight, so the phases of weekly periods start on Mondays
+_PHASE_ORIGIN = pd.Timestamp('1970-01-05').value
+
+
+def _centered_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """ Centered moving average from cumulative sums (a 2 x window average for even windows, like
+        seasonal_decompose). The window shrinks at the ends, so there are no NaNs; NaNs are ignored.
+    """
+
+    n = len(values)
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    i = np.arange(n)
+
+    def window_sum(lo, hi):
+        lo, hi = np.clip(lo, 0, n), np.clip(hi, 0, n)
+        return sums[hi] - sums[lo], counts[hi] - counts[lo]
+
+    h = window // 2
+    if window % 2:
+        total, count = window_sum(i - h, i + h + 1)
+    else:
+        total_1, count_1 = window_sum(i - h, i + h)
+        total_2, count_2 = window_sum(i - h + 1, i + h + 1)
+        total, count = total_1 + total_2, count_1 + count_2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+def _npz_path(path: Path) -> Path:
+    path = Path(path)
+    return path if path.suffix == '.npz' else path.with_name(path.name + '.npz')
+
+
+class MultiSeasonalDecomposition:
+    """ Additive decomposition into a trend, one seasonal component per period and a residual.
+
+        Each seasonal component is the mean over all cycles of its phase profile, centered to zero
+        mean; the trend is a centered moving average over `trend_window` observations (default the
+        longest period), which also averages out all shorter periods that divide it. The components
+        are re-estimated `iterations` times, each seasonal from the series without the trend and the
+        other seasonals (backfitting, like MSTL).
+
+        fit() decomposes a series; update() decomposes the observations that follow it, using and
+        updating the phase sums of the fit, so a daily job can append new days without refitting the
+        history. The result of fit() followed by update() is close to, but not exactly, a fit of the
+        whole series. save() and load() persist the state between runs.
+    """
+
+    def __init__(self, periods: Sequence[int] = (720, 5040), iterations: int = 2, trend_window: int = None):
+        self.periods = [int(p) for p in sorted(periods)]
+        self.iterations = iterations
+        self.trend_window = int(trend_window) if trend_window is not None else max(self.periods)
+
+        self.step = None  # spacing of the observations (ns)
+        self.sums = {}    # period -> sum of the detrended values of each phase
+        self.counts = {}  # period -> number of values of each phase
+        self._tail = None  # last `trend_window` observations, to continue the trend in update()
+
+    def _phases(self, index: pd.DatetimeIndex, period: int) -> np.ndarray:
+        return ((index.as_unit('ns').asi8 - _PHASE_ORIGIN) // self.step) % period
+
+    def _profile(self, period: int) -> np.ndarray:
+        """ Mean seasonal profile of the period, centered to zero mean over the phases with data. """
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profile = self.sums[period] / self.counts[period]
+        return np.nan_to_num(profile - np.nanmean(profile)) if np.isfinite(profile).any() else np.zeros(period)
+
+    def _accumulate(self, period: int, target: np.ndarray, phases: np.ndarray):
+        valid = ~np.isnan(target)
+        self.sums[period] += np.bincount(phases[valid], weights=target[valid], minlength=period)
+        self.counts[period] += np.bincount(phases[valid], minlength=period)
+
+    def _components(self, series: pd.Series, trend: np.ndarray, seasonals: dict) -> pd.DataFrame:
+        seasonal = np.sum([seasonals[p] for p in self.periods], axis=0)
+        components = pd.DataFrame({'observed': series.to_numpy(dtype=np.float64), 'trend': trend,
+                                   'seasonal': seasonal}, index=series.index)
+        components['resid'] = components['observed'] - trend - seasonal
+        for p in self.periods:
+            components[f'seasonal_{p}'] = seasonals[p]
+        return components
+
+    def fit(self, series: pd.Series) -> pd.DataFrame:
+        """ Decomposes the regularly spaced series and returns the columns observed, trend, seasonal
+            (sum of all periods), resid and seasonal_<period> for each period.
+        """
+
+        index = pd.DatetimeIndex(series.index)
+        self.step = int(pd.Series(index.as_unit('ns').asi8).diff().median())
+        y = series.to_numpy(dtype=np.float64)
+        phases = {p: self._phases(index, p) for p in self.periods}
+
+        seasonals = {p: np.zeros(len(y)) for p in self.periods}
+        trend = _centered_mean(y, self.trend_window)
+        for _ in range(self.iterations):
+            for p in self.periods:
+                others = np.sum([seasonals[q] for q in self.periods if q != p], axis=0)
+                self.sums[p], self.counts[p] = np.zeros(p), np.zeros(p, np.int64)
+                self._accumulate(p, y - trend - others, phases[p])
+                seasonals[p] = self._profile(p)[phases[p]]
+            trend = _centered_mean(y - np.sum(list(seasonals.values()), axis=0), self.trend_window)
+
+        self._tail = series.iloc[-self.trend_window:].astype(np.float64)
+        return self._components(series, trend, seasonals)
+
+    def update(self, series: pd.Series) -> pd.DataFrame:
+        """ Decomposes the observations that follow the fitted ones and adds them to the phase sums.
+            Returns their components, and those of the last trend_window / 2 previous observations,
+            whose centered trend changes with the new observations.
+        """
+
+        if self._tail is None:
+            raise RuntimeError("fit() must be called before update()")
+        if len(series) == 0:
+            return self._components(series.astype(np.float64), np.empty(0), {p: np.empty(0) for p in self.periods})
+
+        combined = pd.concat([self._tail, series.astype(np.float64)])
+        index = pd.DatetimeIndex(combined.index)
+        y = combined.to_numpy(dtype=np.float64)
+        phases = {p: self._phases(index, p) for p in self.periods}
+        new = np.arange(len(combined)) >= len(self._tail)
+
+        seasonals = {p: self._profile(p)[phases[p]] for p in self.periods}
+        trend = _centered_mean(y - np.sum(list(seasonals.values()), axis=0), self.trend_window)
+        for p in self.periods:
+            others = np.sum([seasonals[q] for q in self.periods if q != p], axis=0)
+            self._accumulate(p, (y - trend - others)[new], phases[p][new])
+        seasonals = {p: self._profile(p)[phases[p]] for p in self.periods}
+
+        self._tail = combined.iloc[-self.trend_window:]
+        revised = max(0, len(combined) - len(series) - self.trend_window // 2)
+        components = self._components(combined, trend, seasonals)
+        return components.iloc[revised:]
+
+    def save(self, path: Path) -> Path:
+        """ Saves the state (settings, phase sums and the tail of the series) to a .npz file; '.npz' is
+            appended to `path` if it has another suffix, like np.savez does. Returns the file.
+        """
+
+        path = _npz_path(path)
+        arrays = {f'sums_{p}': self.sums[p] for p in self.periods}
+        arrays.update({f'counts_{p}': self.counts[p] for p in self.periods})
+        np.savez(path, periods=self.periods, iterations=self.iterations, trend_window=self.trend_window,
+                 step=self.step, tail_index=self._tail.index.as_unit('ns').asi8, tail_unit=self._tail.index.unit,
+                 tail_values=self._tail.to_numpy(), **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path: Path) -> 'MultiSeasonalDecomposition':
+        """ Loads a state saved with save() to `path` (with the same suffix rule). """
+
+        with np.load(_npz_path(path)) as data:
+            model = cls(data['periods'].tolist(), int(data['iterations']), int(data['trend_window']))
+            model.step = int(data['step'])
+            model.sums = {p: data[f'sums_{p}'] for p in model.periods}
+            model.counts = {p: data[f'counts_{p}'] for p in model.periods}
+            index = pd.to_datetime(data['tail_index'], unit='ns')
+            if 'tail_unit' in data.files:
+                index = index.as_unit(str(data['tail_unit']))
+            model._tail = pd.Series(data['tail_values'], index=index)
+        return model
+
+
+def fit(series: pd.Series, method: str = 'stl', period: int = 720, model: str = 'additive',
+        seasonal: int = 5, robust: bool = False, periods: Sequence[int] = None) -> pd.DataFrame:
+    """ Decomposes one series and returns its components as columns observed, trend, seasonal and resid.
+
+    Args:
+    series (pd.Series): regularly spaced time series, e.g. resampled to 2min.
+    method (str): 'classical' (seasonal_decompose), 'stl' or 'mstl' (MultiSeasonalDecomposition,
+        additive, with the additional columns seasonal_<period>). Default is 'stl'.
+    period (int): observations per seasonal cycle. Default is 720 (one day at 2min).
+    model (str): 'additive' or 'multiplicative', only for 'classical'. Default is 'additive'.
+    seasonal (int): length of the seasonal smoother, only for 'stl'. Default is 5.
+    robust (bool): robust STL fit, only for 'stl'. Default is False.
+    periods (list): seasonal periods of 'mstl', default `period` and 7 * `period` (daily and weekly).
+    """
+
+    series = _prepare(series)
+    if method == 'mstl':
+        periods = periods if periods is not None else (period, 7 * period)
+        return MultiSeasonalDecomposition(periods).fit(series)
+    if method == 'classical':
+        res = seasonal_decompose(series, model=model, period=period)
+    elif method == 'stl':
+        res = STL(series, period=period, seasonal=seasonal, robust=robust).fit()
+    else:
+        raise ValueError(f"unknown decomposition method {method!r}")
+
+    return pd.DataFrame({'observed': res.observed, 'trend': res.trend, 'seasonal': res.seasonal,
+                         'resid': res.resid}, index=series.index)
+
+
+def _decompose(name: str, series: pd.Series, settings: dict, output_dir: Path) -> dict:
+    """ Worker: fits one sensor, writes its components and returns its summary row. """
+
+    tic = time.perf_counter()
+    row = {'sensor': name, 'n_obs': int(series.notna().sum())}
+    try:
+        components = fit(series, **settings)
+
+        # for a multiplicative model, the strengths are computed on the log scale
+        resid = components['resid'].to_numpy()
+        trend, seasonal = components['trend'].to_numpy(), components['seasonal'].to_numpy()
+        if settings.get('method') == 'classical' and settings.get('model') == 'multiplicative':
+            resid, trend, seasonal = np.log(resid), np.log(trend), np.log(seasonal)
+        row.update(trend_strength=_strength(trend, resid), seasonal_strength=_strength(seasonal, resid))
+
+        path = Path(output_dir) / f'{name}.parquet'
+        table = pa.Table.from_pandas(components.astype(np.float64))
+        metadata = {**(table.schema.metadata or {}), _SETTINGS_KEY: json.dumps(settings).encode()}
+        tmp = path.with_name(path.name + '.tmp')
+        pq.write_table(table.replace_schema_metadata(metadata), tmp)
+        os.replace(tmp, path)
+        row['path'] = str(path)
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+    row['seconds'] = time.perf_counter() - tic
+    return row
+
+
+def decompose_sensors(df: pd.DataFrame, method: str = 'stl', period: int = 720, model: str = 'additive',
+                      seasonal: int = 5, robust: bool = False, periods: Sequence[int] = None,
+                      max_workers: int = None, output_dir: Path = None) -> pd.DataFrame:
+    """ Decomposes every column of the frame in parallel worker processes, see fit() for the settings.
+        The components of each sensor are saved to `<output_dir>/<sensor>.parquet` (default
+        `config.DecompositionDir`); nothing is plotted. With `max_workers=1` the fits run in this process
+        (default `config.DecompositionMaxWorkers`).
+
+        Returns a table with one row per sensor: number of observations, strength of the trend and of
+        the seasonality (0 = none, 1 = all variation apart from the residual), runtime, path of the
+        components and the error if the fit failed.
+    """
+
+    settings = dict(method=method, period=period, model=model, seasonal=seasonal, robust=robust,
+                    periods=list(periods) if periods is not None else None)
+    max_workers = max_workers if max_workers is not None else config.DecompositionMaxWorkers
+    output_dir = Path(output_dir) if output_dir is not None else Path(config.DecompositionDir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"Decomposing {df.shape[1]} sensors with {settings}")
+    tic = time.perf_counter()
+
+    names = list(df.columns)
+    with instrumentation.timer('decompose_sensors_seconds', method=method):
+        if max_workers == 1 or len(names) <= 1:
+            rows = [_decompose(name, df[name], settings, output_dir) for name in names]
+        else:
+            with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(names))) as pool:
+                rows = list(pool.map(_decompose, names, (df[name] for name in names),
+                                     [settings] * len(names), [output_dir] * len(names)))
+
+    # the workers time each sensor; their metrics are recorded here, in the calling process
+    for row in rows:
+        instrumentation.observe('decomposition_fit_seconds', row['seconds'], method=method)
+        instrumentation.count('decomposition_sensors_total', status='failed' if 'error' in row else 'ok')
+
+    summary = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+    n_failed = int(summary['error'].notna().sum())
+    logger.info(f"Decomposition done in {time.perf_counter() - tic:.1f} s ({n_failed} failed)")
+    return summary
+
+
+def load_components(sensor: str, output_dir: Path = None, columns: List[str] = None) -> pd.DataFrame:
+    """ Reads the stored components of a sensor (all of them, or `columns`). """
+
+    output_dir = Path(output_dir) if output_dir is not None else Path(config.DecompositionDir)
+    return pd.read_parquet(output_dir / f'{sensor}.parquet', columns=columns)
+
+
+def load_settings(sensor: str, output_dir: Path = None) -> dict:
+    """ Returns the settings the stored components of a sensor were fitted with. """
+
+    output_dir = Path(output_dir) if output_dir is not None else Path(config.DecompositionDir)
+    metadata = pq.read_schema(output_dir / f'{sensor}.parquet').metadata or {}
+    return json.loads(metadata.get(_SETTINGS_KEY, b'{}'))
+
+
+def load_all(column: str = 'resid', sensors: List[str] = None, output_dir: Path = None) -> pd.DataFrame:
+    """ Reads one component of all stored sensors (or `sensors`) into a wide frame, e.g. the residuals
+        for autocorrelation.compute().
+    """
+
+    output_dir = Path(output_dir) if output_dir is not None else Path(config.DecompositionDir)
+    sensors = sensors if sensors is not None else sorted(p.stem for p in output_dir.glob('*.parquet'))
+    return pd.DataFrame({sensor: load_components(sensor, output_dir, [column])[column] for sensor in sensors})
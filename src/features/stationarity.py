@@ -0,0 +1,130 @@
+# Batch stationarity tests of many sensors.
+#
+# test_sensors() runs the Augmented Dickey-Fuller (ADF) and the Kwiatkowski-Phillips-Schmidt-Shin
+# (KPSS) test on every column of a wide frame on a process pool and returns one row per sensor with
+# the statistics, p-values, lags and runtime. ADF tests the null hypothesis of a unit root
+# (non-stationary), KPSS the null hypothesis of (trend-)stationarity, so a sensor is considered
+# stationary if ADF rejects and KPSS does not.
+#
+# The result of each sensor is cached in `config.StationarityCacheDir` under a fingerprint of its
+# data and the test settings, so unchanged sensors are not tested again.
+
+import os
+import json
+import time
+import hashlib
+import logging
+import warnings
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from statsmodels.tsa.stattools import adfuller, kpss
+
+from src import config
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# columns of the results table
+RESULT_COLUMNS = ['sensor', 'n_obs', 'adf_stat', 'adf_pvalue', 'adf_lags', 'kpss_stat', 'kpss_pvalue',
+                  'kpss_lags', 'stationary', 'seconds', 'error', 'cached']
+
+
+def fingerprint(series: pd.Series, settings: dict) -> str:
+    """ Hash of the values and timestamps of the series and of the test settings. """
+
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(series.index.asi8 if isinstance(series.index, pd.DatetimeIndex)
+                                  else series.index.to_numpy()).tobytes())
+    h.update(np.ascontiguousarray(series.to_numpy(dtype=np.float64)).tobytes())
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _run_tests(name: str, values: np.ndarray, settings: dict) -> dict:
+    """ Runs ADF and KPSS on one series; errors (e.g. too few observations) are returned, not raised. """
+
+    tic = time.perf_counter()
+    result = {'sensor': name, 'n_obs': len(values)}
+    try:
+        with warnings.catch_warnings():
+            # KPSS warns when the statistic is outside of its p-value table
+            warnings.simplefilter('ignore')
+            adf = adfuller(values, regression=settings['adf_regression'], maxlag=settings['maxlag'],
+                           autolag=settings['autolag'])
+            kp = kpss(values, regression=settings['kpss_regression'], nlags=settings['kpss_nlags'])
+        result.update(adf_stat=float(adf[0]), adf_pvalue=float(adf[1]), adf_lags=int(adf[2]),
+                      kpss_stat=float(kp[0]), kpss_pvalue=float(kp[1]), kpss_lags=int(kp[2]),
+                      stationary=bool(adf[1] < settings['alpha'] and kp[1] >= settings['alpha']))
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - tic
+    return result
+
+
+def _cache_path(cache_dir: Path, key: str) -> Path:
+    return Path(cache_dir) / key[:2] / f'{key}.json'
+
+
+def test_sensors(df: pd.DataFrame, adf_regression: str = 'ct', kpss_regression: str = 'ct', maxlag: int = None,
+                 autolag: str = 'AIC', kpss_nlags='auto', alpha: float = 0.05, max_workers: int = None,
+                 use_cache: bool = True, cache_dir: Path = None) -> pd.DataFrame:
+    """ Runs the ADF and KPSS tests on every column of the frame in parallel worker processes.
+
+    Args:
+    df (pd.DataFrame): one column per sensor; NaNs are dropped per column.
+    adf_regression (str): deterministic terms of the ADF test, 'c', 'ct', 'ctt' or 'n'. Default is 'ct'.
+    kpss_regression (str): deterministic terms of the KPSS test, 'c' or 'ct'. Default is 'ct'.
+    maxlag (int): maximum lag of the ADF test; default 12 * (nobs / 100)^(1/4).
+    autolag (str): lag selection of the ADF test, 'AIC', 'BIC', 't-stat' or None (use maxlag).
+    kpss_nlags (str or int): lags of the KPSS test, 'auto', 'legacy' or a number. Default is 'auto'.
+    alpha (float): significance level of the `stationary` column. Default is 0.05.
+    max_workers (int): worker processes, default `config.StationarityMaxWorkers`; 1 runs in this process.
+    use_cache (bool): reuse and store results in `cache_dir` (default `config.StationarityCacheDir`).
+
+    Returns a table with one row per sensor: number of observations, ADF and KPSS statistics, p-values
+    and lags, whether the sensor is stationary, the runtime in seconds, the error if a test failed, and
+    whether the row came from the cache.
+    """
+
+    settings = dict(adf_regression=adf_regression, kpss_regression=kpss_regression, maxlag=maxlag,
+                    autolag=autolag, kpss_nlags=kpss_nlags, alpha=alpha)
+    max_workers = max_workers if max_workers is not None else config.StationarityMaxWorkers
+    cache_dir = Path(cache_dir) if cache_dir is not None else Path(config.StationarityCacheDir)
+
+    logger.info(f"Stationarity tests of {df.shape[1]} sensors")
+    tic = time.perf_counter()
+
+    results = {}
+    todo = {}  # sensor -> (values, cache key)
+    for name in df.columns:
+        series = df[name].dropna()
+        key = fingerprint(series, settings)
+        path = _cache_path(cache_dir, key)
+        if use_cache and path.exists():
+            results[name] = dict(json.loads(path.read_text()), sensor=name, cached=True)
+        else:
+            todo[name] = (series.to_numpy(dtype=np.float64), key)
+
+    if todo:
+        if max_workers == 1 or len(todo) == 1:
+            computed = [_run_tests(name, values, settings) for name, (values, _) in todo.items()]
+        else:
+            with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(todo))) as pool:
+                computed = list(pool.map(_run_tests, list(todo), [v for v, _ in todo.values()],
+                                         [settings] * len(todo)))
+
+        for result in computed:
+            name = result['sensor']
+            results[name] = dict(result, cached=False)
+            if use_cache and 'error' not in result:
+                path = _cache_path(cache_dir, todo[name][1])
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(json.dumps(result))
+
+    table = pd.DataFrame([results[name] for name in df.columns], columns=RESULT_COLUMNS)
+    logger.info(f"Stationarity tests done in {time.perf_counter() - tic:.1f} s "
+                f"({len(todo)} tested, {len(results) - len(todo)} from cache, "
+                f"{int(table['stationary'].fillna(False).astype(bool).sum())} stationary)")
+    return table
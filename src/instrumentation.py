@@ -0,0 +1,268 @@
+# Low-overhead metrics of the hot paths: counters and latency histograms.
+#
+# The DB queries, the parquet writes, the resampling and the decomposition record what they do:
+#
+#   with instrumentation.timer('resample_seconds', sensor_type=sensor_type):   # latency histogram
+#       ...
+#   instrumentation.count('db_rows_total', len(df))                            # counter
+#
+# Metrics are only recorded after enable() (or with `config.MetricsEnabled`). Disabled, timer() returns
+# a shared no-op context manager and count()/observe() return right away, so the instrumented code
+# costs one flag check per call. The metrics of a process can be exported as a JSON report
+# (write_json) or in the Prometheus text format (write_prometheus), e.g. for the textfile collector
+# of the node exporter. Worker processes record into their own copy; dump() and merge() carry their
+# metrics back to the parent (see pipeline.py).
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Tuple
+
+from src import config
+
+# get logger
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets in seconds (the Prometheus client defaults, extended down to
+# 0.1 ms for cache hits and connection checkouts and up to 5 minutes for pipeline stages)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# prefix of the metric names in the Prometheus export
+PREFIX = 'smartbuilding_'
+
+_enabled = config.MetricsEnabled
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, tuple], float] = {}
+_histograms: Dict[Tuple[str, tuple], list] = {}   # key -> [bucket counts..., count, sum, min, max]
+
+
+def enable(on: bool = True):
+    """ Starts (or with `on=False` stops) recording metrics in this process. """
+
+    global _enabled
+    _enabled = on
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    """ Removes all recorded metrics. """
+
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def count(name: str, value: float = 1, **labels):
+    """ Adds `value` to the counter `name` with the given labels. """
+
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """ Records `value` (seconds) in the histogram `name` with the given labels. """
+
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * len(BUCKETS) + [0, 0.0, value, value]
+        n = len(BUCKETS)
+        i = bisect.bisect_left(BUCKETS, value)
+        if i < n:
+            h[i] += 1
+        h[n] += 1
+        h[n + 1] += value
+        h[n + 2] = min(h[n + 2], value)
+        h[n + 3] = max(h[n + 3], value)
+
+
+class _Timer:
+    """ Records the wall time of the block in a histogram. """
+
+    __slots__ = ('name', 'labels', 'tic')
+
+    def __init__(self, name: str, labels: dict):
+        self.name, self.labels = name, labels
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.tic, **self.labels)
+        return False
+
+
+class _NullTimer:
+    """ Timer that does nothing, returned while disabled. """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name: str, **labels):
+    """ Context manager that records the wall time of the block in the histogram `name`. """
+
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+def file_written(kind: str, rows: int, seconds: float, *paths: Path):
+    """ Records a parquet write of `rows` rows into the files `paths`: the latency in the histogram
+        'parquet_write_seconds' and the rows and bytes written, labeled with `kind`.
+    """
+
+    if not _enabled:
+        return
+    observe('parquet_write_seconds', seconds, kind=kind)
+    count('parquet_rows_written_total', rows, kind=kind)
+    count('parquet_bytes_written_total', sum(os.path.getsize(p) for p in paths if os.path.exists(p)), kind=kind)
+
+
+### worker processes
+
+def dump() -> dict:
+    """ The raw metrics of this process, to be merged into another process with merge(). """
+
+    with _lock:
+        return {'counters': list(_counters.items()), 'histograms': [(k, list(h)) for k, h in _histograms.items()]}
+
+
+def merge(state: dict):
+    """ Adds the metrics of dump() of another process to the metrics of this process. """
+
+    n = len(BUCKETS)
+    with _lock:
+        for (name, labels), value in state['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            _counters[key] = _counters.get(key, 0) + value
+        for (name, labels), other in state['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            h = _histograms.get(key)
+            if h is None:
+                _histograms[key] = list(other)
+                continue
+            for i in range(n + 2):
+                h[i] += other[i]
+            h[n + 2], h[n + 3] = min(h[n + 2], other[n + 2]), max(h[n + 3], other[n + 3])
+
+
+### export
+
+def _quantile(h: list, q: float) -> float:
+    """ Estimates the quantile from the buckets by linear interpolation, like Prometheus' histogram_quantile(). """
+
+    n = len(BUCKETS)
+    total, low, high = h[n], h[n + 2], h[n + 3]
+    rank, seen = q * total, 0
+    for i, upper in enumerate(BUCKETS):
+        if seen + h[i] >= rank and h[i]:
+            lower = BUCKETS[i - 1] if i else 0.0
+            value = lower + (upper - lower) * (rank - seen) / h[i]
+            return min(max(value, low), high)
+        seen += h[i]
+    return high
+
+
+def _label_str(labels: tuple) -> str:
+    return ','.join(f'{k}={v}' for k, v in labels)
+
+
+def report() -> dict:
+    """ The metrics as a dict: counters (name -> labels -> value) and histograms (name -> labels ->
+        count, sum, min, max, mean and the estimated p50, p95 and p99).
+    """
+
+    n = len(BUCKETS)
+    with _lock:
+        counters, histograms = dict(_counters), {k: list(h) for k, h in _histograms.items()}
+
+    out = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'counters': {}, 'histograms': {}}
+    for (name, labels), value in sorted(counters.items()):
+        out['counters'].setdefault(name, {})[_label_str(labels)] = value
+    for (name, labels), h in sorted(histograms.items()):
+        out['histograms'].setdefault(name, {})[_label_str(labels)] = {
+            'count': h[n], 'sum': h[n + 1], 'min': h[n + 2], 'max': h[n + 3],
+            'mean': h[n + 1] / h[n] if h[n] else None,
+            'p50': _quantile(h, 0.5), 'p95': _quantile(h, 0.95), 'p99': _quantile(h, 0.99)}
+    return out
+
+
+def prometheus() -> str:
+    """ The metrics in the Prometheus text exposition format. """
+
+    def labels_of(labels, extra=()):
+        items = [f'{k}="{str(v)}"' for k, v in tuple(labels) + tuple(extra)]
+        return '{' + ','.join(items) + '}' if items else ''
+
+    n = len(BUCKETS)
+    with _lock:
+        counters, histograms = dict(_counters), {k: list(h) for k, h in _histograms.items()}
+
+    lines, typed = [], set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {PREFIX}{name} counter')
+            typed.add(name)
+        lines.append(f'{PREFIX}{name}{labels_of(labels)} {value}')
+    for (name, labels), h in sorted(histograms.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for i, upper in enumerate(BUCKETS):
+            cumulative += h[i]
+            lines.append(f'{PREFIX}{name}_bucket{labels_of(labels, [("le", upper)])} {cumulative}')
+        lines.append(f'{PREFIX}{name}_bucket{labels_of(labels, [("le", "+Inf")])} {h[n]}')
+        lines.append(f'{PREFIX}{name}_sum{labels_of(labels)} {h[n + 1]}')
+        lines.append(f'{PREFIX}{name}_count{labels_of(labels)} {h[n]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path: Path, text: str) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(text)
+    os.replace(tmp, path)
+    return path
+
+
+def write_json(path: Path = None) -> Path:
+    """ Writes report() to `path` (default `<config.MetricsDir>/metrics.json`). """
+
+    path = Path(path) if path is not None else Path(config.MetricsDir) / 'metrics.json'
+    return _write(path, json.dumps(report(), indent=2))
+
+
+def write_prometheus(path: Path = None) -> Path:
+    """ Writes prometheus() to `path` (default `<config.MetricsDir>/smartbuilding.prom`). """
+
+    path = Path(path) if path is not None else Path(config.MetricsDir) / 'smartbuilding.prom'
+    return _write(path, prometheus())
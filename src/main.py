@@ -1,50 +1,66 @@
 # This is the main file which runs the data processing pipeline.
+#
+# Run from the project root:
+#
+#   python -m src.main --list
+#   python -m src.main [--stage NAME ...] [--from NAME] [--until NAME] [--force] [--workers N] [--metrics]
 
+import sys
 import logging
-from data import make_dataset
-from visualization import visualize
+import argparse
 
-# import config to use global parameters and setup logger
-import config
+# import config to use global parameters; main() sets up the logger
+from src import config
+from src import instrumentation
+from src import pipeline
 
 
-# maybe use click to define command line parameters to run data processing, training, ...
-# @click.command()
-# @click.option('--stage', default='download', help='Run processing pipeline from this stage on.')
-# def main(stage: str):
-def main():
-    """ Runs the data processing pipeline.
+def main(argv=None):
+    """ Runs the data processing pipeline, see pipeline.py.
     """
 
-    # Note: The processing pipeline is bluntly implemented. More elegant ways might use
-    # Perfect, a Python library for data processing pipelines, Apache Airflow or Luigi.
-    
+    # Note: the stages, their inputs and outputs are defined in pipeline.default_stages(). Stages that are
+    # up to date are skipped, independent stages run in parallel.
+    stages = pipeline.default_stages()
+
+    parser = argparse.ArgumentParser(description='Runs the stages of the data processing pipeline that are not up to date.')
+    parser.add_argument('--stage', nargs='+', default=None, choices=list(stages), help='run only these stages')
+    parser.add_argument('--from', dest='start', default=None, choices=list(stages),
+                        help='run this stage and all stages that depend on it')
+    parser.add_argument('--until', default=None, choices=list(stages), help='run this stage and all stages it depends on')
+    parser.add_argument('--force', action='store_true', help='run the selected stages even if they are up to date')
+    parser.add_argument('--workers', type=int, default=None, help='stages run in parallel (default config.PipelineMaxWorkers)')
+    parser.add_argument('--list', action='store_true', help='list the stages and whether they are up to date')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record metrics of the queries, writes and stages into config.MetricsDir (JSON and Prometheus)')
+    args = parser.parse_args(argv)
+
+    # setup the logger and load the .env file
+    config.init()
+
     # get logger
     logger = logging.getLogger(__name__)
 
+    if args.list:
+        for name in pipeline.order(stages):
+            stage = stages[name]
+            status = 'always runs' if stage.always else ('up to date' if pipeline.is_up_to_date(stage) else 'outdated')
+            logger.info(f"{name:16s} after {stage.deps or '-'}: {status}")
+        return 0
+
     # log start
     logger.info(f'starting pipeline')
 
+    if args.metrics:
+        instrumentation.enable()
 
-    ### this defines the automated analysis pipeline
-
-    # download data from DB
-    #make_dataset.download_data()
-
-    # visualize raw data
-    #visualize.plot_raw_data()
-
-    # resample data
-    #make_dataset.resample_data()
-
-    # visualize processed data
-    #visualize.plot_processed_data()
-
-    # compile room data
-    #make_dataset.compile_room_data()
-
+    report = pipeline.run(stages, only=args.stage, start=args.start, until=args.until, force=args.force,
+                          max_workers=args.workers)
 
+    if instrumentation.enabled():
+        logger.info(f"metrics saved to {instrumentation.write_json()} and {instrumentation.write_prometheus()}")
+    return 1 if report['status'].isin(['failed', 'blocked']).any() else 0
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,362 @@
+# Stage runner of the data processing pipeline.
+#
+# The pipeline is a DAG of stages (see default_stages()): each stage declares the stages it depends on, the
+# files it reads and the files it writes. Before a stage runs, its fingerprint is computed from
+#
+#   - the name, size and modification time of every input file,
+#   - the parameters of the stage and
+#   - the source code of the modules that implement it,
+#
+# and compared with the fingerprint of its last successful run (stored in `config.PipelineStateDir`).
+# A stage whose fingerprint did not change and whose outputs are unchanged since that run is skipped.
+# Stages that do not depend on each other (e.g. plotting the raw data and resampling it) run at the
+# same time. Each stage runs in its own worker process; at the end, the status, wall time and peak
+# memory (growth of the peak resident memory of its process) of each stage are logged.
+#
+# Run from the project root, see main.py:
+#
+#   python -m src.main                          # all stages that are not up to date
+#   python -m src.main --from resample          # resample and everything that depends on it
+#   python -m src.main --until resample         # resample and everything it depends on
+#   python -m src.main --stage plot_raw --force
+
+import os
+import json
+import time
+import hashlib
+import inspect
+import logging
+import importlib.util
+import pandas as pd
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List
+
+from src import config
+from src import instrumentation
+
+try:
+    import resource
+except ImportError:  # not available on Windows; the peak memory is not reported
+    resource = None
+
+# get logger
+logger = logging.getLogger(__name__)
+
+REPORT_COLUMNS = ['stage', 'status', 'seconds', 'peak_mb', 'fingerprint']
+
+
+@dataclass
+class Stage:
+    """ A step of the pipeline: `func(**params)` reads `inputs` and writes `outputs` (files, directories
+        or glob patterns) after the stages in `deps` are done. A change of the source of the modules in
+        `code` (or of `func`) runs the stage again. A stage with `always=True` reads from
+        outside of the project (the DB) and runs whenever it is selected; its outputs still decide
+        whether the stages after it run.
+    """
+
+    name: str
+    func: Callable
+    deps: List[str] = field(default_factory=list)
+    inputs: List[Path] = field(default_factory=list)
+    outputs: List[Path] = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    code: List[str] = field(default_factory=list)
+    always: bool = False
+
+
+### stages of the pipeline
+
+def _download(start_date: str):
+    from src.data import make_dataset
+    # only measurements newer than the stored ones are fetched
+    make_dataset.download_data(start_date=start_date, incremental=True)
+
+
+def _plot_raw(max_points: int, method: str):
+    from src.visualization import visualize
+    visualize.plot_raw_data(max_points=max_points, method=method)
+
+
+def _resample(rate: str, max_gap: str):
+    from src.data import make_dataset
+    make_dataset.resample_data(rate=rate, max_gap=max_gap)
+
+
+def _plot_processed(max_points: int, method: str):
+    from src.visualization import visualize
+    visualize.plot_processed_data(max_points=max_points, method=method)
+
+
+def _decompose(period: int):
+    from src.features import decomposition
+    for path in sorted(config.data_processed_dir.glob('*_resampled.parquet')):
+        decomposition.decompose_sensors(pd.read_parquet(path), period=period)
+
+
+def _features(lags: List[str], windows: List[str]):
+    from src.features import build_features
+    for path in sorted(config.data_processed_dir.glob('*_resampled.parquet')):
+        build_features.update(path.name[:-len('_resampled.parquet')], lags=lags, windows=windows)
+
+
+def default_stages() -> Dict[str, Stage]:
+    """ The stages of the pipeline with the current settings of `config`. """
+
+    raw, processed, figures = config.data_raw_dir, config.data_processed_dir, config.figures_dir
+    resampled = processed / '*_resampled.parquet'
+    # one day of bins of the resampling rate
+    period = int(pd.Timedelta('1D') / pd.Timedelta(config.ResampleRate))
+
+    return {stage.name: stage for stage in [
+        Stage('download', _download, outputs=[raw], params=dict(start_date=config.StartDate or "2024-01-01"),
+              always=True),
+        Stage('plot_raw', _plot_raw, deps=['download'], inputs=[raw, config.RollupDir],
+              outputs=[figures / '*_raw.html'], code=['src.visualization.visualize', 'src.visualization.lod'],
+              params=dict(max_points=config.PlotMaxPoints, method=config.PlotLODMethod)),
+        Stage('resample', _resample, deps=['download'], inputs=[raw], outputs=[resampled],
+              params=dict(rate=config.ResampleRate, max_gap=config.ResampleMaxGap),
+              code=['src.data.make_dataset', 'src.data.resample']),
+        Stage('plot_processed', _plot_processed, deps=['resample'], inputs=[resampled],
+              outputs=[figures / '*_resampled.html'], code=['src.visualization.visualize', 'src.visualization.lod'],
+              params=dict(max_points=config.PlotMaxPoints, method=config.PlotLODMethod)),
+        Stage('decompose', _decompose, deps=['resample'], inputs=[resampled],
+              outputs=[config.DecompositionDir], params=dict(period=period), code=['src.features.decomposition']),
+        Stage('features', _features, deps=['resample'], inputs=[resampled], outputs=[config.FeatureDir],
+              params=dict(lags=config.FeatureLags, windows=config.FeatureWindows), code=['src.features.build_features']),
+    ]}
+
+
+### fingerprints
+
+def _files(specs: List[Path]) -> List[Path]:
+    """ Files of the given files, directories (recursive) and glob patterns; temporary files are left out. """
+
+    files = []
+    for spec in map(Path, specs):
+        if '*' in spec.name:
+            found = spec.parent.glob(spec.name)
+        elif spec.is_dir():
+            found = spec.rglob('*')
+        else:
+            found = [spec]
+        files.extend(p for p in found if p.is_file() and not p.name.endswith('.tmp'))
+    return sorted(set(files))
+
+
+def fingerprint_files(specs: List[Path]) -> str:
+    """ Hash of the path, size and modification time of every file of the specs. """
+
+    h = hashlib.sha256()
+    for path in _files(specs):
+        stat = path.stat()
+        h.update(f'{path}|{stat.st_size}|{stat.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+def fingerprint(stage: Stage) -> str:
+    """ Hash of the inputs, the parameters and the code of the stage. """
+
+    h = hashlib.sha256()
+    h.update(stage.name.encode())
+    h.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    sources = [inspect.getsourcefile(stage.func)] + [importlib.util.find_spec(name).origin for name in stage.code]
+    for source in sources:
+        h.update(Path(source).read_bytes())
+    h.update(fingerprint_files(stage.inputs).encode())
+    return h.hexdigest()
+
+
+def _state_path(state_dir: Path, name: str) -> Path:
+    return Path(state_dir) / f'{name}.json'
+
+
+def _load_state(state_dir: Path, name: str) -> dict:
+    path = _state_path(state_dir, name)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(state_dir: Path, name: str, state: dict):
+    path = _state_path(state_dir, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def is_up_to_date(stage: Stage, state_dir: Path = None) -> bool:
+    """ True if the stage ran with the same fingerprint and its outputs were not changed since. """
+
+    state_dir = Path(state_dir) if state_dir is not None else Path(config.PipelineStateDir)
+    if stage.always:
+        return False
+    state = _load_state(state_dir, stage.name)
+    return (state.get('fingerprint') == fingerprint(stage)
+            and _files(stage.outputs) != []
+            and state.get('outputs') == fingerprint_files(stage.outputs))
+
+
+### runner
+
+def order(stages: Dict[str, Stage]) -> List[str]:
+    """ Names of the stages in topological order (a stage after all of its dependencies). """
+
+    done, ordered = set(), []
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise ValueError(f"pipeline has a cycle: {' -> '.join(path + [name])}")
+        if name not in stages:
+            raise ValueError(f"unknown stage {name!r}, use one of {list(stages)}")
+        for dep in stages[name].deps:
+            visit(dep, path + [name])
+        done.add(name)
+        ordered.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return ordered
+
+
+def select(stages: Dict[str, Stage], only: List[str] = None, start: str = None, until: str = None) -> List[str]:
+    """ Names of the selected stages in topological order: the stages in `only`, or the stage `start`
+        and all stages that depend on it, and/or the stage `until` and all stages it depends on.
+        Default all stages.
+    """
+
+    ordered = order(stages)
+    for name in (only or []) + [s for s in (start, until) if s is not None]:
+        if name not in stages:
+            raise ValueError(f"unknown stage {name!r}, use one of {ordered}")
+
+    if only:
+        return [name for name in ordered if name in only]
+
+    selected = set(ordered)
+    if start is not None:
+        downstream = {start}
+        for name in ordered:
+            if downstream & set(stages[name].deps):
+                downstream.add(name)
+        selected &= downstream
+    if until is not None:
+        upstream, todo = set(), [until]
+        while todo:
+            name = todo.pop()
+            if name not in upstream:
+                upstream.add(name)
+                todo.extend(stages[name].deps)
+        selected &= upstream
+    return [name for name in ordered if name in selected]
+
+
+def _execute(func: Callable, params: dict) -> tuple:
+    """ Worker: runs a stage and returns its wall time, the memory it added to the peak resident
+        memory of the worker process in MB, and the metrics it recorded (see instrumentation).
+    """
+
+    def peak_rss():
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else float('nan')
+
+    # the worker is forked from the runner; only the metrics of this stage are sent back
+    instrumentation.reset()
+    rss = peak_rss()
+    tic = time.perf_counter()
+    func(**params)
+    seconds = time.perf_counter() - tic
+    return seconds, peak_rss() - rss, instrumentation.dump()
+
+
+def run(stages: Dict[str, Stage] = None, only: List[str] = None, start: str = None, until: str = None,
+        force: bool = False, max_workers: int = None, state_dir: Path = None) -> pd.DataFrame:
+    """ Runs the selected stages (see select()) that are not up to date, or all selected stages if
+        `force`. Each stage runs in its own worker process, so its peak memory can be measured; stages
+        whose dependencies are done run at the same time, up to `max_workers` (default
+        `config.PipelineMaxWorkers`). Stages after a failed stage are not run.
+
+        Returns the report with one row per selected stage: status ('done', 'skipped', 'failed' or
+        'blocked'), wall time, peak memory added by the stage and fingerprint.
+    """
+
+    stages = stages if stages is not None else default_stages()
+    state_dir = Path(state_dir) if state_dir is not None else Path(config.PipelineStateDir)
+    max_workers = max_workers if max_workers is not None else config.PipelineMaxWorkers
+    max_workers = max_workers or os.cpu_count()
+    selected = select(stages, only, start, until)
+    logger.info(f"pipeline: running {selected}")
+
+    report = {name: dict(stage=name, status='pending', seconds=None, peak_mb=None, fingerprint=None)
+              for name in selected}
+    queue, running = [], {}
+    tic = time.perf_counter()
+
+    def update():
+        # marks the pending stages as blocked, skipped or queued; skipped and blocked stages can make
+        # further stages ready, so repeat until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for name in selected:
+                row, deps = report[name], [dep for dep in stages[name].deps if dep in report]
+                if row['status'] != 'pending':
+                    continue
+                if any(report[dep]['status'] in ('failed', 'blocked') for dep in deps):
+                    row['status'], changed = 'blocked', True
+                # dependencies outside of the selection count as done
+                elif all(report[dep]['status'] in ('done', 'skipped') for dep in deps):
+                    row['fingerprint'] = fingerprint(stages[name])
+                    if not force and is_up_to_date(stages[name], state_dir):
+                        row['status'], changed = 'skipped', True
+                        logger.info(f"pipeline: stage {name} is up to date")
+                    else:
+                        row['status'] = 'queued'
+                        queue.append(name)
+
+    def finish(name, future):
+        stage, row = stages[name], report[name]
+        error = future.exception()
+        if error is not None:
+            row['status'] = 'failed'
+            logger.error(f"pipeline: stage {name} failed: {error!r}")
+            return
+        row['seconds'], row['peak_mb'], metrics = future.result()
+        row['status'] = 'done'
+        instrumentation.merge(metrics)
+        instrumentation.observe('pipeline_stage_seconds', row['seconds'], stage=name)
+        _save_state(state_dir, name, {'fingerprint': row['fingerprint'], 'outputs': fingerprint_files(stage.outputs),
+                                      'seconds': row['seconds'],
+                                      'finished': pd.Timestamp.now().isoformat(timespec='seconds')})
+        logger.info(f"pipeline: stage {name} done in {row['seconds']:.1f} s")
+
+    try:
+        update()
+        while queue or running:
+            while queue and len(running) < max_workers:
+                name = queue.pop(0)
+                report[name]['status'] = 'running'
+                logger.info(f"pipeline: starting stage {name}")
+                executor = ProcessPoolExecutor(max_workers=1)
+                running[executor.submit(_execute, stages[name].func, stages[name].params)] = (name, executor)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, executor = running.pop(future)
+                executor.shutdown()
+                finish(name, future)
+            update()
+    finally:
+        for future, (name, executor) in running.items():
+            executor.shutdown(cancel_futures=True)
+
+    df = pd.DataFrame(list(report.values()), columns=REPORT_COLUMNS)
+    df['fingerprint'] = df['fingerprint'].str[:12]
+    logger.info(f"pipeline: finished in {time.perf_counter() - tic:.1f} s\n{df.to_string(index=False)}")
+    return df
@@ -0,0 +1,162 @@
+# Level-of-detail downsampling of sensor series for interactive plots.
+#
+# A line plot cannot show more points than it has pixels, so each series is reduced to about
+# `max_points` points before it is handed to Bokeh:
+#
+# - 'minmax' keeps the minimum and the maximum of each of max_points / 2 equally wide time buckets,
+#   so spikes are always visible; it is the fastest method.
+# - 'lttb' (Largest-Triangle-Three-Buckets, Steinarsson 2013) keeps one point per bucket, the one that
+#   forms the largest triangle with the points kept in the neighbouring buckets; it preserves the
+#   visual shape with fewer points.
+#
+# source_data() builds the columns of a single ColumnDataSource for all sensors (x_<sensor> and
+# y_<sensor>, padded to the same length). zoom_document() builds a Bokeh server document that reads
+# the visible range again from the raw data store whenever the user zooms or pans, see lod_app.py.
+
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+
+from src import config
+
+# get logger
+logger = logging.getLogger(__name__)
+
+
+def minmax(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """ Positions of the minimum and maximum of `y` in each of max_points / 2 buckets of equal width
+        in `x` (sorted, numeric). The positions are sorted, so the points stay in time order.
+    """
+
+    n = len(x)
+    n_buckets = max(1, max_points // 2)
+    if n <= max_points:
+        return np.arange(n)
+
+    # x is sorted, so the buckets are contiguous runs of positions
+    bounds = np.linspace(x[0], x[-1], n_buckets + 1)[1:-1]
+    starts = np.unique(np.r_[0, np.searchsorted(x, bounds, side='left')])
+    starts = starts[starts < n]
+    counts = np.diff(np.r_[starts, n])
+    bucket = np.repeat(np.arange(len(starts)), counts)
+
+    kept = []
+    for reduce in (np.minimum, np.maximum):
+        extreme = reduce.reduceat(y, starts)
+        hits = np.flatnonzero(y == extreme[bucket])
+        # first position of the extreme in each bucket
+        kept.append(hits[np.unique(bucket[hits], return_index=True)[1]])
+    return np.unique(np.concatenate(kept))
+
+
+def lttb(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """ Positions of the points kept by Largest-Triangle-Three-Buckets; the first and the last point
+        are always kept.
+    """
+
+    n = len(x)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    # the inner points are split into max_points - 2 buckets of equal count
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    kept = np.empty(max_points, np.int64)
+    kept[0], kept[-1] = 0, n - 1
+
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+METHODS = {'minmax': minmax, 'lttb': lttb}
+
+
+def downsample(series: pd.Series, max_points: int = None, method: str = None) -> pd.Series:
+    """ Reduces the series (DatetimeIndex) to at most about `max_points` points (default
+        `config.PlotMaxPoints`) with `method` (default `config.PlotLODMethod`). NaNs are dropped.
+    """
+
+    max_points = max_points if max_points is not None else config.PlotMaxPoints
+    method = method if method is not None else config.PlotLODMethod
+    if method not in METHODS:
+        raise ValueError(f"unknown downsampling method {method!r}, use one of {list(METHODS)}")
+
+    series = series.dropna()
+    x = series.index.as_unit('ns').asi8.astype(np.float64)
+    kept = METHODS[method](x, series.to_numpy(dtype=np.float64), max_points)
+    return series.iloc[kept]
+
+
+def source_data(df: pd.DataFrame, max_points: int = None, method: str = None) -> Dict[str, np.ndarray]:
+    """ Columns of a single ColumnDataSource for all sensors of the frame: x_<sensor> (timestamps) and
+        y_<sensor> (values) of each downsampled sensor, padded with NaT/NaN to the same length. With
+        `method=False` the sensors are not downsampled and share the column 'timestamp'.
+    """
+
+    if method is False:
+        data = {'timestamp': df.index.to_numpy()}
+        data.update({f'x_{column}': data['timestamp'] for column in df.columns})
+        data.update({f'y_{column}': df[column].to_numpy(dtype=np.float64) for column in df.columns})
+        return data
+
+    reduced = {column: downsample(df[column], max_points, method) for column in df.columns}
+    length = max((len(s) for s in reduced.values()), default=0)
+
+    data = {}
+    for column, series in reduced.items():
+        x = np.full(length, np.datetime64('NaT'), dtype='datetime64[ns]')
+        y = np.full(length, np.nan)
+        x[:len(series)] = series.index.as_unit('ns').to_numpy()
+        y[:len(series)] = series.to_numpy(dtype=np.float64)
+        data[f'x_{column}'], data[f'y_{column}'] = x, y
+    return data
+
+
+def zoom_document(doc, raw_dir: Path, sensor_type: str, sensors: List[str] = None, max_points: int = None,
+                  method: str = None):
+    """ Fills the Bokeh server document `doc` with a plot of the sensor type that shows the downsampled
+        overview and, after each zoom or pan, the visible range downsampled again from the raw data
+        store (raw_store.read_type() only reads the partitions and row groups of that range).
+    """
+
+    from bokeh.events import RangesUpdate
+    from bokeh.models import ColumnDataSource
+    from bokeh.palettes import Category20
+    from bokeh.plotting import figure
+    from src.data import raw_store
+
+    df = raw_store.read_type(raw_dir, sensor_type, sensors)
+    source = ColumnDataSource(data=source_data(df, max_points, method))
+    columns = list(df.columns)
+    del df
+
+    p = figure(title=f"{sensor_type} sensors", x_axis_type="datetime", x_axis_label='Timestamp',
+               y_axis_label='Sensor Values', width=1200, height=400)
+    colors = Category20[20]
+    for index, column in enumerate(columns):
+        p.line(x=f'x_{column}', y=f'y_{column}', source=source, legend_label=column, line_width=2,
+               color=colors[index % len(colors)])
+    p.legend.location = "top_left"
+    p.legend.click_policy = "hide"
+
+    def on_range(event):
+        # the event gives the visible range in milliseconds since the epoch
+        start, end = pd.Timestamp(event.x0, unit='ms'), pd.Timestamp(event.x1, unit='ms')
+        window = raw_store.read_type(raw_dir, sensor_type, columns, start=start, end=end)
+        logger.debug(f"zoom {start} - {end}: {len(window)} rows")
+        source.data = source_data(window.reindex(columns=columns), max_points, method)
+
+    p.on_event(RangesUpdate, on_range)
+    doc.add_root(p)
+    doc.title = f"SmartBuilding {sensor_type}"
+    return doc
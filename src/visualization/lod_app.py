@@ -0,0 +1,27 @@
+# Bokeh server app to browse the raw data of a sensor type with level-of-detail downsampling.
+#
+# Zooming or panning reads the visible range again from the raw data store and downsamples it to
+# the plot width, so details down to single samples can be inspected (see lod.zoom_document).
+# Run from the project root:
+#
+#   bokeh serve src/visualization/lod_app.py --args temperature
+#   bokeh serve src/visualization/lod_app.py --args co2 --raw-dir data/raw --method lttb --sensors sensor_12 sensor_13
+
+import argparse
+
+from bokeh.plotting import curdoc
+
+from src import config
+from src.visualization import lod
+
+parser = argparse.ArgumentParser(description='Browse the raw sensor data with level-of-detail downsampling.')
+parser.add_argument('sensor_type')
+parser.add_argument('--raw-dir', default=config.data_raw_dir)
+parser.add_argument('--sensors', nargs='*', default=None)
+parser.add_argument('--method', default=None, choices=list(lod.METHODS))
+parser.add_argument('--max-points', type=int, default=None)
+args = parser.parse_args()
+
+config.init()
+
+lod.zoom_document(curdoc(), args.raw_dir, args.sensor_type, args.sensors, args.max_points, args.method)
@@ -0,0 +1,96 @@
+# Headless overview plots of the raw and the processed data, one HTML file per sensor type.
+#
+# The plots are saved in `config.figures_dir` and not shown, so they can be rendered by the pipeline
+# (see pipeline.py). Each sensor is reduced to about `config.PlotMaxPoints` points (see lod.py); the
+# raw data is read from the rollup store if it is available, which is much faster than the raw files.
+
+import logging
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+
+from src import config
+from src.data import raw_store
+from src.data import rollups
+from src.visualization import lod
+
+# get logger
+logger = logging.getLogger(__name__)
+
+
+def save_plot(df: pd.DataFrame, title: str, file_path: Path, max_points: int = None, method: str = None) -> Path:
+    """ Saves a line plot of all sensors of the frame (timestamp index, one column per sensor) as HTML,
+        in the layout of util_tools.plot_all_sensors. Each sensor is downsampled to `max_points` with
+        `method`, see lod.source_data().
+    """
+
+    from bokeh.io import save
+    from bokeh.models import ColumnDataSource
+    from bokeh.palettes import Category20
+    from bokeh.plotting import figure
+    from bokeh.resources import CDN
+
+    p = figure(title=title, x_axis_type="datetime", x_axis_label='Timestamp', y_axis_label='Sensor Values',
+               width=1200, height=400)
+    source = ColumnDataSource(data=lod.source_data(df, max_points=max_points, method=method))
+    colors = Category20[20]
+    for index, column in enumerate(df.columns):
+        p.line(x=f'x_{column}', y=f'y_{column}', source=source, legend_label=column, line_width=2,
+               color=colors[index % len(colors)])
+    p.legend.location = "top_left"
+    p.legend.click_policy = "hide"
+
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    save(p, filename=file_path, resources=CDN, title=title)
+    return file_path
+
+
+def plot_raw_data(raw_dir: Path = None, output_dir: Path = None, sensor_types: List[str] = None,
+                  max_points: int = None, method: str = None) -> Dict[str, Path]:
+    """ Plots the raw data of each sensor type (default all stored types) into
+        `<output_dir>/<sensor_type>_raw.html` (default `config.figures_dir`), see save_plot() for
+        `max_points` and `method`. Returns the files.
+    """
+
+    raw_dir = Path(raw_dir) if raw_dir is not None else config.data_raw_dir
+    output_dir = Path(output_dir) if output_dir is not None else config.figures_dir
+    sensor_types = sensor_types if sensor_types is not None else raw_store.stored_types(raw_dir)
+    rollup_dir = rollups.rollup_dir_for(raw_dir)
+
+    files = {}
+    for sensor_type in sensor_types:
+        if config.RollupsEnabled and rollups.stored_resolutions(sensor_type, rollup_dir):
+            df = rollups.read(sensor_type, rollup_dir=rollup_dir)
+            title = f"{sensor_type} sensors (mean per {df.attrs['resolution']})"
+        else:
+            df = raw_store.read_type(raw_dir, sensor_type)
+            title = f"{sensor_type} sensors"
+        if df.empty:
+            logger.warning(f"No raw data to plot for {sensor_type}")
+            continue
+        files[sensor_type] = save_plot(df, title, output_dir / f'{sensor_type}_raw.html', max_points, method)
+
+    logger.info(f"Plots of the raw data of {list(files)} saved in {output_dir}")
+    return files
+
+
+def plot_processed_data(processed_dir: Path = None, output_dir: Path = None, max_points: int = None,
+                        method: str = None) -> Dict[str, Path]:
+    """ Plots every `<sensor_type>_resampled.parquet` of the processed data (default
+        `config.data_processed_dir`) into `<output_dir>/<sensor_type>_resampled.html` (default
+        `config.figures_dir`), see save_plot() for `max_points` and `method`. Returns the files.
+    """
+
+    processed_dir = Path(processed_dir) if processed_dir is not None else config.data_processed_dir
+    output_dir = Path(output_dir) if output_dir is not None else config.figures_dir
+
+    files = {}
+    for path in sorted(processed_dir.glob('*_resampled.parquet')):
+        sensor_type = path.name[:-len('_resampled.parquet')]
+        df = pd.read_parquet(path)
+        files[sensor_type] = save_plot(df, f"{sensor_type} sensors (resampled)", output_dir / f'{sensor_type}_resampled.html',
+                                       max_points, method)
+
+    logger.info(f"Plots of the processed data of {list(files)} saved in {output_dir}")
+    return files
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from src.features import build_features
+
+
+def _store(tmp_path):
+    index = pd.date_range('2024-03-01', periods=24 * 40, freq='1h', name='timestamp')
+    t = np.arange(len(index))
+    df = pd.DataFrame({'sensor_1': np.sin(t / 24), 'sensor_2': np.cos(t / 24)}, index=index)
+    processed_dir, feature_dir = tmp_path / 'processed', tmp_path / 'features'
+    processed_dir.mkdir()
+    df.to_parquet(processed_dir / 'temperature_resampled.parquet')
+    build_features.update('temperature', processed_dir, feature_dir, lags=['1h'], windows=['3h'])
+    return feature_dir
+
+
+def test_read_range_without_data(tmp_path):
+    feature_dir = _store(tmp_path)
+    stored = build_features.read('temperature', feature_dir=feature_dir)
+
+    df = build_features.read('temperature', start='2023-01-01', end='2023-02-01', feature_dir=feature_dir)
+    assert df.empty
+    assert list(df.columns) == list(stored.columns)
+
+    df = build_features.read('temperature', start='2023-01-01', end='2023-02-01', sensors=['sensor_1'],
+                             features=['diff'], feature_dir=feature_dir)
+    assert df.empty
+    assert list(df.columns) == ['sensor_1__diff']
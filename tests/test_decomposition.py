@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from src.features.decomposition import MultiSeasonalDecomposition
+
+
+def _series(start: str, n: int) -> pd.Series:
+    index = pd.date_range(start, periods=n, freq='2min')
+    t = np.arange(n) + (index[0] - pd.Timestamp('2024-01-01')) // pd.Timedelta('2min')
+    rng = np.random.default_rng(0)
+    return pd.Series(20 + np.sin(2 * np.pi * t / 24) + 0.5 * np.sin(2 * np.pi * t / 168) + rng.normal(0, 0.1, n),
+                     index=index)
+
+
+def test_save_load_round_trip_without_suffix(tmp_path):
+    model = MultiSeasonalDecomposition(periods=(24, 168))
+    model.fit(_series('2024-01-01', 2000))
+
+    path = model.save(tmp_path / 'state')
+    assert path == tmp_path / 'state.npz'
+    loaded = MultiSeasonalDecomposition.load(tmp_path / 'state')
+
+    assert loaded.periods == model.periods
+    assert loaded.step == model.step
+    new = _series(model._tail.index[-1] + pd.Timedelta('2min'), 300)
+    pd.testing.assert_frame_equal(loaded.update(new), model.update(new), check_freq=False)